@@ -1,8 +1,21 @@
 from PIL import Image
 from math import sqrt
+import sys, os, argparse
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'project1')))
+
+import render.tiles
+import render.stats
+from assignment5.bvh import build_bvh_sah, build_primitive_bvh, leaf_dispatch, bvh_closest, bvh_occluded
+from assignment5.instance import Instance, affine, hit_instance
+from assignment5.mesh import Material, TriangleMesh, triangle_intersector
+from assignment5.objfile import load_obj_arrays
 
 
 class Vec:
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -23,8 +36,18 @@ class Vec:
     def div(self, num):
         return Vec(self.x / num, self.y / num, self.z / num)
 
+    def neg(self):
+        return Vec(-self.x, -self.y, -self.z)
+
+    def madd(self, vec, num):
+        """self + vec * num as a single new vector."""
+        return Vec(self.x + vec.x * num, self.y + vec.y * num, self.z + vec.z * num)
+
+    def length_squared(self):
+        return self.x * self.x + self.y * self.y + self.z * self.z
+
     def length(self):
-        return sqrt(self.x**2 + self.y**2 + self.z**2)
+        return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
 
     def cross(self, vec):
         return Vec(self.y * vec.z - self.z * vec.y,
@@ -37,7 +60,24 @@ class Vec:
             raise ValueError("Cannot normalize a zero-length vector")
         return self.div(l)
 
+    def direction_from(self, origin):
+        """self.sub(origin).normalize() without the intermediate vector."""
+        x = self.x - origin.x
+        y = self.y - origin.y
+        z = self.z - origin.z
+        l = sqrt(x * x + y * y + z * z)
+        if l == 0:
+            raise ValueError("Cannot normalize a zero-length vector")
+        return Vec(x / l, y / l, z / l)
+
+    def reflect(self, normal):
+        """normal * (2 * normal.dot(self)) - self as a single new vector."""
+        k = 2 * (normal.x * self.x + normal.y * self.y + normal.z * self.z)
+        return Vec(normal.x * k - self.x, normal.y * k - self.y, normal.z * k - self.z)
+
 class Color:
+    __slots__ = ('r', 'g', 'b')
+
     def __init__(self, r, g, b):
         self.r = r
         self.g = g
@@ -49,6 +89,11 @@ class Color:
     def add(self, other):
         return Color(self.r + other.r, self.g + other.g, self.b + other.b)
 
+    def blend(self, other, t):
+        """self * (1 - t) + other * t as a single new color."""
+        s = 1 - t
+        return Color(self.r * s + other.r * t, self.g * s + other.g * t, self.b * s + other.b * t)
+
 class Sphere:
     def __init__(self, center, radius, color, specular=0, reflective=0):
         self.center = center
@@ -58,6 +103,10 @@ class Sphere:
         self.reflective = reflective
         self.transparency = 0  # Opaque
 
+    def bounds(self):
+        c, r = self.center, self.radius
+        return (c.x - r, c.y - r, c.z - r), (c.x + r, c.y + r, c.z + r)
+
 class Light:
     def __init__(self, intensity):
         self.intensity = intensity
@@ -89,6 +138,12 @@ class Triangle:
         self.edge2 = self.v2.sub(self.v0)
         self.normal = self.edge1.cross(self.edge2).normalize()
 
+    def bounds(self):
+        xs = (self.v0.x, self.v1.x, self.v2.x)
+        ys = (self.v0.y, self.v1.y, self.v2.y)
+        zs = (self.v0.z, self.v1.z, self.v2.z)
+        return (min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs))
+
 class Cylinder:
     def __init__(self, base, axis, height, radius, color, specular, reflective, transparency=0):
         """
@@ -108,6 +163,18 @@ class Cylinder:
         self.reflective = reflective
         self.transparency = transparency
 
+    def bounds(self):
+        """Box around both end caps: a cap of radius r reaches r*sqrt(1 - a_i^2) along axis i."""
+        a = self.axis
+        top = self.base.madd(a, self.height)
+        lo, hi = [], []
+        for b, t, a_i in ((self.base.x, top.x, a.x), (self.base.y, top.y, a.y),
+                          (self.base.z, top.z, a.z)):
+            reach = self.radius * sqrt(max(0.0, 1 - a_i * a_i))
+            lo.append(min(b, t) - reach)
+            hi.append(max(b, t) + reach)
+        return tuple(lo), tuple(hi)
+
 
 WIDTH = 300
 HEIGHT = 300
@@ -137,7 +204,10 @@ cylinders = [
     )
 ]
 
-triangles = []  # to be filled by the OBJ loader
+triangles = []
+triangle_arrays = None  # the same triangles as a TriangleMesh, for the BVH leaf tests
+
+instances = []  # to be filled with the bunny (a transformed instance of bunny.obj)
 
 lights = [
     AmbientLight(0.2),
@@ -145,8 +215,11 @@ lights = [
     DirectionalLight(0.2, Vec(1, 4, 4))
 ]
 
-bunny_bbox_min = None
-bunny_bbox_max = None
+# Every sphere, triangle and cylinder in one list, the BVH over it and the
+# leaf callback that dispatches to the right intersector (see set_scene).
+scene_objects = []
+scene_bvh = None
+scene_intersect = None
 
 
 def canvas_to_viewport(x, y):
@@ -157,31 +230,6 @@ def canvas_to_viewport(x, y):
         projection_plane_z
     )
 
-def ray_intersect_aabb(origin, direction, box_min, box_max):
-    """Simple ray-AABB intersection test."""
-    tmin = (box_min.x - origin.x) / direction.x if direction.x != 0 else -float('inf')
-    tmax = (box_max.x - origin.x) / direction.x if direction.x != 0 else float('inf')
-    if tmin > tmax: tmin, tmax = tmax, tmin
-
-    tymin = (box_min.y - origin.y) / direction.y if direction.y != 0 else -float('inf')
-    tymax = (box_max.y - origin.y) / direction.y if direction.y != 0 else float('inf')
-    if tymin > tymax: tymin, tymax = tymax, tymin
-
-    if (tmin > tymax) or (tymin > tmax):
-        return False
-
-    tmin = max(tmin, tymin)
-    tmax = min(tmax, tymax)
-
-    tzmin = (box_min.z - origin.z) / direction.z if direction.z != 0 else -float('inf')
-    tzmax = (box_max.z - origin.z) / direction.z if direction.z != 0 else float('inf')
-    if tzmin > tzmax: tzmin, tzmax = tzmax, tzmin
-
-    if (tmin > tzmax) or (tzmin > tmax):
-        return False
-
-    return tmax >= max(tmin, 0)
-
 def refract_ray(incident, normal, n1, n2):
     """
     Computes the refracted ray direction using Snell's law.
@@ -199,10 +247,14 @@ def refract_ray(incident, normal, n1, n2):
 
 
 def intersect_ray_sphere(origin, direction, sphere):
-    oc = origin.sub(sphere.center)
+    # oc = origin - center
+    c = sphere.center
+    ocx = origin.x - c.x
+    ocy = origin.y - c.y
+    ocz = origin.z - c.z
     k1 = direction.dot(direction)
-    k2 = 2 * oc.dot(direction)
-    k3 = oc.dot(oc) - sphere.radius**2
+    k2 = 2 * (ocx * direction.x + ocy * direction.y + ocz * direction.z)
+    k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - sphere.radius**2
     discriminant = k2 * k2 - 4 * k1 * k3
     if discriminant < 0:
         return float('inf'), float('inf')
@@ -214,8 +266,8 @@ def intersect_ray_sphere(origin, direction, sphere):
 def intersect_ray_triangle(origin, direction, triangle):
     """Möller–Trumbore algorithm."""
     epsilon = 1e-6
-    edge1 = triangle.v1.sub(triangle.v0)
-    edge2 = triangle.v2.sub(triangle.v0)
+    edge1 = triangle.edge1
+    edge2 = triangle.edge2
     h = direction.cross(edge2)
     a = edge1.dot(h)
     if abs(a) < epsilon:
@@ -257,7 +309,7 @@ def intersect_ray_cylinder(origin, direction, cylinder):
         t2 = (-b_quad - sqrt_disc) / (2 * a)
         for t in [t1, t2]:
             if t > EPSILON:
-                P = o.add(d.mul(t))
+                P = o.madd(d, t)
                 proj = P.sub(b).dot(v)
                 if 0 <= proj <= cylinder.height:
                     t_side = min(t_side, t)
@@ -265,14 +317,14 @@ def intersect_ray_cylinder(origin, direction, cylinder):
     if abs(d.dot(v)) > EPSILON:
         t_bottom = (cylinder.base.sub(o)).dot(v) / d.dot(v)
         if t_bottom > EPSILON:
-            P_bottom = o.add(d.mul(t_bottom))
+            P_bottom = o.madd(d, t_bottom)
             if P_bottom.sub(cylinder.base).sub(v.mul(P_bottom.sub(cylinder.base).dot(v))).length() <= r:
                 t_cap = min(t_cap, t_bottom)
     top_center = cylinder.base.add(v.mul(cylinder.height))
     if abs(d.dot(v)) > EPSILON:
         t_top = (top_center.sub(o)).dot(v) / d.dot(v)
         if t_top > EPSILON:
-            P_top = o.add(d.mul(t_top))
+            P_top = o.madd(d, t_top)
             if P_top.sub(top_center).sub(v.mul(P_top.sub(top_center).dot(v))).length() <= r:
                 t_cap = min(t_cap, t_top)
 
@@ -280,80 +332,65 @@ def intersect_ray_cylinder(origin, direction, cylinder):
     return t_final if t_final != float('inf') else float('inf')
 
 
-def load_obj(filename, color, specular, reflective):
-    """Load a Wavefront OBJ file and return a list of Triangle objects."""
-    vertices = []
-    tris = []
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('v '):
-                parts = line.split()
-                try:
-                    x = float(parts[1])
-                    y = float(parts[2])
-                    z = float(parts[3])
-                except Exception as e:
-                    print("Error parsing vertex line:", line)
-                    continue
-                vertices.append(Vec(x, y, z))
-            elif line.startswith('f '):
-                parts = line.split()
-                try:
-                    idx0 = int(parts[1].split('/')[0]) - 1
-                    idx1 = int(parts[2].split('/')[0]) - 1
-                    idx2 = int(parts[3].split('/')[0]) - 1
-                except Exception as e:
-                    print("Error parsing face line:", line)
-                    continue
-                try:
-                    v0 = vertices[idx0]
-                    v1 = vertices[idx1]
-                    v2 = vertices[idx2]
-                except IndexError as e:
-                    print("Index error in face line:", line)
-                    continue
-                tris.append(Triangle(v0, v1, v2, color, specular, reflective))
-    return tris
+def triangle_mesh(tris):
+    """Pack triangles into a TriangleMesh (in the same order) for batched ray tests."""
+    corners = [(v.x, v.y, v.z) for tri in tris for v in (tri.v0, tri.v1, tri.v2)]
+    return TriangleMesh(corners, np.arange(len(corners)).reshape(-1, 3), [])
 
+def hit_sphere(sphere, origin, direction, t_min, t_max):
+    """Nearer intersection distance with a sphere within (t_min, t_max), or inf."""
+    t1, t2 = intersect_ray_sphere(origin, direction, sphere)
+    t = float('inf')
+    if t_min < t1 < t_max:
+        t = t1
+    if t_min < t2 < t_max and t2 < t:
+        t = t2
+    return t
 
-def closest_intersection(origin, direction, t_min, t_max):
-    closest_t = float('inf')
-    closest_obj = None
-
-    # Check spheres.
-    for sphere in spheres:
-        t1, t2 = intersect_ray_sphere(origin, direction, sphere)
-        if t_min < t1 < t_max and t1 < closest_t:
-            closest_t = t1
-            closest_obj = sphere
-        if t_min < t2 < t_max and t2 < closest_t:
-            closest_t = t2
-            closest_obj = sphere
-
-    # Check bunny triangles.
-    if triangles and bunny_bbox_min is not None and bunny_bbox_max is not None:
-        if ray_intersect_aabb(origin, direction, bunny_bbox_min, bunny_bbox_max):
-            for triangle in triangles:
-                t = intersect_ray_triangle(origin, direction, triangle)
-                if t_min < t < t_max and t < closest_t:
-                    closest_t = t
-                    closest_obj = triangle
-    else:
-        for triangle in triangles:
-            t = intersect_ray_triangle(origin, direction, triangle)
-            if t_min < t < t_max and t < closest_t:
-                closest_t = t
-                closest_obj = triangle
+def hit_cylinder(cylinder, origin, direction, t_min, t_max):
+    """Intersection distance with a cylinder within (t_min, t_max), or inf."""
+    t = intersect_ray_cylinder(origin, direction, cylinder)
+    return t if t_min < t < t_max else float('inf')
 
-    # Check cylinders.
-    for cylinder in cylinders:
-        t = intersect_ray_cylinder(origin, direction, cylinder)
-        if t_min < t < t_max and t < closest_t:
-            closest_t = t
-            closest_obj = cylinder
+def scene_tests(objects, mesh):
+    """
+    The (intersector, argument) pair of every scene object for leaf_dispatch.
+    Triangles are tested straight from the mesh arrays; they appear in
+    `objects` in the same order as in the mesh. Instances are traversed in
+    their own object space.
+    """
+    hit_triangle = triangle_intersector(mesh) if mesh is not None else None
+    tests = []
+    k = 0
+    for obj in objects:
+        if isinstance(obj, Triangle):
+            tests.append((hit_triangle, k))
+            k += 1
+        elif isinstance(obj, Sphere):
+            tests.append((hit_sphere, obj))
+        elif isinstance(obj, Instance):
+            tests.append((hit_instance, obj))
+        else:
+            tests.append((hit_cylinder, obj))
+    return tests
 
-    return (closest_obj, closest_t) if closest_obj is not None else None
+def closest_intersection(origin, direction, t_min, t_max):
+    """
+    Finds the closest object hit by the ray within (t_min, t_max) with one
+    BVH over all spheres, triangles, cylinders and instances.
+    Returns a tuple (object, t) if found, or None otherwise.
+    """
+    hit = bvh_closest(scene_bvh, origin, direction, t_min, t_max, scene_intersect)
+    if hit is None:
+        return None
+    return (scene_objects[hit[0]], hit[1])
+
+def occluded(origin, direction, t_min, t_max):
+    """
+    Shadow-ray query: True as soon as any object blocks the ray within
+    (t_min, t_max), instead of looking for the nearest one.
+    """
+    return bvh_occluded(scene_bvh, origin, direction, t_min, t_max, scene_intersect)
 
 def compute_lighting(point, normal, view, specular):
     intensity = 0.0
@@ -369,53 +406,67 @@ def compute_lighting(point, normal, view, specular):
                 t_max = float('inf')
             else:
                 continue
-            if closest_intersection(point, L, EPSILON, t_max) is not None:
+            stats = render.stats.active
+            if stats is None:
+                blocked = occluded(point, L, EPSILON, t_max)
+            else:
+                blocked = stats.trace("shadow", occluded, point, L, EPSILON, t_max)
+            if blocked:
                 continue
             n_dot_l = normal.dot(L)
             if n_dot_l > 0:
                 intensity += light.intensity * n_dot_l / (normal.length() * L.length())
             if specular != -1:
-                R = normal.mul(2 * n_dot_l).sub(L)
+                R = L.reflect(normal)
                 r_dot_v = R.dot(view)
                 if r_dot_v > 0:
                     intensity += light.intensity * (r_dot_v / (R.length() * view.length())) ** specular
     return intensity
 
 def reflect_ray(incident, normal):
-    return normal.mul(2 * incident.dot(normal)).sub(incident)
+    return incident.reflect(normal)
 
-def trace_ray(origin, direction, t_min, t_max, depth):
-    intersection = closest_intersection(origin, direction, t_min, t_max)
+def trace_ray(origin, direction, t_min, t_max, depth, kind="primary"):
+    stats = render.stats.active
+    if stats is None:
+        intersection = closest_intersection(origin, direction, t_min, t_max)
+    else:
+        intersection = stats.trace(kind, closest_intersection, origin, direction, t_min, t_max)
     if intersection is None:
         return background_color
     closest_obj, closest_t = intersection
-    point = origin.add(direction.mul(closest_t))
+    point = origin.madd(direction, closest_t)
 
     # Compute normal.
     if isinstance(closest_obj, Sphere):
-        normal = point.sub(closest_obj.center).normalize()
+        normal = point.direction_from(closest_obj.center)
     elif isinstance(closest_obj, Triangle):
         normal = closest_obj.normal
+    elif isinstance(closest_obj, Instance):
+        # Shade with the hit triangle's material from here on.
+        index = closest_obj.last_hit
+        normal = Vec(*closest_obj.normal(index))
+        closest_obj = closest_obj.material(index)
     elif isinstance(closest_obj, Cylinder):
         v = closest_obj.axis
         proj = point.sub(closest_obj.base).dot(v)
         if 0 < proj < closest_obj.height:
             point_on_axis = closest_obj.base.add(v.mul(proj))
-            normal = point.sub(point_on_axis).normalize()
+            normal = point.direction_from(point_on_axis)
         else:
-            normal = v if proj > closest_obj.height else v.mul(-1)
+            normal = v if proj > closest_obj.height else v.neg()
     else:
         normal = Vec(0, 0, 0)
 
-    view = direction.mul(-1)
+    view = direction.neg()
     lighting = compute_lighting(point, normal, view, closest_obj.specular)
     local_color = closest_obj.color.mul(lighting)
     final_color = local_color
 
     if closest_obj.reflective > 0 and depth > 0:
         reflected_ray = reflect_ray(view, normal).normalize()
-        reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1)
-        final_color = final_color.mul(1 - closest_obj.reflective).add(reflected_color.mul(closest_obj.reflective))
+        reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1, "reflection")
+        final_color = final_color.blend(reflected_color, closest_obj.reflective)
 
     if hasattr(closest_obj, 'transparency') and closest_obj.transparency > 0 and depth > 0:
         # For our cylinder we simulate refraction.
@@ -424,72 +475,114 @@ def trace_ray(origin, direction, t_min, t_max, depth):
         if direction.dot(normal) < 0:
             refracted = refract_ray(direction, normal, n_air, n_cyl)
         else:
-            refracted = refract_ray(direction, normal.mul(-1), n_cyl, n_air)
+            refracted = refract_ray(direction, normal.neg(), n_cyl, n_air)
         if refracted is None:
             transmitted_color = Color(0, 0, 0)
         else:
-            transmitted_color = trace_ray(point, refracted, EPSILON, float('inf'), depth - 1)
-        final_color = final_color.mul(1 - closest_obj.transparency).add(transmitted_color.mul(closest_obj.transparency))
+            transmitted_color = trace_ray(point, refracted, EPSILON, float('inf'), depth - 1, "refraction")
+        final_color = final_color.blend(transmitted_color, closest_obj.transparency)
 
     return final_color
 
 
-def render_scene():
-    img = Image.new("RGB", (WIDTH, HEIGHT))
-    pixels = img.load()
-    for px in range(-WIDTH // 2, WIDTH // 2):
-        for py in range(-HEIGHT // 2, HEIGHT // 2):
+def set_scene(objects, bvh, mesh):
+    """
+    Installs the scene objects, their BVH and the mesh of the loose triangles,
+    e.g. in a worker process that did not inherit them. The leaf callback is
+    a closure, so it is rebuilt here instead of being pickled.
+    """
+    global scene_objects, scene_bvh, scene_intersect, triangle_arrays
+    scene_objects = objects
+    scene_bvh = bvh
+    triangle_arrays = mesh
+    scene_intersect = leaf_dispatch(scene_tests(objects, mesh))
+
+def render_tile(x0, y0, x1, y1):
+    """Render the pixel block [x0, x1) x [y0, y1) as a (y1 - y0, x1 - x0, 3) uint8 array."""
+    data = bytearray()
+    for fy in range(y0, y1):
+        py = HEIGHT // 2 - fy - 1
+        for fx in range(x0, x1):
+            px = fx - WIDTH // 2
             direction = canvas_to_viewport(px, py).normalize()
             color = trace_ray(camera_position, direction, 1.0, float('inf'), RECURSION_DEPTH)
-            fx = px + WIDTH // 2
-            fy = HEIGHT // 2 - py - 1
             r = max(min(int(color.r), 255), 0)
             g = max(min(int(color.g), 255), 0)
             b = max(min(int(color.b), 255), 0)
-            pixels[fx, fy] = (r, g, b)
-    return img
+            data += bytes((r, g, b))
+    return np.frombuffer(data, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
 
+def render_scene(workers=1, tile_size=32, order="hilbert", costs=None):
+    frame = render.tiles.render_parallel(render_tile, WIDTH, HEIGHT, workers, tile_size,
+                                         initializer=set_scene,
+                                         initargs=(scene_objects, scene_bvh, triangle_arrays),
+                                         order=order, costs=costs)
+    return Image.fromarray(frame, "RGB")
 
-def main():
-    global bunny_bbox_min, bunny_bbox_max
 
-    # Load the Stanford Bunny from an OBJ file.
+def build_scene():
+    """
+    Loads the bunny, builds the BVH over all objects and installs the scene.
+    """
+    del instances[:]
+    # Load the Stanford Bunny from an OBJ file. Its transform is applied to
+    # the rays (object space), not to the triangles.
     try:
-        bunny_triangles = load_obj("bunny.obj",
-                                   color=Color(255, 255, 255),  # White bunny.
-                                   specular=10,
-                                   reflective=0)
+        with render.stats.phase("load"):
+            vertices, faces = load_obj_arrays("bunny.obj")
+        bunny = TriangleMesh(vertices, faces, [Material(Color(255, 255, 255),  # White bunny.
+                                                        specular=10,
+                                                        reflective=0)])
         # Adjust bunny transformation so that it overlaps the cylinder.
         bunny_scale = 3.5
-        bunny_translation = Vec(-0.5, -1, 5)  
-        for tri in bunny_triangles:
-            tri.v0 = tri.v0.mul(bunny_scale).add(bunny_translation)
-            tri.v1 = tri.v1.mul(bunny_scale).add(bunny_translation)
-            tri.v2 = tri.v2.mul(bunny_scale).add(bunny_translation)
-            tri.edge1 = tri.v1.sub(tri.v0)
-            tri.edge2 = tri.v2.sub(tri.v0)
-            tri.normal = tri.edge1.cross(tri.edge2).normalize()
-        triangles.extend(bunny_triangles)
+        bunny_translation = (-0.5, -1, 5)
+        with render.stats.phase("build"):
+            bunny_bvh = build_bvh_sah(*bunny.bounds())
+        instances.append(Instance(bunny, bunny_bvh, affine(bunny_scale), bunny_translation))
     except Exception as e:
         print("Error loading bunny.obj:", e)
 
-    if triangles:
-        min_x = min_y = min_z = float('inf')
-        max_x = max_y = max_z = -float('inf')
-        for tri in triangles:
-            for v in [tri.v0, tri.v1, tri.v2]:
-                min_x = min(min_x, v.x)
-                min_y = min(min_y, v.y)
-                min_z = min(min_z, v.z)
-                max_x = max(max_x, v.x)
-                max_y = max(max_y, v.y)
-                max_z = max(max_z, v.z)
-        bunny_bbox_min = Vec(min_x, min_y, min_z)
-        bunny_bbox_max = Vec(max_x, max_y, max_z)
-
-    image = render_scene()
-    image.save("inclass_assessment.png")
+    mesh = triangle_mesh(triangles) if triangles else None
+    objects = spheres + triangles + cylinders + instances
+    with render.stats.phase("build"):
+        bvh = build_primitive_bvh(objects)
+    set_scene(objects, bvh, mesh)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Render the in-class assessment scene.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of render processes (0 uses every core)")
+    parser.add_argument("--tile-size", type=int, default=32, help="tile size in pixels")
+    parser.add_argument("--tile-order", choices=render.tiles.TILE_ORDERS, default="hilbert",
+                        help="order in which tiles are scheduled")
+    parser.add_argument("--tile-report", action="store_true",
+                        help="print per-tile and per-worker render times")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="count rays, traversal work and phase times and save them as JSON")
+    parser.add_argument("--heatmap", metavar="FILE",
+                        help="save an image of the render time of every tile (implies statistics)")
+    args = parser.parse_args()
+    if args.stats or args.heatmap:
+        render.stats.enable()
+
+    build_scene()
+
+    costs = [] if args.tile_report else None
+    image = render_scene(args.workers, args.tile_size, args.tile_order, costs)
+    if costs is not None:
+        print(render.tiles.cost_report(costs))
+    with render.stats.phase("encode"):
+        image.save("inclass_assessment.png")
     print("Render complete. Saved to inclass_assessment.png")
+    stats = render.stats.active
+    if stats is not None:
+        print(stats.summary())
+        if args.stats:
+            stats.save_json(args.stats)
+        if args.heatmap:
+            stats.save_heatmap(args.heatmap, WIDTH, HEIGHT)
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,31 @@
 class Color:
+    __slots__ = ('r', 'g', 'b')
+
     def __init__(self, r, g, b):
         self.r = r
         self.g = g
         self.b = b
-    
+
     def mul(self, num):
         return Color(self.r * num, self.g * num, self.b * num)
-    
+
     def add(self, other):
         return Color(self.r + other.r, self.g + other.g, self.b + other.b)
 
     def div(self, other):
-        return Color(self.r/other, self.g/other, self.b/other)
\ No newline at end of file
+        return Color(self.r/other, self.g/other, self.b/other)
+
+    def blend(self, other, t):
+        """
+        Returns self * (1 - t) + other * t (e.g. a local color mixed with a
+        reflected one) as a single new color instead of three.
+        """
+        s = 1 - t
+        return Color(self.r * s + other.r * t, self.g * s + other.g * t, self.b * s + other.b * t)
+
+    def iadd(self, other):
+        """Adds other to this color in place and returns it."""
+        self.r += other.r
+        self.g += other.g
+        self.b += other.b
+        return self
@@ -6,8 +6,8 @@ from color import Color
 canvas_width = 500
 canvas_height = 500
 
-image = Image.new("RGB", (canvas_width, canvas_height), (255, 255, 255))
-pixels = image.load()
+# Row-major RGB bytes of the canvas, starting white.
+canvas = bytearray(b'\xff' * (canvas_width * canvas_height * 3))
 
 
 def put_pixel(x, y, color):
@@ -15,7 +15,8 @@ def put_pixel(x, y, color):
     y = canvas_height // 2 - y - 1
     
     if 0 <= x < canvas_width and 0 <= y < canvas_height:
-        pixels[x, y] = (color.r, color.g, color.b)
+        offset = (y * canvas_width + x) * 3
+        canvas[offset:offset + 3] = (color.r, color.g, color.b)
 
 
 
@@ -39,11 +40,14 @@ def canvas_to_viewport(x, y):
     )
 
 def intersect_ray_sphere(origin, direction, sphere):
-    oc = origin.sub(sphere.center)
-    
+    # oc = origin - center
+    c = sphere.center
+    ocx = origin.x - c.x
+    ocy = origin.y - c.y
+    ocz = origin.z - c.z
     k1 = direction.dot(direction)
-    k2 = 2 * oc.dot(direction)
-    k3 = oc.dot(oc) - sphere.radius ** 2
+    k2 = 2 * (ocx * direction.x + ocy * direction.y + ocz * direction.z)
+    k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - sphere.radius ** 2
     
     discriminant = k2 ** 2 - 4 * k1 * k3
     if discriminant < 0:
@@ -78,5 +82,6 @@ for x in range(-canvas_width // 2, canvas_width // 2):
         color = trace_ray(camera_position, direction, 1, float('inf'))
         put_pixel(x, y, color)
 
+image = Image.frombytes("RGB", (canvas_width, canvas_height), bytes(canvas))
 image.save('assignment_1_output.png')
  
\ No newline at end of file
@@ -1,28 +1,60 @@
+from math import sqrt
+
+
 class Vec:
+    # No per-instance __dict__: smaller objects and faster attribute access.
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
         self.z = z
-    
+
     def dot(self, vec):
         return self.x * vec.x + self.y * vec.y + self.z * vec.z
-    
+
     def sub(self, vec):
         return Vec(self.x - vec.x, self.y - vec.y, self.z - vec.z)
-    
+
     def add(self, vec):
         return Vec(self.x + vec.x, self.y + vec.y, self.z + vec.z)
-    
+
     def mul(self, num):
         return Vec(self.x * num, self.y * num, self.z * num)
-    
+
     def div(self, num):
         return Vec(self.x / num, self.y / num, self.z / num)
-    
+
+    def neg(self):
+        return Vec(-self.x, -self.y, -self.z)
+
+    def madd(self, vec, num):
+        """
+        Returns self + vec * num (e.g. the point origin + t * direction) as a
+        single new vector instead of two.
+        """
+        return Vec(self.x + vec.x * num, self.y + vec.y * num, self.z + vec.z * num)
+
+    def iadd(self, vec):
+        """Adds vec to this vector in place and returns it."""
+        self.x += vec.x
+        self.y += vec.y
+        self.z += vec.z
+        return self
+
+    def imul(self, num):
+        """Scales this vector in place and returns it."""
+        self.x *= num
+        self.y *= num
+        self.z *= num
+        return self
+
+    def length_squared(self):
+        return self.x * self.x + self.y * self.y + self.z * self.z
+
     def length(self):
-        from math import sqrt
-        return sqrt(self.x**2 + self.y**2 + self.z**2)
-    
+        return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
     def cross(self, vec):
         """
         Computes the cross product of self with another vector.
@@ -35,7 +67,7 @@ class Vec:
         y = self.z * vec.x - self.x * vec.z
         z = self.x * vec.y - self.y * vec.x
         return Vec(x, y, z)
-    
+
     def normalize(self):
         """
         Returns a normalized (unit length) vector in the same direction.
@@ -45,3 +77,24 @@ class Vec:
         if l == 0:
             raise ValueError("Cannot normalize a zero-length vector")
         return self.div(l)
+
+    def direction_from(self, origin):
+        """
+        Returns the unit vector pointing from origin to self, i.e.
+        self.sub(origin).normalize() without the intermediate vector.
+        Raises a ValueError if the two points coincide.
+        """
+        x = self.x - origin.x
+        y = self.y - origin.y
+        z = self.z - origin.z
+        l = sqrt(x * x + y * y + z * z)
+        if l == 0:
+            raise ValueError("Cannot normalize a zero-length vector")
+        return Vec(x / l, y / l, z / l)
+
+    def reflect(self, normal):
+        """
+        Reflects this vector about normal: normal * (2 * normal.dot(self)) - self.
+        """
+        k = 2 * (normal.x * self.x + normal.y * self.y + normal.z * self.z)
+        return Vec(normal.x * k - self.x, normal.y * k - self.y, normal.z * k - self.z)
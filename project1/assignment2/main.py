@@ -48,11 +48,13 @@ def intersect_ray_sphere(origin, direction, sphere):
     ray (origin + t*direction) with a sphere.
     """
     # oc = origin - center
-    oc = origin.sub(sphere.center)
-
+    c = sphere.center
+    ocx = origin.x - c.x
+    ocy = origin.y - c.y
+    ocz = origin.z - c.z
     k1 = direction.dot(direction)  # direction^2
-    k2 = 2 * oc.dot(direction)
-    k3 = oc.dot(oc) - sphere.radius**2
+    k2 = 2 * (ocx * direction.x + ocy * direction.y + ocz * direction.z)
+    k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - sphere.radius**2
 
     discriminant = k2*k2 - 4*k1*k3
     if discriminant < 0:
@@ -93,7 +95,7 @@ def compute_lighting(point, normal, view, specular):
             # Specular component
             if specular != -1:
                 # R = 2*(N dot L)*N - L
-                R = normal.mul(2 * n_dot_l).sub(L)
+                R = L.reflect(normal)
                 r_dot_v = R.dot(view)
                 if r_dot_v > 0:
                     intensity += light.intensity * (r_dot_v / (R.length() * v_len))**specular
@@ -126,11 +128,11 @@ def trace_ray(origin, direction, t_min, t_max):
         return background_color
 
     # Compute intersection point and normal
-    point = origin.add(direction.mul(closest_t))
+    point = origin.madd(direction, closest_t)
     normal = point.sub(closest_sphere.center)
     normal = normal.div(normal.length())  # normalize
 
-    view = direction.mul(-1)
+    view = direction.neg()
     lighting = compute_lighting(point, normal, view, closest_sphere.specular)
 
     shaded_color = closest_sphere.color.mul(lighting)
@@ -138,8 +140,8 @@ def trace_ray(origin, direction, t_min, t_max):
 
 
 def render_scene():
-    img = Image.new("RGB", (WIDTH, HEIGHT))
-    pixels = img.load()
+    # Row-major RGB bytes, turned into an image in one step at the end.
+    data = bytearray(WIDTH * HEIGHT * 3)
 
     for px in range(-WIDTH//2, WIDTH//2):
         for py in range(-HEIGHT//2, HEIGHT//2):
@@ -155,9 +157,10 @@ def render_scene():
             g = max(min(int(color.g), 255), 0)
             b = max(min(int(color.b), 255), 0)
 
-            pixels[fx, fy] = (r, g, b)
+            offset = (fy * WIDTH + fx) * 3
+            data[offset:offset + 3] = (r, g, b)
 
-    return img
+    return Image.frombytes("RGB", (WIDTH, HEIGHT), bytes(data))
 
 if __name__ == "__main__":
     image = render_scene()
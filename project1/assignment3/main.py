@@ -58,10 +58,14 @@ def intersect_ray_sphere(origin, direction, sphere):
     Computes the intersections (t values) of a ray with a sphere.
     Returns a tuple (t1, t2); if there is no intersection, returns (inf, inf).
     """
-    oc = origin.sub(sphere.center)
+    # oc = origin - center
+    c = sphere.center
+    ocx = origin.x - c.x
+    ocy = origin.y - c.y
+    ocz = origin.z - c.z
     k1 = direction.dot(direction)
-    k2 = 2 * oc.dot(direction)
-    k3 = oc.dot(oc) - sphere.radius**2
+    k2 = 2 * (ocx * direction.x + ocy * direction.y + ocz * direction.z)
+    k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - sphere.radius**2
 
     discriminant = k2 * k2 - 4 * k1 * k3
     if discriminant < 0:
@@ -76,7 +80,7 @@ def closest_intersection(origin, direction, t_min, t_max):
     """
     Finds the closest sphere intersected by the ray (if any) within (t_min, t_max).
     Returns a tuple (sphere, t) if an intersection is found, or None otherwise.
-    This function is used both for finding the primary intersection and for shadow checking.
+    Shadow checks use occluded() instead.
     """
     closest_t = float('inf')
     closest_sphere = None
@@ -94,6 +98,17 @@ def closest_intersection(origin, direction, t_min, t_max):
         return None
     return (closest_sphere, closest_t)
 
+def occluded(origin, direction, t_min, t_max):
+    """
+    Shadow-ray query: returns True as soon as any sphere is hit within
+    (t_min, t_max). Unlike closest_intersection it stops at the first hit.
+    """
+    for sphere in spheres:
+        t1, t2 = intersect_ray_sphere(origin, direction, sphere)
+        if t_min < t1 < t_max or t_min < t2 < t_max:
+            return True
+    return False
+
 def compute_lighting(point, normal, view, specular):
     """
     Computes the lighting at a given point on a surface with the given normal.
@@ -117,7 +132,7 @@ def compute_lighting(point, normal, view, specular):
 
             # Shadow check: if there is any object between the point and the light,
             # skip this light's contribution.
-            if closest_intersection(point, L, EPSILON, t_max) is not None:
+            if occluded(point, L, EPSILON, t_max):
                 continue
 
             # Diffuse reflection.
@@ -128,7 +143,7 @@ def compute_lighting(point, normal, view, specular):
             # Specular reflection.
             if specular != -1:
                 # Reflect L around normal: R = 2*(N dot L)*N - L.
-                R = normal.mul(2 * n_dot_l).sub(L)
+                R = L.reflect(normal)
                 r_dot_v = R.dot(view)
                 if r_dot_v > 0:
                     intensity += light.intensity * (r_dot_v / (R.length() * view.length())) ** specular
@@ -141,7 +156,7 @@ def reflect_ray(incident, normal):
     (Incident and normal are assumed to be Vec objects.)
     """
     # Reflection formula: R = 2*(incident dot normal)*normal - incident.
-    return normal.mul(2 * incident.dot(normal)).sub(incident)
+    return incident.reflect(normal)
 
 def trace_ray(origin, direction, t_min, t_max, depth):
     """
@@ -157,9 +172,9 @@ def trace_ray(origin, direction, t_min, t_max, depth):
     closest_sphere, closest_t = intersection
 
     # Compute the intersection point and the surface normal.
-    point = origin.add(direction.mul(closest_t))
-    normal = point.sub(closest_sphere.center).div(point.sub(closest_sphere.center).length())
-    view = direction.mul(-1)
+    point = origin.madd(direction, closest_t)
+    normal = point.direction_from(closest_sphere.center)
+    view = direction.neg()
 
     # Compute lighting (diffuse and specular).
     lighting = compute_lighting(point, normal, view, closest_sphere.specular)
@@ -174,14 +189,14 @@ def trace_ray(origin, direction, t_min, t_max, depth):
     reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1)
 
     # Combine the local color with the reflected color.
-    return local_color.mul(1 - closest_sphere.reflective).add(reflected_color.mul(closest_sphere.reflective))
+    return local_color.blend(reflected_color, closest_sphere.reflective)
 
 def render_scene():
     """
     Renders the scene pixel-by-pixel and returns a PIL Image.
     """
-    img = Image.new("RGB", (WIDTH, HEIGHT))
-    pixels = img.load()
+    # Row-major RGB bytes, turned into an image in one step at the end.
+    data = bytearray(WIDTH * HEIGHT * 3)
 
     for px in range(-WIDTH // 2, WIDTH // 2):
         for py in range(-HEIGHT // 2, HEIGHT // 2):
@@ -195,9 +210,10 @@ def render_scene():
             r = max(min(int(color.r), 255), 0)
             g = max(min(int(color.g), 255), 0)
             b = max(min(int(color.b), 255), 0)
-            pixels[fx, fy] = (r, g, b)
+            offset = (fy * WIDTH + fx) * 3
+            data[offset:offset + 3] = (r, g, b)
 
-    return img
+    return Image.frombytes("RGB", (WIDTH, HEIGHT), bytes(data))
 
 
 if __name__ == "__main__":
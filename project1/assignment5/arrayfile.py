@@ -0,0 +1,114 @@
+"""
+Named numpy arrays stored in one binary file that can be memory-mapped back.
+
+Layout: an 8-byte magic string, the header length as an 8-byte little-endian
+integer, a JSON header (format version, caller metadata, a BLAKE2 checksum of
+the data and the name, dtype, shape and offset of every array) and then the
+raw array data, every array aligned to 64 bytes so it can be mapped in place.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+MAGIC = b'ICSARR\x00\x01'
+VERSION = 2
+ALIGN = 64
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def checksum(arrays):
+    """BLAKE2b digest (hex) of the bytes of a sequence of contiguous arrays."""
+    digest = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        digest.update(memoryview(np.ascontiguousarray(a)).cast('B'))
+    return digest.hexdigest()
+
+
+def save_arrays(path, arrays, meta=None):
+    """
+    Writes a dict of arrays plus JSON-serializable metadata to path.
+    The file is written under a temporary name first and renamed into place,
+    so readers never see a half-written file.
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    specs = []
+    offset = 0
+    for name, a in arrays.items():
+        specs.append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape),
+                      'offset': offset})
+        offset = _aligned(offset + a.nbytes)
+    header = json.dumps({'version': VERSION, 'meta': meta or {},
+                         'checksum': checksum(arrays.values()), 'arrays': specs}).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for spec, a in zip(specs, arrays.values()):
+                f.seek(data_start + spec['offset'])
+                f.write(a.data)
+            f.truncate(data_start + offset)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_header(path):
+    """
+    Returns (header, data_start) of an array file, or None if the file is
+    missing or not an array file of the current version.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size))
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != VERSION:
+        return None
+    return header, _aligned(len(MAGIC) + 8 + size)
+
+
+def load_arrays(path, mmap=True, verify=True):
+    """
+    Loads an array file written by save_arrays and returns (meta, arrays),
+    or None if it is missing, unreadable or (with verify) fails its checksum.
+    With mmap the arrays are read-only views of the file, so without verify
+    only the pages that are touched are read.
+    """
+    found = read_header(path)
+    if found is None:
+        return None
+    header, data_start = found
+    file_size = os.path.getsize(path)
+    arrays = {}
+    for spec in header['arrays']:
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape))
+        start = data_start + spec['offset']
+        if start + count * dtype.itemsize > file_size:
+            return None
+        if count == 0:
+            arrays[spec['name']] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[spec['name']] = np.memmap(path, dtype=dtype, mode='r',
+                                             offset=start, shape=shape)
+        else:
+            arrays[spec['name']] = np.fromfile(path, dtype=dtype, count=count,
+                                               offset=start).reshape(shape)
+    if verify and checksum(arrays.values()) != header.get('checksum'):
+        return None
+    return header['meta'], arrays
@@ -1,3 +1,16 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import render.stats
+
+INF = float('inf')
+
+# Direction components smaller than this are treated as parallel to a slab.
+PARALLEL_EPSILON = 0.001
+
+
 class BVHNode:
     def __init__(self, bbox_min, bbox_max, triangles=None, left=None, right=None):
         self.bbox_min = bbox_min
@@ -5,4 +18,729 @@ class BVHNode:
         self.triangles = triangles  # Only for leaf nodes.
         self.left = left
         self.right = right
-        self.is_leaf = (triangles is not None)
\ No newline at end of file
+        self.is_leaf = (triangles is not None)
+
+
+class FlatBVH:
+    def __init__(self, bounds, offsets, counts, axes, prim_indices):
+        """
+        A BVH packed into contiguous typed arrays. Nodes are stored in
+        depth-first order, so the left child of an interior node always
+        directly follows it and only the right child needs an index.
+
+        bounds: (n_nodes, 6) float64 - min x, y, z then max x, y, z
+        offsets: (n_nodes,) int32 - leaf: first entry in prim_indices,
+                 interior: index of the right child
+        counts: (n_nodes,) int32 - leaf: number of primitives, interior: 0
+        axes: (n_nodes,) uint8 - split axis of interior nodes (0=x, 1=y, 2=z)
+        prim_indices: (n_prims,) int32 - primitive numbers in leaf order
+        """
+        self.bounds = np.ascontiguousarray(bounds, dtype=np.float64).reshape(-1, 6)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int32)
+        self.counts = np.ascontiguousarray(counts, dtype=np.int32)
+        self.axes = np.ascontiguousarray(axes, dtype=np.uint8)
+        self.prim_indices = np.ascontiguousarray(prim_indices, dtype=np.int32)
+        self._make_views()
+
+    def _make_views(self):
+        # Flat memoryviews index almost as fast as lists and hand back plain
+        # Python numbers, which keeps the traversal loop cheap.
+        self.bounds_view = memoryview(self.bounds.reshape(-1))
+        self.offsets_view = memoryview(self.offsets)
+        self.counts_view = memoryview(self.counts)
+        self.prims_view = memoryview(self.prim_indices)
+
+    def __getstate__(self):
+        return {'bounds': self.bounds, 'offsets': self.offsets, 'counts': self.counts,
+                'axes': self.axes, 'prim_indices': self.prim_indices}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def nbytes(self):
+        """Total size of the node and primitive arrays in bytes."""
+        return (self.bounds.nbytes + self.offsets.nbytes + self.counts.nbytes
+                + self.axes.nbytes + self.prim_indices.nbytes)
+
+    def root_bounds(self):
+        """Box of the whole tree as a (2, 3) array of min and max corners."""
+        return self.bounds[0].reshape(2, 3)
+
+
+def flatten_bvh(root, primitives):
+    """
+    Packs a BVHNode tree into a FlatBVH. Leaf primitives are stored as their
+    positions in the `primitives` list.
+    """
+    index_of = {id(prim): i for i, prim in enumerate(primitives)}
+    bounds, offsets, counts, axes, prim_indices = [], [], [], [], []
+
+    stack = [(root, None)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(counts)
+        if parent is not None:
+            offsets[parent] = index
+        bounds.append((node.bbox_min.x, node.bbox_min.y, node.bbox_min.z,
+                       node.bbox_max.x, node.bbox_max.y, node.bbox_max.z))
+        if node.is_leaf:
+            offsets.append(len(prim_indices))
+            counts.append(len(node.triangles))
+            axes.append(0)
+            prim_indices.extend(index_of[id(prim)] for prim in node.triangles)
+        else:
+            offsets.append(0)  # Patched once the right child is emitted.
+            counts.append(0)
+            extent = [node.bbox_max.x - node.bbox_min.x,
+                      node.bbox_max.y - node.bbox_min.y,
+                      node.bbox_max.z - node.bbox_min.z]
+            axes.append(extent.index(max(extent)))
+            # The right child is popped after the whole left subtree.
+            stack.append((node.right, index))
+            stack.append((node.left, None))
+
+    return FlatBVH(np.array(bounds, dtype=np.float64), offsets, counts, axes, prim_indices)
+
+
+def surface_area(lo, hi):
+    """Surface area of the boxes lo..hi (arrays whose last axis is x, y, z)."""
+    d = hi - lo
+    return 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+def _segment_ids(lengths):
+    """For segments of the given lengths, the segment number of every element."""
+    return np.repeat(np.arange(len(lengths)), lengths)
+
+
+def build_bvh_sah(bounds_min, bounds_max, centroids=None, max_leaf_size=4, bins=16,
+                  traversal_cost=1.0, intersection_cost=1.0, stop_size=0):
+    """
+    Builds a FlatBVH with the Surface Area Heuristic, evaluated over `bins`
+    centroid bins per axis instead of every possible split position.
+
+    bounds_min, bounds_max: (N, 3) per-primitive bounding boxes.
+    centroids: (N, 3) per-primitive split points; defaults to the box centers.
+    max_leaf_size: nodes with more primitives than this are always split.
+    traversal_cost, intersection_cost: relative cost of visiting a node and
+        of testing one primitive. A node becomes a leaf as soon as testing
+        all of its primitives is cheaper than the best split.
+    stop_size: nodes with at most this many primitives are not split at
+        all, whatever their size; build_bvh_parallel builds them later.
+
+    The tree is built one level at a time: every node of a level is a
+    contiguous range of a shared primitive permutation, so binning, the SAH
+    sweep and partitioning run as a handful of array operations per level
+    instead of per node.
+    """
+    bounds_min = np.ascontiguousarray(bounds_min, dtype=np.float64).reshape(-1, 3)
+    bounds_max = np.ascontiguousarray(bounds_max, dtype=np.float64).reshape(-1, 3)
+    n_prims = len(bounds_min)
+    if n_prims == 0:
+        raise ValueError("Cannot build a BVH without primitives")
+    if centroids is None:
+        centroids = (bounds_min + bounds_max) * 0.5
+    centroids = np.ascontiguousarray(centroids, dtype=np.float64).reshape(-1, 3)
+
+    perm = np.arange(n_prims)
+    # Nodes in creation (breadth-first) order.
+    node_bounds, node_start, node_count, node_axis, node_left, node_right = [], [], [], [], [], []
+    levels = []  # (first node, interior node ids, their left ids, their right ids)
+
+    seg_start = np.array([0])
+    seg_end = np.array([n_prims])
+    first_node = 0
+    while len(seg_start):
+        n_segs = len(seg_start)
+        lengths = seg_end - seg_start
+        offs = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        seg_of = _segment_ids(lengths)
+        local = np.arange(len(seg_of)) - offs[seg_of]
+        prims = perm[seg_start[seg_of] + local]
+
+        lo = np.minimum.reduceat(bounds_min[prims], offs)
+        hi = np.maximum.reduceat(bounds_max[prims], offs)
+        cent = centroids[prims]
+        cmin = np.minimum.reduceat(cent, offs)
+        extent = np.maximum.reduceat(cent, offs) - cmin
+
+        # Only nodes with two or more primitives can split. Deep levels are
+        # dominated by tiny nodes, so they also get fewer bins.
+        node_area = surface_area(lo, hi)
+        candidate = lengths > 1
+        n_cand = int(candidate.sum())
+        best_cost = np.full(n_segs, INF)
+        best_axis = np.zeros(n_segs, dtype=np.intp)
+        best_bin = np.zeros(n_segs, dtype=np.intp)
+        b = np.zeros((len(seg_of), 3), dtype=np.intp)
+        if n_cand:
+            level_bins = int(min(bins, lengths.max()))
+            in_cand = candidate[seg_of]
+            cand_of = (np.cumsum(candidate) - 1)[seg_of[in_cand]]
+            c_prims = prims[in_cand]
+            c_cmin = cmin[candidate]
+            c_extent = extent[candidate]
+
+            # Bin every centroid along all three axes at once.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = np.where(c_extent > 0, level_bins / c_extent, 0.0)
+            cb = ((cent[in_cand] - c_cmin[cand_of]) * scale[cand_of]).astype(np.intp)
+            np.minimum(cb, level_bins - 1, out=cb)
+            b[in_cand] = cb
+            key = ((cand_of[:, None] * 3 + np.arange(3)) * level_bins + cb).ravel()
+            size = n_cand * 3 * level_bins
+            count = np.bincount(key, minlength=size).reshape(n_cand, 3, level_bins)
+            bin_lo = np.full((3, size), INF)
+            bin_hi = np.full((3, size), -INF)
+            box_lo = np.repeat(bounds_min[c_prims], 3, axis=0)
+            box_hi = np.repeat(bounds_max[c_prims], 3, axis=0)
+            for c in range(3):
+                # One-dimensional ufunc.at takes NumPy's fast path.
+                np.minimum.at(bin_lo[c], key, box_lo[:, c])
+                np.maximum.at(bin_hi[c], key, box_hi[:, c])
+            bin_lo = bin_lo.T.reshape(n_cand, 3, level_bins, 3)
+            bin_hi = bin_hi.T.reshape(n_cand, 3, level_bins, 3)
+
+            # Split k puts bins 0..k on the left and k+1.. on the right.
+            # Costs are scaled by the node's surface area so that flat or
+            # point nodes need no division.
+            left_n = np.cumsum(count, axis=2)[:, :, :-1]
+            right_n = lengths[candidate][:, None, None] - left_n
+            with np.errstate(invalid='ignore'):
+                left_area = surface_area(np.minimum.accumulate(bin_lo, axis=2)[:, :, :-1],
+                                         np.maximum.accumulate(bin_hi, axis=2)[:, :, :-1])
+                right_area = surface_area(
+                    np.minimum.accumulate(bin_lo[:, :, ::-1], axis=2)[:, :, -2::-1],
+                    np.maximum.accumulate(bin_hi[:, :, ::-1], axis=2)[:, :, -2::-1])
+                cost = (traversal_cost * node_area[candidate][:, None, None]
+                        + intersection_cost * (left_area * left_n + right_area * right_n))
+            cost[(left_n == 0) | (right_n == 0)] = INF
+            cost = cost.reshape(n_cand, -1)
+            best = np.argmin(cost, axis=1)
+            best_cost[candidate] = cost[np.arange(n_cand), best]
+            best_axis[candidate] = best // (level_bins - 1)
+            best_bin[candidate] = best % (level_bins - 1)
+
+        leaf_cost = intersection_cost * lengths * node_area
+        has_plane = best_cost < INF
+        split = candidate & has_plane & ((lengths > max_leaf_size) | (best_cost < leaf_cost))
+        # When every centroid coincides no plane separates them; oversized
+        # nodes are then cut in half by position.
+        halve = (lengths > max_leaf_size) & ~has_plane
+        split |= halve
+        if stop_size:
+            split &= lengths > stop_size
+            halve &= split
+
+        n_split = int(split.sum())
+        ids = first_node + np.arange(n_segs)
+        next_node = first_node + n_segs
+        left_ids = np.full(n_segs, -1)
+        right_ids = np.full(n_segs, -1)
+        left_ids[split] = next_node + 2 * np.arange(n_split)
+        right_ids[split] = left_ids[split] + 1
+
+        node_bounds.append(np.concatenate((lo, hi), axis=1))
+        node_start.append(seg_start)
+        node_count.append(lengths)
+        node_axis.append(np.where(split & ~halve, best_axis, 0))
+        node_left.append(left_ids)
+        node_right.append(right_ids)
+        levels.append((ids[split], left_ids[split], right_ids[split]))
+
+        if not n_split:
+            break
+
+        # Stable partition of every split node's primitive range.
+        go_left = b[np.arange(len(b)), best_axis[seg_of]] <= best_bin[seg_of]
+        go_left = np.where(halve[seg_of], local < (lengths // 2)[seg_of], go_left)
+        moving = split[seg_of]
+        go_left &= moving
+        before = np.cumsum(go_left) - go_left
+        rank_left = before - before[offs][seg_of]
+        n_left = np.add.reduceat(go_left, offs)
+        new_local = np.where(go_left, rank_left, n_left[seg_of] + (local - rank_left))
+        perm[(seg_start[seg_of] + new_local)[moving]] = prims[moving]
+
+        mid = seg_start[split] + n_left[split]
+        seg_start, seg_end = (np.stack((seg_start[split], mid), axis=1).ravel(),
+                              np.stack((mid, seg_end[split]), axis=1).ravel())
+        first_node = next_node
+
+    node_bounds = np.concatenate(node_bounds)
+    node_start = np.concatenate(node_start)
+    node_count = np.concatenate(node_count)
+    node_axis = np.concatenate(node_axis)
+    node_left = np.concatenate(node_left)
+    node_right = np.concatenate(node_right)
+
+    # Re-number the nodes depth-first: subtree sizes bottom-up, then every
+    # left child follows its parent and every right child follows the
+    # parent's whole left subtree.
+    size = np.ones(len(node_count), dtype=np.int64)
+    for parents, lefts, rights in reversed(levels):
+        size[parents] = 1 + size[lefts] + size[rights]
+    order = np.zeros(len(node_count), dtype=np.int64)
+    for parents, lefts, rights in levels:
+        order[lefts] = order[parents] + 1
+        order[rights] = order[parents] + 1 + size[lefts]
+
+    interior = node_left >= 0
+    bounds = np.empty_like(node_bounds)
+    bounds[order] = node_bounds
+    offsets = np.empty(len(order), dtype=np.int64)
+    offsets[order] = np.where(interior, order[node_right], node_start)
+    counts = np.empty(len(order), dtype=np.int64)
+    counts[order] = np.where(interior, 0, node_count)
+    axes = np.empty(len(order), dtype=np.int64)
+    axes[order] = node_axis
+    # Leaves partition the permutation in depth-first order already.
+    return FlatBVH(bounds, offsets, counts, axes, perm)
+
+
+def _build_task(task):
+    bounds_min, bounds_max, centroids, options = task
+    return build_bvh_sah(bounds_min, bounds_max, centroids, **options)
+
+
+def build_bvh_parallel(bounds_min, bounds_max, centroids=None, workers=0, task_size=None,
+                       **options):
+    """
+    Builds a SAH FlatBVH on several processes. The top of the tree is built
+    by build_bvh_sah, which stops splitting at nodes of at most task_size
+    primitives (default: a 64th of them, at least 4096). Those nodes become
+    independent tasks that a pool of `workers` processes (0 uses every core)
+    builds, largest first, and their trees are stitched into the top one.
+
+    options are those of build_bvh_sah. The tree depends only on the input,
+    the options and task_size: any number of workers, finishing in any
+    order, produces the same tree. It is usually not identical to the tree
+    of build_bvh_sah, whose deep levels see all nodes at once, but of the
+    same quality.
+    """
+    bounds_min = np.ascontiguousarray(bounds_min, dtype=np.float64).reshape(-1, 3)
+    bounds_max = np.ascontiguousarray(bounds_max, dtype=np.float64).reshape(-1, 3)
+    if centroids is None:
+        centroids = (bounds_min + bounds_max) * 0.5
+    centroids = np.ascontiguousarray(centroids, dtype=np.float64).reshape(-1, 3)
+    if task_size is None:
+        task_size = max(4096, len(bounds_min) // 64)
+    top = build_bvh_sah(bounds_min, bounds_max, centroids, stop_size=task_size, **options)
+
+    # Every leaf the top build could not finish is a task.
+    roots = np.flatnonzero(top.counts > options.get('max_leaf_size', 4))
+    if not len(roots):
+        return top
+    tasks = []
+    for root in roots.tolist():
+        prims = top.prim_indices[top.offsets[root]:top.offsets[root] + top.counts[root]]
+        tasks.append((bounds_min[prims], bounds_max[prims], centroids[prims], options))
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(max(1, workers), len(tasks))
+    if workers == 1:
+        subtrees = [_build_task(task) for task in tasks]
+    else:
+        subtrees = [None] * len(tasks)
+        largest_first = sorted(range(len(tasks)), key=lambda k: -len(tasks[k][0]))
+        with multiprocessing.Pool(workers) as pool:
+            built = pool.imap(_build_task, [tasks[k] for k in largest_first])
+            for k, sub in zip(largest_first, built):
+                subtrees[k] = sub
+    size, first, _ = _subtree_ranges(top, _interior_levels(top))
+    return _splice(top, roots, subtrees, size, first)
+
+
+def _interior_levels(bvh):
+    """Interior nodes of bvh grouped by depth, root level first."""
+    counts = bvh.counts
+    offsets = bvh.offsets
+    levels = []
+    frontier = np.array([0])
+    while len(frontier):
+        interior = frontier[counts[frontier] == 0]
+        if not len(interior):
+            break
+        levels.append(interior)
+        frontier = np.concatenate((interior + 1, offsets[interior]))
+    return levels
+
+
+def refit_bvh(bvh, bounds_min, bounds_max):
+    """
+    Recomputes the node boxes of bvh in place from new per-primitive boxes
+    (e.g. after the mesh vertices moved), keeping its topology: the leaves
+    first, then every level of interior nodes from the deepest up. This is
+    one linear pass instead of a rebuild, but the tree gets slower to
+    traverse as primitives drift away from where they were split; see
+    AnimatedBVH.
+    """
+    bounds_min = np.asarray(bounds_min, dtype=np.float64).reshape(-1, 3)
+    bounds_max = np.asarray(bounds_max, dtype=np.float64).reshape(-1, 3)
+    if not bvh.bounds.flags.writeable:
+        # Memory-mapped from a scene cache.
+        bvh.bounds = bvh.bounds.copy()
+        bvh._make_views()
+    bounds = bvh.bounds
+    prims = bvh.prim_indices
+    # Leaves cover consecutive runs of prim_indices in node order.
+    leaves = np.flatnonzero(bvh.counts)
+    starts = bvh.offsets[leaves]
+    bounds[leaves, :3] = np.minimum.reduceat(bounds_min[prims], starts)
+    bounds[leaves, 3:] = np.maximum.reduceat(bounds_max[prims], starts)
+    for nodes in reversed(_interior_levels(bvh)):
+        right = bvh.offsets[nodes]
+        bounds[nodes, :3] = np.minimum(bounds[nodes + 1, :3], bounds[right, :3])
+        bounds[nodes, 3:] = np.maximum(bounds[nodes + 1, 3:], bounds[right, 3:])
+
+
+def sah_costs(bvh, traversal_cost=1.0, intersection_cost=1.0):
+    """
+    SAH cost of the subtree below every node divided by the surface area of
+    the node's box: the expected traversal work of a ray that enters the
+    node. Lower is better; element 0 rates the whole tree. Costs are as for
+    build_bvh_sah.
+    """
+    bounds = bvh.bounds
+    area = surface_area(bounds[:, :3], bounds[:, 3:])
+    cost = intersection_cost * bvh.counts * area
+    for nodes in reversed(_interior_levels(bvh)):
+        cost[nodes] = (traversal_cost * area[nodes] + cost[nodes + 1]
+                       + cost[bvh.offsets[nodes]])
+    return np.divide(cost, area, out=np.zeros_like(cost), where=area > 0)
+
+
+class AnimatedBVH:
+    def __init__(self, bvh, threshold=1.5, **options):
+        """
+        Keeps a FlatBVH usable while its primitives move. update() refits the
+        tree and watches its quality: the cost of every subtree (see
+        sah_costs) is compared with its cost when it was built, and subtrees
+        that became more than `threshold` times as expensive are rebuilt
+        with build_bvh_sah (options are passed on). If that includes the
+        root, the whole tree is rebuilt.
+        """
+        self.bvh = bvh
+        self.threshold = threshold
+        self.options = options
+        self._costs = {name: options[name] for name in ('traversal_cost', 'intersection_cost')
+                       if name in options}
+        self.reference = sah_costs(bvh, **self._costs)
+        # Subtrees rebuilt so far; full_rebuilds counts whole-tree rebuilds.
+        self.rebuilds = 0
+        self.full_rebuilds = 0
+
+    def update(self, bounds_min, bounds_max, centroids=None):
+        """
+        Brings the BVH up to date with new per-primitive boxes (and split
+        points, by default the box centers) and returns it. The FlatBVH is
+        changed in place, so everything holding it sees the new tree.
+        """
+        bvh = self.bvh
+        bounds_min = np.asarray(bounds_min, dtype=np.float64).reshape(-1, 3)
+        bounds_max = np.asarray(bounds_max, dtype=np.float64).reshape(-1, 3)
+        refit_bvh(bvh, bounds_min, bounds_max)
+        degraded = sah_costs(bvh, **self._costs) > self.threshold * self.reference
+        # A leaf's cost only depends on its primitive count.
+        degraded &= bvh.counts == 0
+        if degraded.any():
+            if centroids is None:
+                centroids = (bounds_min + bounds_max) * 0.5
+            centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 3)
+            self._rebuild(degraded, bounds_min, bounds_max, centroids)
+        return bvh
+
+    def _rebuild(self, degraded, bounds_min, bounds_max, centroids):
+        """
+        Rebuilds the degraded subtrees that have no degraded ancestor and
+        splices them in, or the whole tree if they hold most primitives.
+        """
+        bvh = self.bvh
+        levels = _interior_levels(bvh)
+        size, first, count = _subtree_ranges(bvh, levels)
+        covered = np.zeros(len(bvh), dtype=bool)
+        for nodes in levels:
+            below = covered[nodes] | degraded[nodes]
+            covered[nodes + 1] = below
+            covered[bvh.offsets[nodes]] = below
+        roots = np.flatnonzero(degraded & ~covered)
+        if 2 * count[roots].sum() > len(bvh.prim_indices):
+            rebuilt = build_bvh_sah(bounds_min, bounds_max, centroids, **self.options)
+            bvh.__setstate__(rebuilt.__getstate__())
+            self.reference = sah_costs(bvh, **self._costs)
+            self.rebuilds += 1
+            self.full_rebuilds += 1
+            return
+
+        subtrees = []
+        reference = []
+        start = 0
+        for root in roots.tolist():
+            prims = bvh.prim_indices[first[root]:first[root] + count[root]]
+            sub = build_bvh_sah(bounds_min[prims], bounds_max[prims], centroids[prims],
+                                **self.options)
+            subtrees.append(sub)
+            reference.extend((self.reference[start:root], sah_costs(sub, **self._costs)))
+            start = root + size[root]
+        reference.append(self.reference[start:])
+        bvh.__setstate__(_splice(bvh, roots, subtrees, size, first).__getstate__())
+        self.reference = np.concatenate(reference)
+        self.rebuilds += len(roots)
+
+
+def _subtree_ranges(bvh, levels):
+    """
+    Node count, first entry in prim_indices and primitive count of the
+    subtree below every node, given the _interior_levels of bvh.
+    """
+    size = np.ones(len(bvh), dtype=np.int64)
+    first = bvh.offsets.astype(np.int64)
+    count = bvh.counts.astype(np.int64)
+    for nodes in reversed(levels):
+        right = bvh.offsets[nodes]
+        size[nodes] = 1 + size[nodes + 1] + size[right]
+        first[nodes] = first[nodes + 1]
+        count[nodes] = count[nodes + 1] + count[right]
+    return size, first, count
+
+
+def _splice(bvh, roots, subtrees, size, first):
+    """
+    Returns a FlatBVH in which the subtree below each node of roots
+    (ascending, none inside another) is replaced by the matching FlatBVH of
+    subtrees, built over that subtree's primitives in their prim_indices
+    order. size and first are from _subtree_ranges.
+    """
+    n = len(bvh)
+    ends = roots + size[roots]
+    names = ('bounds', 'offsets', 'counts', 'axes')
+    pieces = {name: [] for name in names}
+    prim_indices = bvh.prim_indices.copy()
+    # Old nodes behind the k-th new subtree move by shift[k + 1].
+    shift = [0]
+    start = 0
+    for root, end, sub in zip(roots.tolist(), ends.tolist(), subtrees):
+        lo = first[root]
+        prims = bvh.prim_indices[lo:lo + len(sub.prim_indices)]
+        for name in names:
+            pieces[name].append(getattr(bvh, name)[start:root])
+        pieces['bounds'].append(sub.bounds)
+        # The subtree's primitives keep their run of prim_indices.
+        pieces['offsets'].append(np.where(sub.counts == 0, sub.offsets + root + shift[-1],
+                                          sub.offsets + lo))
+        pieces['counts'].append(sub.counts)
+        pieces['axes'].append(sub.axes)
+        prim_indices[lo:lo + len(prims)] = prims[sub.prim_indices]
+        shift.append(shift[-1] + len(sub) - (end - root))
+        start = end
+    for name in names:
+        pieces[name].append(getattr(bvh, name)[start:])
+    arrays = {name: np.concatenate(pieces[name]) for name in names}
+
+    # Right-child links of the kept interior nodes, moved past the new subtrees.
+    shift = np.array(shift)
+    kept = np.concatenate([np.arange(s, e) for s, e in zip(np.concatenate(([0], ends)),
+                                                           np.concatenate((roots, [n])))])
+    links = kept[bvh.counts[kept] == 0]
+    targets = bvh.offsets[links].astype(np.int64)
+    arrays['offsets'][links + shift[np.searchsorted(ends, links, side='right')]] = \
+        targets + shift[np.searchsorted(ends, targets, side='right')]
+    return FlatBVH(prim_indices=prim_indices, **arrays)
+
+
+def build_primitive_bvh(primitives, **options):
+    """
+    Builds a SAH FlatBVH over a list of arbitrary primitives, which may be of
+    different kinds. Every primitive must provide
+    bounds() -> ((min x, y, z), (max x, y, z)); the BVH refers to them by
+    their position in the list. options are passed on to build_bvh_sah.
+    """
+    bounds = np.array([p.bounds() for p in primitives], dtype=np.float64).reshape(-1, 2, 3)
+    return build_bvh_sah(bounds[:, 0], bounds[:, 1], **options)
+
+
+def leaf_dispatch(tests):
+    """
+    Turns a list of per-primitive (intersector, argument) pairs into one BVH
+    leaf callback: primitive i is tested with
+    intersector(argument, origin, direction, t_min, t_max), so each kind of
+    primitive keeps its own intersection routine.
+    """
+    def intersect(i, origin, direction, t_min, t_max):
+        test, arg = tests[i]
+        return test(arg, origin, direction, t_min, t_max)
+
+    return intersect
+
+
+def _box_entry(bvh, origin, direction, t_min, parallel_epsilon):
+    """
+    Returns a slab test enter(node, t_max) for this ray: the distance at which
+    the ray enters the node's box within (t_min, t_max), or inf on a miss.
+    Direction components below parallel_epsilon count as parallel to a slab.
+    """
+    bounds = bvh.bounds_view
+    ox, oy, oz = origin.x, origin.y, origin.z
+    dx, dy, dz = direction.x, direction.y, direction.z
+    flat_x = abs(dx) < parallel_epsilon
+    flat_y = abs(dy) < parallel_epsilon
+    flat_z = abs(dz) < parallel_epsilon
+    inv_x = 0.0 if flat_x else 1.0 / dx
+    inv_y = 0.0 if flat_y else 1.0 / dy
+    inv_z = 0.0 if flat_z else 1.0 / dz
+
+    def enter(node, hi):
+        i = 6 * node
+        lo = t_min
+        if flat_x:
+            if ox < bounds[i] or ox > bounds[i + 3]:
+                return INF
+        else:
+            t0 = (bounds[i] - ox) * inv_x
+            t1 = (bounds[i + 3] - ox) * inv_x
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > lo:
+                lo = t0
+            if t1 < hi:
+                hi = t1
+            if hi < lo:
+                return INF
+        if flat_y:
+            if oy < bounds[i + 1] or oy > bounds[i + 4]:
+                return INF
+        else:
+            t0 = (bounds[i + 1] - oy) * inv_y
+            t1 = (bounds[i + 4] - oy) * inv_y
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > lo:
+                lo = t0
+            if t1 < hi:
+                hi = t1
+            if hi < lo:
+                return INF
+        if flat_z:
+            if oz < bounds[i + 2] or oz > bounds[i + 5]:
+                return INF
+        else:
+            t0 = (bounds[i + 2] - oz) * inv_z
+            t1 = (bounds[i + 5] - oz) * inv_z
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > lo:
+                lo = t0
+            if t1 < hi:
+                hi = t1
+            if hi < lo:
+                return INF
+        return lo
+
+    stats = render.stats.active
+    if stats is not None:
+        return stats.count_nodes(enter)
+    return enter
+
+
+def bvh_closest(bvh, origin, direction, t_min, t_max, intersect,
+                parallel_epsilon=PARALLEL_EPSILON):
+    """
+    Iteratively traverses a FlatBVH and finds the closest primitive hit by the
+    ray within (t_min, t_max).
+
+    Both children of an interior node are slab-tested together; the nearer
+    one is visited first, every hit shrinks the search interval to the
+    closest distance found so far, and subtrees whose entry distance lies
+    beyond that are skipped without being opened.
+
+    intersect(prim, origin, direction, t_min, t_max) must return the distance
+    to primitive number `prim` within (t_min, t_max), or inf.
+    parallel_epsilon: see _box_entry; rays traced in a scaled space (such as
+    an instance's object space) pass a correspondingly scaled value.
+    Returns a tuple (prim, t) if an intersection is found; otherwise, None.
+    """
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter = _box_entry(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    closest_t = t_max
+    closest = -1
+    entry = enter(0, t_max)
+    if entry == INF:
+        return None
+    stack = [(0, entry)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, entry = pop()
+        if entry > closest_t:
+            continue
+        count = counts[node]
+        if count:
+            first = offsets[node]
+            for k in range(first, first + count):
+                prim = prims[k]
+                t = intersect(prim, origin, direction, t_min, closest_t)
+                if t < closest_t:
+                    closest_t = t
+                    closest = prim
+        else:
+            left = node + 1
+            right = offsets[node]
+            t_left = enter(left, closest_t)
+            t_right = enter(right, closest_t)
+            if t_left <= t_right:
+                if t_right != INF:
+                    push((right, t_right))
+                if t_left != INF:
+                    push((left, t_left))
+            else:
+                if t_left != INF:
+                    push((left, t_left))
+                push((right, t_right))
+
+    if closest < 0:
+        return None
+    return (closest, closest_t)
+
+
+def bvh_occluded(bvh, origin, direction, t_min, t_max, intersect,
+                 parallel_epsilon=PARALLEL_EPSILON):
+    """
+    Any-hit query for shadow rays: returns True as soon as any primitive is
+    hit within (t_min, t_max). Nothing is sorted or compared, because which
+    occluder is nearest does not matter.
+
+    intersect and parallel_epsilon are as for bvh_closest.
+    """
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter = _box_entry(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    stack = [0]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        if enter(node, t_max) == INF:
+            continue
+        count = counts[node]
+        if count:
+            first = offsets[node]
+            for k in range(first, first + count):
+                if intersect(prims[k], origin, direction, t_min, t_max) < t_max:
+                    return True
+        else:
+            push(offsets[node])
+            push(node + 1)
+    return False
@@ -0,0 +1,283 @@
+"""
+Compact BVH storage for meshes with millions of triangles.
+
+A FlatBVH stores six float64 numbers per node. A CompactBVH stores the root
+box as float32 and every other box as 8- or 16-bit integers on a grid that
+spans its parent's box: per axis, the box runs from grid line lo to grid
+line hi out of 2^bits - 1 steps. Boxes are rounded outward when they are
+quantized, against the parent box as it will be decoded, so a decoded box
+always contains the exact one and no hit is lost; rays only enter some
+boxes they would have missed. With 8 bits a node takes 15 bytes instead of
+57.
+
+The traversal decodes a child's box from its parent's while it descends,
+so compact_closest and compact_occluded carry the decoded boxes on their
+stack; otherwise they work like bvh_closest and bvh_occluded.
+"""
+import numpy as np
+
+import render.stats
+from assignment5.bvh import INF, PARALLEL_EPSILON, _interior_levels
+
+BOX_TYPES = {8: np.uint8, 16: np.uint16}
+
+
+class CompactBVH:
+    def __init__(self, root, boxes, offsets, counts, axes, prim_indices):
+        """
+        A FlatBVH with quantized node boxes (see compact_bvh). The nodes,
+        offsets, counts, axes and prim_indices are those of the FlatBVH.
+
+        root: (6,) float32 - box of the root node, min x, y, z then max x, y, z
+        boxes: (n_nodes, 6) uint8 or uint16 - grid lines of every node's box
+               within its parent's box, in the same order (unused for the root)
+        """
+        self.root = np.ascontiguousarray(root, dtype=np.float32).reshape(6)
+        self.boxes = np.ascontiguousarray(boxes).reshape(-1, 6)
+        if self.boxes.dtype not in (np.uint8, np.uint16):
+            raise ValueError("Quantized boxes must be uint8 or uint16")
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int32)
+        self.counts = np.ascontiguousarray(counts, dtype=np.int32)
+        self.axes = np.ascontiguousarray(axes, dtype=np.uint8)
+        self.prim_indices = np.ascontiguousarray(prim_indices, dtype=np.int32)
+        self._make_views()
+
+    def _make_views(self):
+        self.steps = int(np.iinfo(self.boxes.dtype).max)
+        self.root_box = tuple(self.root.tolist())
+        self.boxes_view = memoryview(self.boxes.reshape(-1))
+        self.offsets_view = memoryview(self.offsets)
+        self.counts_view = memoryview(self.counts)
+        self.prims_view = memoryview(self.prim_indices)
+
+    def __getstate__(self):
+        return {'root': self.root, 'boxes': self.boxes, 'offsets': self.offsets,
+                'counts': self.counts, 'axes': self.axes, 'prim_indices': self.prim_indices}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def nbytes(self):
+        """Total size of the node and primitive arrays in bytes."""
+        return (self.root.nbytes + self.boxes.nbytes + self.offsets.nbytes
+                + self.counts.nbytes + self.axes.nbytes + self.prim_indices.nbytes)
+
+    def root_bounds(self):
+        """Box of the whole tree as a (2, 3) array of min and max corners."""
+        return self.root.astype(np.float64).reshape(2, 3)
+
+
+def _decode(lo, hi, q_lo, q_hi, steps):
+    """
+    Boxes at grid lines q_lo..q_hi of the parent boxes lo..hi. The Python
+    traversal repeats these operations, so both get the same numbers.
+    """
+    step = (hi - lo) / steps
+    return lo + q_lo * step, np.where(q_hi == steps, hi, lo + q_hi * step)
+
+
+def compact_bvh(bvh, bits=8):
+    """
+    Quantizes the boxes of a FlatBVH to `bits` (8 or 16) bits per coordinate
+    and returns the CompactBVH. Every decoded box contains the original one.
+    """
+    if bits not in BOX_TYPES:
+        raise ValueError("Compact boxes have 8 or 16 bits")
+    steps = (1 << bits) - 1
+    bounds = bvh.bounds
+    # Root box rounded outward to float32.
+    lo = bounds[0, :3].astype(np.float32)
+    hi = bounds[0, 3:].astype(np.float32)
+    lo = np.where(lo > bounds[0, :3], np.nextafter(lo, np.float32(-INF)), lo)
+    hi = np.where(hi < bounds[0, 3:], np.nextafter(hi, np.float32(INF)), hi)
+
+    boxes = np.zeros((len(bvh), 6), dtype=np.int64)
+    boxes[0, 3:] = steps
+    decoded = np.empty_like(bounds)
+    decoded[0] = np.concatenate((lo, hi))
+    for nodes in _interior_levels(bvh):
+        children = np.concatenate((nodes + 1, bvh.offsets[nodes]))
+        parent = decoded[np.concatenate((nodes, nodes))]
+        p_lo, p_hi = parent[:, :3], parent[:, 3:]
+        box_lo, box_hi = bounds[children, :3], bounds[children, 3:]
+        extent = p_hi - p_lo
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q_lo = np.where(extent > 0, np.floor((box_lo - p_lo) / extent * steps), 0)
+            q_hi = np.where(extent > 0, np.ceil((box_hi - p_lo) / extent * steps), steps)
+        q_lo = np.clip(q_lo, 0, steps).astype(np.int64)
+        q_hi = np.clip(q_hi, 0, steps).astype(np.int64)
+        # Step outward wherever rounding in the decoding would cut the box.
+        while True:
+            d_lo, d_hi = _decode(p_lo, p_hi, q_lo, q_hi, steps)
+            low = d_lo > box_lo
+            high = d_hi < box_hi
+            if not (low.any() or high.any()):
+                break
+            q_lo -= low
+            q_hi += high
+        boxes[children, :3] = q_lo
+        boxes[children, 3:] = q_hi
+        decoded[children] = np.concatenate((d_lo, d_hi), axis=1)
+    return CompactBVH(decoded[0], boxes.astype(BOX_TYPES[bits]), bvh.offsets, bvh.counts,
+                      bvh.axes, bvh.prim_indices)
+
+
+def _child_entry(bvh, origin, direction, t_min, parallel_epsilon):
+    """
+    Returns enter(node, parent, t_max) for this ray: the box of node decoded
+    from its parent's box (a 6-tuple) and the distance at which the ray
+    enters it within (t_min, t_max), or inf on a miss. Direction components
+    below parallel_epsilon count as parallel to a slab.
+    """
+    boxes = bvh.boxes_view
+    steps = bvh.steps
+    ox, oy, oz = origin.x, origin.y, origin.z
+    dx, dy, dz = direction.x, direction.y, direction.z
+    flat_x = abs(dx) < parallel_epsilon
+    flat_y = abs(dy) < parallel_epsilon
+    flat_z = abs(dz) < parallel_epsilon
+    inv_x = 0.0 if flat_x else 1.0 / dx
+    inv_y = 0.0 if flat_y else 1.0 / dy
+    inv_z = 0.0 if flat_z else 1.0 / dz
+
+    def slab(o, flat, inv, lo_box, hi_box, lo, hi):
+        if flat:
+            if o < lo_box or o > hi_box:
+                return INF, hi
+            return lo, hi
+        t0 = (lo_box - o) * inv
+        t1 = (hi_box - o) * inv
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > lo:
+            lo = t0
+        if t1 < hi:
+            hi = t1
+        if hi < lo:
+            return INF, hi
+        return lo, hi
+
+    def enter(node, parent, hi):
+        i = 6 * node
+        x0, y0, z0, x1, y1, z1 = parent
+        sx = (x1 - x0) / steps
+        sy = (y1 - y0) / steps
+        sz = (z1 - z0) / steps
+        q = boxes[i + 3]
+        bx1 = x1 if q == steps else x0 + q * sx
+        q = boxes[i + 4]
+        by1 = y1 if q == steps else y0 + q * sy
+        q = boxes[i + 5]
+        bz1 = z1 if q == steps else z0 + q * sz
+        box = (x0 + boxes[i] * sx, y0 + boxes[i + 1] * sy, z0 + boxes[i + 2] * sz, bx1, by1, bz1)
+        lo, hi = slab(ox, flat_x, inv_x, box[0], bx1, t_min, hi)
+        if lo == INF:
+            return INF, box
+        lo, hi = slab(oy, flat_y, inv_y, box[1], by1, lo, hi)
+        if lo == INF:
+            return INF, box
+        lo, hi = slab(oz, flat_z, inv_z, box[2], bz1, lo, hi)
+        return lo, box
+
+    def enter_root(hi):
+        box = bvh.root_box
+        lo, hi = slab(ox, flat_x, inv_x, box[0], box[3], t_min, hi)
+        if lo != INF:
+            lo, hi = slab(oy, flat_y, inv_y, box[1], box[4], lo, hi)
+        if lo != INF:
+            lo, hi = slab(oz, flat_z, inv_z, box[2], box[5], lo, hi)
+        return lo
+
+    stats = render.stats.active
+    if stats is not None:
+        return stats.count_nodes(enter), stats.count_nodes(enter_root)
+    return enter, enter_root
+
+
+def compact_closest(bvh, origin, direction, t_min, t_max, intersect,
+                    parallel_epsilon=PARALLEL_EPSILON):
+    """Closest-hit query on a CompactBVH; arguments and result as for bvh_closest."""
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter, enter_root = _child_entry(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    closest_t = t_max
+    closest = -1
+    entry = enter_root(t_max)
+    if entry == INF:
+        return None
+    stack = [(0, entry, bvh.root_box)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, entry, box = pop()
+        if entry > closest_t:
+            continue
+        count = counts[node]
+        if count:
+            first = offsets[node]
+            for k in range(first, first + count):
+                prim = prims[k]
+                t = intersect(prim, origin, direction, t_min, closest_t)
+                if t < closest_t:
+                    closest_t = t
+                    closest = prim
+        else:
+            left = node + 1
+            right = offsets[node]
+            t_left, box_left = enter(left, box, closest_t)
+            t_right, box_right = enter(right, box, closest_t)
+            if t_left <= t_right:
+                if t_right != INF:
+                    push((right, t_right, box_right))
+                if t_left != INF:
+                    push((left, t_left, box_left))
+            else:
+                if t_left != INF:
+                    push((left, t_left, box_left))
+                push((right, t_right, box_right))
+
+    if closest < 0:
+        return None
+    return (closest, closest_t)
+
+
+def compact_occluded(bvh, origin, direction, t_min, t_max, intersect,
+                     parallel_epsilon=PARALLEL_EPSILON):
+    """Any-hit query on a CompactBVH; arguments and result as for bvh_occluded."""
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter, enter_root = _child_entry(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    if enter_root(t_max) == INF:
+        return False
+    stack = [(0, bvh.root_box)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, box = pop()
+        count = counts[node]
+        if count:
+            first = offsets[node]
+            for k in range(first, first + count):
+                if intersect(prims[k], origin, direction, t_min, t_max) < t_max:
+                    return True
+        else:
+            right = offsets[node]
+            t_right, box_right = enter(right, box, t_max)
+            if t_right != INF:
+                push((right, box_right))
+            t_left, box_left = enter(node + 1, box, t_max)
+            if t_left != INF:
+                push((node + 1, box_left))
+    return False
@@ -0,0 +1,227 @@
+"""
+Object instancing: one mesh and one BVH shared by any number of placements.
+
+An Instance places a TriangleMesh (and the BVH built over it in the mesh's
+own coordinates) in the world with an affine transform. Instead of moving
+the triangles, every ray is moved into object space: origin' = M^-1 (origin - T)
+and direction' = M^-1 direction. The direction is not renormalized, so a
+distance t along the object-space ray is the same distance along the world
+ray and hits from different instances compare directly.
+
+An InstanceScene puts a top-level BVH over the instances, whose leaves run
+the per-instance traversal, so many copies of an asset cost one mesh and
+one BVH in memory plus a few numbers per copy.
+"""
+import math
+
+import numpy as np
+
+from assignment1.vec import Vec
+from assignment5.bvh import (INF, PARALLEL_EPSILON as BOX_EPSILON, AnimatedBVH, FlatBVH,
+                             build_primitive_bvh, bvh_closest, bvh_occluded, leaf_dispatch)
+from assignment5.compact import CompactBVH, compact_closest, compact_occluded
+from assignment5.wide import WideBVH, wide_closest, wide_occluded
+from assignment5.mesh import PARALLEL_EPSILON as TRIANGLE_EPSILON, triangle_intersector
+
+
+# Closest-hit and any-hit query for every kind of mesh BVH.
+QUERIES = {
+    FlatBVH: (bvh_closest, bvh_occluded),
+    CompactBVH: (compact_closest, compact_occluded),
+    WideBVH: (wide_closest, wide_occluded),
+}
+
+
+def affine(scale=1.0, rotation_y=0.0):
+    """
+    3x3 matrix that scales (uniformly, or per axis with a 3-tuple) and then
+    rotates by rotation_y degrees about the y axis.
+    """
+    sx, sy, sz = scale if isinstance(scale, (tuple, list)) else (scale, scale, scale)
+    c = math.cos(math.radians(rotation_y))
+    s = math.sin(math.radians(rotation_y))
+    rotation = np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]], dtype=np.float64)
+    return rotation @ np.diag([sx, sy, sz]).astype(np.float64)
+
+
+class Instance:
+    def __init__(self, mesh, bvh, matrix=None, translation=(0, 0, 0)):
+        """
+        mesh: TriangleMesh in object space
+        bvh: FlatBVH, CompactBVH or WideBVH over the mesh triangles (shared
+             between instances)
+        matrix: 3x3 linear part of the object-to-world transform (default identity)
+        translation: (x, y, z) added after the linear part
+        """
+        self.mesh = mesh
+        self.bvh = bvh
+        # Triangle of the last hit reported by hit_instance.
+        self.last_hit = -1
+        self.set_transform(matrix, translation)
+
+    def set_transform(self, matrix=None, translation=(0, 0, 0)):
+        """
+        Places the instance with a new transform (see __init__), e.g. for the
+        next frame of an animation. InstanceScene.update refits the scene
+        around the moved instances.
+        """
+        self.matrix = np.eye(3) if matrix is None else np.array(matrix, dtype=np.float64).reshape(3, 3)
+        self.translation = tuple(float(c) for c in translation)
+        inverse = np.linalg.inv(self.matrix)
+        self._inverse = tuple(inverse.reshape(-1).tolist())
+        self._normal_matrix = tuple(inverse.T.reshape(-1).tolist())
+        # The Möller–Trumbore determinant is a triple product, so it shrinks
+        # by exactly det(M) in object space; scaling the threshold with it
+        # keeps the parallel test equivalent to testing world-space triangles.
+        self._det = abs(float(np.linalg.det(self.matrix)))
+        self._make_intersector()
+
+    def _make_intersector(self):
+        self._intersect = triangle_intersector(self.mesh, TRIANGLE_EPSILON / self._det)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_intersect']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_intersector()
+
+    def bounds(self):
+        """World-space box around the transformed root box of the BVH."""
+        box = self.bvh.root_bounds()
+        corners = np.array([(box[i, 0], box[j, 1], box[k, 2])
+                            for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        world = corners @ self.matrix.T + self.translation
+        return tuple(world.min(axis=0).tolist()), tuple(world.max(axis=0).tolist())
+
+    def to_object(self, origin, direction):
+        """
+        The ray in object space as (origin, direction, slab epsilon), where the
+        slab epsilon is the BVH parallel threshold scaled like the direction.
+        """
+        m = self._inverse
+        tx, ty, tz = self.translation
+        ox, oy, oz = origin.x - tx, origin.y - ty, origin.z - tz
+        dx, dy, dz = direction.x, direction.y, direction.z
+        o = Vec(m[0] * ox + m[1] * oy + m[2] * oz,
+                m[3] * ox + m[4] * oy + m[5] * oz,
+                m[6] * ox + m[7] * oy + m[8] * oz)
+        d = Vec(m[0] * dx + m[1] * dy + m[2] * dz,
+                m[3] * dx + m[4] * dy + m[5] * dz,
+                m[6] * dx + m[7] * dy + m[8] * dz)
+        epsilon = BOX_EPSILON * d.length() / direction.length()
+        return o, d, epsilon
+
+    def normal(self, prim):
+        """World-space unit normal of triangle prim as an (x, y, z) tuple."""
+        n = self._normal_matrix
+        x, y, z = self.mesh.normal(prim)
+        wx = n[0] * x + n[1] * y + n[2] * z
+        wy = n[3] * x + n[4] * y + n[5] * z
+        wz = n[6] * x + n[7] * y + n[8] * z
+        l = math.sqrt(wx * wx + wy * wy + wz * wz)
+        return (wx / l, wy / l, wz / l)
+
+    def material(self, prim):
+        """Material of triangle prim."""
+        return self.mesh.material(prim)
+
+
+def instance_closest(instance, origin, direction, t_min, t_max):
+    """
+    Closest triangle of one instance hit by a world-space ray within
+    (t_min, t_max). Returns (triangle index, t) or None.
+    """
+    o, d, epsilon = instance.to_object(origin, direction)
+    closest = QUERIES[type(instance.bvh)][0]
+    return closest(instance.bvh, o, d, t_min, t_max, instance._intersect, epsilon)
+
+
+def instance_occluded(instance, origin, direction, t_min, t_max):
+    """Any-hit query of one instance for a world-space ray."""
+    o, d, epsilon = instance.to_object(origin, direction)
+    occluded = QUERIES[type(instance.bvh)][1]
+    return occluded(instance.bvh, o, d, t_min, t_max, instance._intersect, epsilon)
+
+
+def hit_instance(instance, origin, direction, t_min, t_max):
+    """
+    Leaf test for a BVH whose primitives include instances (see leaf_dispatch):
+    returns the distance to the closest hit, or inf, and keeps the triangle in
+    instance.last_hit. Every primitive sits in exactly one BVH leaf, so after
+    a closest-hit traversal that returned this instance, last_hit is the
+    triangle of that hit.
+    """
+    hit = instance_closest(instance, origin, direction, t_min, t_max)
+    if hit is None:
+        return INF
+    instance.last_hit = hit[0]
+    return hit[1]
+
+
+class InstanceScene:
+    def __init__(self, instances):
+        """A top-level BVH over a list of Instances."""
+        self.instances = list(instances)
+        self.bvh = build_primitive_bvh(self.instances, max_leaf_size=1)
+        # AnimatedBVH over self.bvh, made by the first update().
+        self._animated = None
+        self._make_intersector()
+
+    def _make_intersector(self):
+        self._intersect = leaf_dispatch([(hit_instance, inst) for inst in self.instances])
+
+    def __getstate__(self):
+        return {'instances': self.instances, 'bvh': self.bvh}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._animated = None
+        self._make_intersector()
+
+    def update(self):
+        """
+        Refits the top-level BVH after instances were moved with
+        set_transform, or after their meshes were deformed and the mesh
+        BVHs updated (see AnimatedBVH), rebuilding the parts that degraded.
+        """
+        for inst in self.instances:
+            # The triangle tests read the mesh arrays, which may be new.
+            inst._make_intersector()
+        if self._animated is None:
+            self._animated = AnimatedBVH(self.bvh, max_leaf_size=1)
+        bounds = np.array([inst.bounds() for inst in self.instances], dtype=np.float64)
+        self._animated.update(bounds[:, 0], bounds[:, 1])
+
+    def nbytes(self):
+        """Bytes of mesh and BVH arrays, counting shared ones once."""
+        seen = {}
+        for inst in self.instances:
+            seen[id(inst.mesh)] = inst.mesh.nbytes()
+            seen[id(inst.bvh)] = inst.bvh.nbytes()
+        return sum(seen.values()) + self.bvh.nbytes()
+
+
+def scene_closest(scene, origin, direction, t_min, t_max):
+    """
+    Closest hit over all instances within (t_min, t_max).
+    Returns (instance, triangle index, t) or None.
+    """
+    hit = bvh_closest(scene.bvh, origin, direction, t_min, t_max, scene._intersect)
+    if hit is None:
+        return None
+    instance = scene.instances[hit[0]]
+    return (instance, instance.last_hit, hit[1])
+
+
+def scene_occluded(scene, origin, direction, t_min, t_max):
+    """True if any instance blocks the ray within (t_min, t_max)."""
+    instances = scene.instances
+
+    def blocked(i, origin, direction, t_min, t_max):
+        # Any distance below t_max counts as a hit for bvh_occluded.
+        return t_min if instance_occluded(instances[i], origin, direction, t_min, t_max) else INF
+
+    return bvh_occluded(scene.bvh, origin, direction, t_min, t_max, blocked)
@@ -0,0 +1,285 @@
+"""
+Linear BVH (LBVH) construction from Morton codes, for scenes that change
+every frame.
+
+The primitive centroids are quantized to a 1024^3 grid over their bounding
+box, turned into 30-bit Morton codes (the bits of x, y and z interleaved)
+and put in order with an LSD radix sort. In Morton order every node of the
+hierarchy is a contiguous range of primitives, split where the highest
+differing code bit changes, so the children of all nodes are found at once
+(Karras, "Maximizing Parallelism in the Construction of BVHs, Octrees, and
+k-d Trees", 2012) with no sorting or binning per level. Ranges of at most
+max_leaf_size primitives become leaves.
+
+Morton splits are spatial-median splits that ignore the SAH, so the tree
+is quick to build but slower to trace than one from build_bvh_sah. The
+optional optimization pass restructures every treelet of a node, its
+children and grandchildren by tree rotations (Kensler, "Tree Rotations for
+Improving Bounding Volume Hierarchies", 2008) whenever that shrinks a
+child's surface area, from the bottom of the tree up.
+
+build_lbvh takes the same arguments as build_bvh_sah and also returns a
+FlatBVH, so either can build any BVH in the project.
+"""
+import numpy as np
+
+from assignment5.bvh import FlatBVH, surface_area
+
+# Quantization steps per axis; three axes of 10 bits fill a 30-bit code.
+GRID = 1 << 10
+
+
+def _expand_bits(v):
+    """Spreads the low 10 bits of every value so two zero bits follow each bit."""
+    v = v.astype(np.uint64)
+    v = (v * 0x00010001) & 0xFF0000FF
+    v = (v * 0x00000101) & 0x0F00F00F
+    v = (v * 0x00000011) & 0xC30C30C3
+    v = (v * 0x00000005) & 0x49249249
+    return v
+
+
+def morton_codes(centroids):
+    """30-bit Morton codes (uint64) of points quantized over their bounding box."""
+    centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 3)
+    lo = centroids.min(axis=0)
+    extent = centroids.max(axis=0) - lo
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(extent > 0, GRID / extent, 0.0)
+    cells = np.minimum(((centroids - lo) * scale).astype(np.int64), GRID - 1)
+    return (_expand_bits(cells[:, 0]) << 2) | (_expand_bits(cells[:, 1]) << 1) \
+        | _expand_bits(cells[:, 2])
+
+
+def radix_sort(keys, bits=30, digit_bits=15):
+    """
+    Permutation that sorts the non-negative integer keys (stable), by an LSD
+    radix sort over digits of digit_bits bits (at most 16). Every pass is a
+    stable sort of one digit stored as uint16, which NumPy does as a
+    counting (radix) sort.
+    """
+    order = np.arange(len(keys))
+    mask = (1 << digit_bits) - 1
+    for shift in range(0, bits, digit_bits):
+        digits = ((keys[order] >> shift) & mask).astype(np.uint16)
+        order = order[np.argsort(digits, kind='stable')]
+    return order
+
+
+def _leading_zeros(x):
+    """Leading zero bits of 32-bit values given as int64 (32 for zero)."""
+    return 32 - np.frexp(x.astype(np.float64))[1]
+
+
+def _prefix(codes, i, j):
+    """
+    Length of the common prefix of sorted keys i and j, where a key is the
+    code followed by its index (so equal codes still differ); -1 for a j
+    outside the array.
+    """
+    n = len(codes)
+    inside = (j >= 0) & (j < n)
+    j = np.clip(j, 0, n - 1)
+    x = (codes[i] ^ codes[j]).astype(np.int64)
+    length = np.where(x == 0, 32 + _leading_zeros(i ^ j), _leading_zeros(x))
+    return np.where(inside, length, -1)
+
+
+def radix_tree(codes):
+    """
+    The binary radix tree over n >= 2 sorted codes, with internal nodes
+    0..n-2 (0 is the root) and leaves 0..n-1 (the sorted primitives).
+    Returns, per internal node, its left and right child with flags telling
+    whether each is a leaf, and the range [first, last] of leaves below it.
+    """
+    n = len(codes)
+    i = np.arange(n - 1)
+    # A node grows from one end of its range, towards the neighbour with
+    # the longer common prefix.
+    d = np.sign(_prefix(codes, i, i + 1) - _prefix(codes, i, i - 1))
+    prefix_min = _prefix(codes, i, i - d)
+
+    # Upper bound on the length of the range, then its other end by binary search.
+    bound = np.full(n - 1, 2)
+    grow = _prefix(codes, i, i + bound * d) > prefix_min
+    while grow.any():
+        bound[grow] *= 2
+        grow &= _prefix(codes, i, i + bound * d) > prefix_min
+    length = np.zeros(n - 1, dtype=np.int64)
+    step = bound // 2
+    while step.any():
+        length += step * (_prefix(codes, i, i + (length + step) * d) > prefix_min)
+        step //= 2
+    j = i + length * d
+    prefix = _prefix(codes, i, j)
+
+    # The split is the last key that shares more than the node's prefix with key i.
+    split = np.zeros(n - 1, dtype=np.int64)
+    step = length
+    done = np.zeros(n - 1, dtype=bool)
+    while not done.all():
+        step = np.where(done, 0, (step + 1) // 2)
+        split += step * (_prefix(codes, i, i + (split + step) * d) > prefix)
+        done |= step <= 1
+    gamma = i + split * d + np.minimum(d, 0)
+    first = np.minimum(i, j)
+    last = np.maximum(i, j)
+    return gamma, first == gamma, gamma + 1, last == gamma + 1, first, last
+
+
+def _levels(left, right):
+    """Interior nodes of a tree in pointer form (children -1 in leaves) by depth, root first."""
+    levels = []
+    frontier = np.array([0])
+    while len(frontier):
+        interior = frontier[left[frontier] >= 0]
+        if not len(interior):
+            break
+        levels.append(interior)
+        frontier = np.concatenate((left[interior], right[interior]))
+    return levels
+
+
+def _rotate(left, right, box_min, box_max):
+    """
+    One pass of tree rotations, from the deepest level up. In the treelet of
+    every node, a child may trade places with a grandchild on the other
+    side; the trade that shrinks the surface area of the changed child the
+    most is made, if any does. The node's own box stays the same, and the
+    treelets of one level are disjoint, so a whole level is rotated at once.
+    """
+    for nodes in reversed(_levels(left, right)):
+        best_gain = np.zeros(len(nodes))
+        best = np.full(len(nodes), -1)
+        # (child that moves down, child that takes it in, grandchild that
+        # moves up, grandchild that stays)
+        trades = []
+        for keep, inner in ((left[nodes], right[nodes]), (right[nodes], left[nodes])):
+            has = left[inner] >= 0
+            area = surface_area(box_min[inner], box_max[inner])
+            grandchildren = (np.where(has, left[inner], 0), np.where(has, right[inner], 0))
+            for up, stay in (grandchildren, grandchildren[::-1]):
+                gain = area - surface_area(np.minimum(box_min[keep], box_min[stay]),
+                                           np.maximum(box_max[keep], box_max[stay]))
+                better = has & (gain > best_gain)
+                best_gain[better] = gain[better]
+                best[better] = len(trades)
+                trades.append((keep, inner, up, stay))
+        for k, trade in enumerate(trades):
+            pick = best == k
+            if not pick.any():
+                continue
+            node = nodes[pick]
+            keep, inner, up, stay = (a[pick] for a in trade)
+            on_left = left[node] == keep
+            left[node] = np.where(on_left, up, inner)
+            right[node] = np.where(on_left, inner, up)
+            on_left = left[inner] == up
+            left[inner] = np.where(on_left, keep, stay)
+            right[inner] = np.where(on_left, stay, keep)
+            box_min[inner] = np.minimum(box_min[keep], box_min[stay])
+            box_max[inner] = np.maximum(box_max[keep], box_max[stay])
+
+
+def build_lbvh(bounds_min, bounds_max, centroids=None, max_leaf_size=4, optimize=0, **options):
+    """
+    Builds a FlatBVH from the Morton order of the primitive centroids.
+
+    bounds_min, bounds_max, centroids and max_leaf_size are as for
+    build_bvh_sah. Its other options (SAH costs, bins) do not apply and are
+    ignored, so the two builders are interchangeable.
+    optimize: number of tree rotation passes after the build (0 for none).
+    """
+    bounds_min = np.ascontiguousarray(bounds_min, dtype=np.float64).reshape(-1, 3)
+    bounds_max = np.ascontiguousarray(bounds_max, dtype=np.float64).reshape(-1, 3)
+    n_prims = len(bounds_min)
+    if n_prims == 0:
+        raise ValueError("Cannot build a BVH without primitives")
+    if centroids is None:
+        centroids = (bounds_min + bounds_max) * 0.5
+    codes = morton_codes(centroids)
+    perm = radix_sort(codes)
+
+    # Nodes of the output tree level by level from the root, each a range
+    # [first, last] of sorted primitives and the radix tree node it comes
+    # from (-1 once it is small enough to be a leaf).
+    if n_prims > max_leaf_size:
+        child_left, left_leaf, child_right, right_leaf, range_first, range_last = \
+            radix_tree(codes[perm])
+    seg_first = np.array([0])
+    seg_last = np.array([n_prims - 1])
+    seg_tree = np.array([0 if n_prims > max_leaf_size else -1])
+    node_first, node_last, node_left, node_right = [], [], [], []
+    next_node = 1
+    while True:
+        split = seg_tree >= 0
+        n_split = int(split.sum())
+        left_ids = np.full(len(split), -1)
+        right_ids = np.full(len(split), -1)
+        left_ids[split] = next_node + 2 * np.arange(n_split)
+        right_ids[split] = left_ids[split] + 1
+        next_node += 2 * n_split
+        node_first.append(seg_first)
+        node_last.append(seg_last)
+        node_left.append(left_ids)
+        node_right.append(right_ids)
+
+        if not n_split:
+            break
+        tree = seg_tree[split]
+        lo, hi, sub = [], [], []
+        for child, leaf in ((child_left[tree], left_leaf[tree]),
+                            (child_right[tree], right_leaf[tree])):
+            inner = np.minimum(child, n_prims - 2)
+            lo.append(np.where(leaf, child, range_first[inner]))
+            hi.append(np.where(leaf, child, range_last[inner]))
+            sub.append(np.where(leaf | (hi[-1] - lo[-1] < max_leaf_size), -1, child))
+        seg_first = np.stack(lo, axis=1).ravel()
+        seg_last = np.stack(hi, axis=1).ravel()
+        seg_tree = np.stack(sub, axis=1).ravel()
+    first = np.concatenate(node_first)
+    last = np.concatenate(node_last)
+    left = np.concatenate(node_left)
+    right = np.concatenate(node_right)
+
+    # Leaf boxes from their primitives, which lie in sorted order already.
+    leaves = np.flatnonzero(left < 0)
+    leaves = leaves[np.argsort(first[leaves])]
+    box_min = np.empty((len(first), 3))
+    box_max = np.empty((len(first), 3))
+    box_min[leaves] = np.minimum.reduceat(bounds_min[perm], first[leaves])
+    box_max[leaves] = np.maximum.reduceat(bounds_max[perm], first[leaves])
+    for nodes in reversed(_levels(left, right)):
+        box_min[nodes] = np.minimum(box_min[left[nodes]], box_min[right[nodes]])
+        box_max[nodes] = np.maximum(box_max[left[nodes]], box_max[right[nodes]])
+    for _ in range(int(optimize)):
+        _rotate(left, right, box_min, box_max)
+
+    # Re-number the nodes depth-first as build_bvh_sah does.
+    levels = _levels(left, right)
+    size = np.ones(len(first), dtype=np.int64)
+    for nodes in reversed(levels):
+        size[nodes] = 1 + size[left[nodes]] + size[right[nodes]]
+    order = np.zeros(len(first), dtype=np.int64)
+    for nodes in levels:
+        order[left[nodes]] = order[nodes] + 1
+        order[right[nodes]] = order[nodes] + 1 + size[left[nodes]]
+
+    # Rotations can change the order of the leaves, so their primitive
+    # runs are gathered in depth-first order.
+    leaves = leaves[np.argsort(order[leaves])]
+    lengths = last[leaves] - first[leaves] + 1
+    starts = np.cumsum(lengths) - lengths
+    prim_indices = perm[np.repeat(first[leaves] - starts, lengths) + np.arange(n_prims)]
+
+    interior = left >= 0
+    bounds = np.empty((len(first), 6))
+    bounds[order] = np.concatenate((box_min, box_max), axis=1)
+    offsets = np.empty(len(first), dtype=np.int64)
+    offsets[order[leaves]] = starts
+    offsets[order[interior]] = order[right[interior]]
+    counts = np.zeros(len(first), dtype=np.int64)
+    counts[order[leaves]] = lengths
+    axes = np.empty(len(first), dtype=np.int64)
+    axes[order] = np.where(interior, np.argmax(box_max - box_min, axis=1), 0)
+    return FlatBVH(bounds, offsets, counts, axes, prim_indices)
@@ -1,14 +1,24 @@
 from PIL import Image
-import sys, os, math
+import sys, os, math, argparse
+import numpy as np
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from assignment5.bvh import BVHNode
+from assignment5.bvh import BVHNode, flatten_bvh, build_bvh_sah, build_bvh_parallel
+from assignment5.lbvh import build_lbvh
+from assignment5.compact import compact_bvh
+from assignment5.wide import collapse_bvh
 from assignment5.triangle import Triangle
+from assignment5.mesh import Material, TriangleMesh
+from assignment5.instance import Instance, InstanceScene, affine, scene_closest, scene_occluded
+from assignment5.objfile import load_obj_arrays, source_key
+from assignment5.scenecache import load_scene, save_scene
 import assignment1.vec
 import assignment1.color
 import assignment2.light
+import render.tiles
+import render.stats
 
 WIDTH = 500
 HEIGHT = 500
@@ -28,7 +38,7 @@ background_color = assignment1.color.Color(0, 0, 0)
 EPSILON = 0.001
 RECURSION_DEPTH = 3
 
-triangles = []
+scene = None  # InstanceScene, installed by set_scene
 
 lights = [
     assignment2.light.AmbientLight(intensity=0.2),
@@ -57,60 +67,24 @@ def multiply_mv(mat, vec):
     return assignment1.vec.Vec(rx, ry, rz)
 
 
-def intersect_ray_triangle(origin, direction, triangle):
-    epsilon = 1e-6
-    edge1 = triangle.v1.sub(triangle.v0)
-    edge2 = triangle.v2.sub(triangle.v0)
-    h = direction.cross(edge2)
-    a = edge1.dot(h)
-    if abs(a) < epsilon:
-        return float('inf')
-    f = 1 / a
-    s = origin.sub(triangle.v0)
-    u = f * s.dot(h)
-    if u < 0 or u > 1:
-        return float('inf')
-    q = s.cross(edge1)
-    v = f * direction.dot(q)
-    if v < 0 or u + v > 1:
-        return float('inf')
-    t = f * edge2.dot(q)
-    if t > EPSILON:
-        return t
-    else:
-        return float('inf')
-
-
-
-
-def load_obj(filename, color, specular, reflective):
+def load_mesh(filename, material, dtype=np.float64, cache=True):
     """
-    Loads an OBJ file and returns a list of Triangle objects.
-    Assumes that the OBJ faces are triangles.
+    Loads an OBJ file into a TriangleMesh whose triangles all use `material`.
+    Polygons are split into triangles. cache=False parses the file without
+    reading or writing its array cache (see load_obj_arrays).
     """
-    vertices = []
-    tris = []
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith('v '):
-                parts = line.split()
-                x = float(parts[1])
-                y = float(parts[2])
-                z = float(parts[3])
-                vertices.append(assignment1.vec.Vec(x, y, z))
-            elif line.startswith('f '):
-                parts = line.split()
-                idx0 = int(parts[1].split('/')[0]) - 1
-                idx1 = int(parts[2].split('/')[0]) - 1
-                idx2 = int(parts[3].split('/')[0]) - 1
-                v0 = vertices[idx0]
-                v1 = vertices[idx1]
-                v2 = vertices[idx2]
-                tris.append(Triangle(v0, v1, v2, color, specular, reflective))
-    return tris
-
+    vertices, faces = load_obj_arrays(filename, cache)
+    return TriangleMesh(vertices, faces, [material], dtype=dtype)
 
 
+def mesh_triangles(mesh):
+    """Expands a TriangleMesh into Triangle objects, in mesh order."""
+    tris = []
+    for i, (a, b, c) in enumerate(mesh.faces.tolist()):
+        m = mesh.material(i)
+        v0, v1, v2 = (assignment1.vec.Vec(*mesh.vertices[k].tolist()) for k in (a, b, c))
+        tris.append(Triangle(v0, v1, v2, m.color, m.specular, m.reflective))
+    return tris
 
 
 def compute_bbox_for_triangles(triangles):
@@ -164,69 +138,71 @@ def build_bvh(triangles, max_triangles_per_leaf=4):
     return BVHNode(combined_min, combined_max, left=left_child, right=right_child)
 
 
-def intersect_ray_aabb(origin, direction, bbox_min, bbox_max, t_min, t_max):
+def build_scene_bvh(mesh, builder="sah"):
     """
-    Checks whether a ray intersects an axis-aligned bounding box using the slab method.
+    Builds the flat BVH over the mesh triangles with the SAH builder, with
+    the SAH builder on every core ("parallel"), from Morton codes ("lbvh",
+    or "lbvh-opt" with tree rotations) or with the original median-split
+    build_bvh.
     """
-    for axis in ['x', 'y', 'z']:
-        o = getattr(origin, axis)
-        d = getattr(direction, axis)
-        min_val = getattr(bbox_min, axis)
-        max_val = getattr(bbox_max, axis)
-        if abs(d) < EPSILON:
-            if o < min_val or o > max_val:
-                return False
-        else:
-            invD = 1.0 / d
-            t0 = (min_val - o) * invD
-            t1 = (max_val - o) * invD
-            if t0 > t1:
-                t0, t1 = t1, t0
-            t_min = max(t_min, t0)
-            t_max = min(t_max, t1)
-            if t_max < t_min:
-                return False
-    return True
-
-
-def bvh_intersect(node, origin, direction, t_min, t_max):
+    if builder == "median":
+        tris = mesh_triangles(mesh)
+        return flatten_bvh(build_bvh(list(tris)), tris)
+    if builder == "parallel":
+        return build_bvh_parallel(*mesh.bounds())
+    if builder in ("lbvh", "lbvh-opt"):
+        return build_lbvh(*mesh.bounds(), optimize=2 if builder == "lbvh-opt" else 0)
+    return build_bvh_sah(*mesh.bounds())
+
+
+def load_scene_bvh(filename, material, builder="sah", cache=True, compact=0):
     """
-    Recursively traverses the BVH to find the closest triangle intersected by the ray.
-    Returns a tuple (triangle, t) if an intersection is found; otherwise, None.
+    Loads an OBJ mesh and builds its BVH in object space (instances place it
+    in the world). Returns (mesh, bvh). With cache, the result is stored in
+    <filename>.bvhcache and later runs with the same file and settings
+    memory-map it instead of loading and building again. Without cache,
+    neither this file nor the parsed-array cache of the OBJ is used.
+    compact: 8 or 16 stores the mesh in float32 and the BVH as a CompactBVH
+    with boxes of that many bits (0 keeps full precision).
     """
-    if not intersect_ray_aabb(origin, direction, node.bbox_min, node.bbox_max, t_min, t_max):
-        return None
-    hit_obj = None
-    closest_t = float('inf')
-    if node.is_leaf:
-        for tri in node.triangles:
-            t = intersect_ray_triangle(origin, direction, tri)
-            if t_min < t < t_max and t < closest_t:
-                closest_t = t
-                hit_obj = tri
-    else:
-        hit_left = bvh_intersect(node.left, origin, direction, t_min, t_max)
-        hit_right = bvh_intersect(node.right, origin, direction, t_min, t_max)
-        if hit_left is not None:
-            obj_left, t_left = hit_left
-            if t_left < closest_t:
-                closest_t = t_left
-                hit_obj = obj_left
-        if hit_right is not None:
-            obj_right, t_right = hit_right
-            if t_right < closest_t:
-                closest_t = t_right
-                hit_obj = obj_right
-    if hit_obj is not None:
-        return (hit_obj, closest_t)
-    return None
+    path = filename + ".bvhcache"
+    key = {"source": source_key(filename), "builder": builder}
+    if compact:
+        key["compact"] = compact
+    if cache:
+        with render.stats.phase("load"):
+            found = load_scene(path, key, [material])
+        if found is not None:
+            return found
+
+    with render.stats.phase("load"):
+        mesh = load_mesh(filename, material, np.float32 if compact else np.float64, cache)
+    with render.stats.phase("build"):
+        bvh = build_scene_bvh(mesh, builder)
+        if compact:
+            bvh = compact_bvh(bvh, compact)
+    if cache:
+        try:
+            save_scene(path, key, mesh, bvh)
+        except OSError:
+            pass  # e.g. a read-only directory; the cache is only an optimization
+    return mesh, bvh
 
 
 def closest_intersection(origin, direction, t_min, t_max):
     """
-    Finds the closest intersecting triangle (if any) using the BVH.
+    Finds the closest intersecting triangle (if any) through the instance BVH
+    and the BVH of the hit instance's mesh.
+    Returns a tuple (instance, triangle index, t), or None.
+    """
+    return scene_closest(scene, origin, direction, t_min, t_max)
+
+
+def occluded(origin, direction, t_min, t_max):
+    """
+    Shadow-ray query: True if any triangle blocks the ray within (t_min, t_max).
     """
-    return bvh_intersect(bvh_root, origin, direction, t_min, t_max)
+    return scene_occluded(scene, origin, direction, t_min, t_max)
 
 
 def compute_lighting(point, normal, view, specular):
@@ -247,7 +223,12 @@ def compute_lighting(point, normal, view, specular):
             else:
                 continue
             # Shadow check.
-            if closest_intersection(point, L, EPSILON, t_max) is not None:
+            stats = render.stats.active
+            if stats is None:
+                blocked = occluded(point, L, EPSILON, t_max)
+            else:
+                blocked = stats.trace("shadow", occluded, point, L, EPSILON, t_max)
+            if blocked:
                 continue
             # Diffuse lighting.
             n_dot_l = normal.dot(L)
@@ -255,7 +236,7 @@ def compute_lighting(point, normal, view, specular):
                 intensity += light.intensity * n_dot_l / (normal.length() * L.length())
             # Specular lighting.
             if specular != -1:
-                R = normal.mul(2 * n_dot_l).sub(L)
+                R = L.reflect(normal)
                 r_dot_v = R.dot(view)
                 if r_dot_v > 0:
                     intensity += light.intensity * (r_dot_v / (R.length() * view.length())) ** specular
@@ -266,22 +247,28 @@ def reflect_ray(incident, normal):
     """
     Computes the reflection of an incident ray with respect to a surface normal.
     """
-    return normal.mul(2 * incident.dot(normal)).sub(incident)
+    return incident.reflect(normal)
 
 
-def trace_ray(origin, direction, t_min, t_max, depth):
+def trace_ray(origin, direction, t_min, t_max, depth, kind="primary"):
     """
     Traces a ray into the scene. If an intersection is found, it computes local lighting
     and recursively computes reflections.
+    kind is the ray type counted by render.stats.
     """
-    intersection = closest_intersection(origin, direction, t_min, t_max)
+    stats = render.stats.active
+    if stats is None:
+        intersection = closest_intersection(origin, direction, t_min, t_max)
+    else:
+        intersection = stats.trace(kind, closest_intersection, origin, direction, t_min, t_max)
     if intersection is None:
         return background_color
 
-    closest_obj, closest_t = intersection
-    point = origin.add(direction.mul(closest_t))
-    normal = closest_obj.normal
-    view = direction.mul(-1)
+    instance, index, closest_t = intersection
+    closest_obj = instance.material(index)
+    point = origin.madd(direction, closest_t)
+    normal = assignment1.vec.Vec(*instance.normal(index))
+    view = direction.neg()
     lighting = compute_lighting(point, normal, view, closest_obj.specular)
     local_color = closest_obj.color.mul(lighting)
 
@@ -289,52 +276,130 @@ def trace_ray(origin, direction, t_min, t_max, depth):
         return local_color
 
     reflected_ray = reflect_ray(view, normal)
-    reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1)
-    return local_color.mul(1 - closest_obj.reflective).add(reflected_color.mul(closest_obj.reflective))
+    reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1, "reflection")
+    return local_color.blend(reflected_color, closest_obj.reflective)
 
 
-def render_scene():
+def bunny_instances(mesh, bvh, count=1):
+    """
+    Places `count` copies of the bunny, all sharing one mesh and one BVH.
+    The first one is the single bunny of the original scene; the others
+    stand in rows of five behind it, each turned a little further.
+    """
+    columns = [0, -2.5, 2.5, -5, 5]
+    instances = []
+    for k in range(count):
+        translation = (columns[k % 5], -1.5, 4 + 3 * (k // 5))
+        instances.append(Instance(mesh, bvh, affine(15.0, rotation_y=(37 * k) % 360), translation))
+    return instances
+
+
+def build_scene(builder="sah", cache=True, bunnies=1, compact=0, wide=False):
+    """
+    Loads bunny.obj (or its cache) and installs a scene of `bunnies` instances.
+    compact is as for load_scene_bvh; wide traces the bunny through the
+    4-wide BVH collapsed from its binary one.
+    """
+    bunny_material = Material(color=assignment1.color.Color(255, 255, 255),
+                              specular=10,
+                              reflective=0.2)
+    bunny_mesh, bunny_bvh = load_scene_bvh("bunny.obj", bunny_material, builder, cache,
+                                             compact)
+    if wide:
+        with render.stats.phase("build"):
+            bunny_bvh = collapse_bvh(bunny_bvh)
+    with render.stats.phase("build"):
+        set_scene(InstanceScene(bunny_instances(bunny_mesh, bunny_bvh, bunnies)))
+
+
+def set_scene(scene_instances):
     """
-    Renders the scene pixel-by-pixel and returns a PIL Image.
+    Installs the InstanceScene, also in worker processes that did not
+    inherit it.
     """
-    img = Image.new("RGB", (WIDTH, HEIGHT))
-    pixels = img.load()
+    global scene
+    scene = scene_instances
 
-    for px in range(-WIDTH // 2, WIDTH // 2):
-        for py in range(-HEIGHT // 2, HEIGHT // 2):
+
+def render_tile(x0, y0, x1, y1):
+    """
+    Renders the pixel block [x0, x1) x [y0, y1) (image coordinates) ray by ray
+    and returns it as a (y1 - y0, x1 - x0, 3) uint8 array.
+    """
+    data = bytearray()
+    for fy in range(y0, y1):
+        py = HEIGHT // 2 - fy - 1
+        for fx in range(x0, x1):
+            px = fx - WIDTH // 2
             direction = canvas_to_viewport(px, py)
             # direction = multiply_mv(camera_rotation, direction)
             color = trace_ray(camera_position, direction, 1.0, float('inf'), RECURSION_DEPTH)
 
-            fx = px + WIDTH // 2
-            fy = HEIGHT // 2 - py - 1
             r = max(min(int(color.r), 255), 0)
             g = max(min(int(color.g), 255), 0)
             b = max(min(int(color.b), 255), 0)
-            pixels[fx, fy] = (r, g, b)
-    return img
+            data += bytes((r, g, b))
+    return np.frombuffer(data, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
+
+
+def render_scene(workers=1, tile_size=32, order="hilbert", costs=None):
+    """
+    Renders the scene tile by tile on `workers` processes (0 uses every core)
+    and returns a PIL Image. Tiles are scheduled in `order` (see
+    render.tiles.TILE_ORDERS); per-tile timings are appended to `costs`.
+    """
+    frame = render.tiles.render_parallel(render_tile, WIDTH, HEIGHT, workers, tile_size,
+                                         initializer=set_scene, initargs=(scene,),
+                                         order=order, costs=costs)
+    return Image.fromarray(frame, "RGB")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the Stanford Bunny with a BVH.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of render processes (0 uses every core)")
+    parser.add_argument("--tile-size", type=int, default=32, help="tile size in pixels")
+    parser.add_argument("--builder", choices=["sah", "parallel", "lbvh", "lbvh-opt", "median"], default="sah",
+                        help="BVH construction strategy")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse bunny.obj and build the scene instead of using "
+                             "bunny.obj.cache and bunny.obj.bvhcache")
+    parser.add_argument("--bunnies", type=int, default=1,
+                        help="number of bunny instances sharing one mesh and BVH")
+    parser.add_argument("--compact", type=int, choices=[0, 8, 16], default=0,
+                        help="store the mesh in float32 and the BVH boxes in this many bits")
+    parser.add_argument("--wide", action="store_true",
+                        help="trace the bunny through a 4-wide BVH")
+    parser.add_argument("--tile-order", choices=render.tiles.TILE_ORDERS, default="hilbert",
+                        help="order in which tiles are scheduled")
+    parser.add_argument("--tile-report", action="store_true",
+                        help="print per-tile and per-worker render times")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="count rays, traversal work and phase times and save them as JSON")
+    parser.add_argument("--heatmap", metavar="FILE",
+                        help="save an image of the render time of every tile (implies statistics)")
+    args = parser.parse_args()
+    if args.wide and args.compact:
+        parser.error("--wide and --compact cannot be combined")
+    if args.stats or args.heatmap:
+        render.stats.enable()
+
     try:
-        bunny_triangles = load_obj("bunny.obj",
-                                   color=assignment1.color.Color(255, 255, 255),
-                                   specular=10,
-                                   reflective=0.2)
-        bunny_scale = 15.0
-        bunny_translation = assignment1.vec.Vec(0, -1.5, 4)
-        for tri in bunny_triangles:
-            tri.v0 = tri.v0.mul(bunny_scale).add(bunny_translation)
-            tri.v1 = tri.v1.mul(bunny_scale).add(bunny_translation)
-            tri.v2 = tri.v2.mul(bunny_scale).add(bunny_translation)
-            tri.edge1 = tri.v1.sub(tri.v0)
-            tri.edge2 = tri.v2.sub(tri.v0)
-            tri.normal = tri.edge1.cross(tri.edge2).normalize()
-        triangles.extend(bunny_triangles)
-        bvh_root = build_bvh(triangles)
+        build_scene(args.builder, not args.no_cache, args.bunnies, args.compact, args.wide)
     except Exception as e:
         print("Error loading bunny.obj:", e)
         sys.exit(1)
 
-    image = render_scene()
-    image.save("bunny.png")
+    costs = [] if args.tile_report else None
+    image = render_scene(args.workers, args.tile_size, args.tile_order, costs)
+    if costs is not None:
+        print(render.tiles.cost_report(costs))
+    with render.stats.phase("encode"):
+        image.save("bunny.png")
+    stats = render.stats.active
+    if stats is not None:
+        print(stats.summary())
+        if args.stats:
+            stats.save_json(args.stats)
+        if args.heatmap:
+            stats.save_heatmap(args.heatmap, WIDTH, HEIGHT)
@@ -0,0 +1,178 @@
+import numpy as np
+
+INF = float('inf')
+
+# Determinant threshold of the Möller–Trumbore test below which a ray is
+# treated as parallel to the triangle.
+PARALLEL_EPSILON = 1e-6
+
+# The arrays that make up a TriangleMesh (see TriangleMesh.arrays).
+MESH_ARRAYS = ('vertices', 'faces', 'material_ids', 'v0', 'edge1', 'edge2', 'normals')
+
+
+class Material:
+    def __init__(self, color, specular, reflective, transparency=0):
+        """
+        color: a Color object
+        specular: specular exponent (for lighting calculations)
+        reflective: reflection coefficient (float between 0 and 1)
+        transparency: values from 0 (opaque) to 1 (fully transparent)
+        """
+        self.color = color
+        self.specular = specular
+        self.reflective = reflective
+        self.transparency = transparency
+
+
+class TriangleMesh:
+    def __init__(self, vertices, faces, materials, material_ids=None, dtype=np.float64):
+        """
+        A triangle mesh stored as contiguous arrays instead of Triangle objects.
+
+        vertices: (V, 3) float vertex positions
+        faces: (F, 3) int vertex indices of every triangle
+        materials: list of Material objects
+        material_ids: (F,) index into materials per triangle (default: all 0)
+        dtype: float type of the vertex and per-triangle arrays; np.float32
+               halves their size for very large meshes
+
+        The Möller–Trumbore data (first vertex, both edges) and the unit face
+        normals are precomputed per triangle as (F, 3) arrays.
+        """
+        self.dtype = np.dtype(dtype)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32).reshape(-1, 3)
+        self.materials = list(materials)
+        if material_ids is None:
+            material_ids = np.zeros(len(self.faces), dtype=np.int32)
+        self.material_ids = np.ascontiguousarray(material_ids, dtype=np.int32)
+        self.set_vertices(vertices)
+
+    def set_vertices(self, vertices):
+        """
+        Replaces the vertex positions (e.g. after a transform) and recomputes
+        the per-triangle edges and normals.
+        """
+        self.vertices = np.ascontiguousarray(vertices, dtype=self.dtype).reshape(-1, 3)
+        v0 = self.vertices[self.faces[:, 0]]
+        self.v0 = v0
+        self.edge1 = self.vertices[self.faces[:, 1]] - v0
+        self.edge2 = self.vertices[self.faces[:, 2]] - v0
+        e1, e2 = self.edge1, self.edge2
+        n = np.stack((e1[:, 1] * e2[:, 2] - e1[:, 2] * e2[:, 1],
+                      e1[:, 2] * e2[:, 0] - e1[:, 0] * e2[:, 2],
+                      e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]), axis=1)
+        length = np.sqrt(n[:, 0] * n[:, 0] + n[:, 1] * n[:, 1] + n[:, 2] * n[:, 2])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.normals = n / length[:, None]
+        self._make_views()
+
+    def _make_views(self):
+        # Flat memoryviews give the scalar intersector plain Python floats.
+        self.v0_view = memoryview(self.v0.reshape(-1))
+        self.edge1_view = memoryview(self.edge1.reshape(-1))
+        self.edge2_view = memoryview(self.edge2.reshape(-1))
+
+    def arrays(self):
+        """All mesh arrays by name, including the derived per-triangle ones."""
+        return {name: getattr(self, name) for name in MESH_ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, materials):
+        """
+        Rebuilds a mesh from the output of arrays() (e.g. memory-mapped from a
+        cache file) without recomputing the edges and normals.
+        """
+        mesh = cls.__new__(cls)
+        for name in MESH_ARRAYS:
+            setattr(mesh, name, arrays[name])
+        mesh.dtype = mesh.vertices.dtype
+        mesh.materials = list(materials)
+        mesh._make_views()
+        return mesh
+
+    def __getstate__(self):
+        return {'vertices': self.vertices, 'faces': self.faces,
+                'materials': self.materials, 'material_ids': self.material_ids}
+
+    def __setstate__(self, state):
+        self.dtype = state['vertices'].dtype
+        self.faces = state['faces']
+        self.materials = state['materials']
+        self.material_ids = state['material_ids']
+        self.set_vertices(state['vertices'])
+
+    def __len__(self):
+        return len(self.faces)
+
+    def nbytes(self):
+        """Total size of the mesh arrays in bytes."""
+        return sum(a.nbytes for a in (self.vertices, self.faces, self.material_ids,
+                                      self.v0, self.edge1, self.edge2, self.normals))
+
+    def normal(self, i):
+        """Unit normal of triangle i as an (x, y, z) tuple."""
+        return tuple(self.normals[i].tolist())
+
+    def material(self, i):
+        """Material of triangle i."""
+        return self.materials[self.material_ids[i]]
+
+    def bounds(self):
+        """
+        Per-triangle bounding boxes and centroids as three (F, 3) arrays
+        (bounds_min, bounds_max, centroids), e.g. for build_bvh_sah.
+        """
+        if self.dtype == np.float64:
+            corners = self.vertices[self.faces]
+        else:
+            # The intersector works in double precision on v0 and the edges,
+            # whose corners can be a rounding step away from the vertices.
+            v0 = self.v0.astype(np.float64)
+            corners = np.stack((v0, v0 + self.edge1, v0 + self.edge2), axis=1)
+        return corners.min(axis=1), corners.max(axis=1), corners.sum(axis=1) / 3
+
+
+def triangle_intersector(mesh, parallel_epsilon=PARALLEL_EPSILON):
+    """
+    Returns intersect(i, origin, direction, t_min, t_max): the Möller–Trumbore
+    test of triangle i, read straight from the mesh arrays. It gives the hit
+    distance within (t_min, t_max), or inf, and fits the BVH leaf contract.
+    parallel_epsilon is the determinant threshold below which a ray counts
+    as parallel to the triangle.
+    """
+    v0 = mesh.v0_view
+    edge1 = mesh.edge1_view
+    edge2 = mesh.edge2_view
+
+    def intersect(i, origin, direction, t_min, t_max):
+        j = 3 * i
+        e2x, e2y, e2z = edge2[j], edge2[j + 1], edge2[j + 2]
+        dx, dy, dz = direction.x, direction.y, direction.z
+        # h = direction x edge2
+        hx = dy * e2z - dz * e2y
+        hy = dz * e2x - dx * e2z
+        hz = dx * e2y - dy * e2x
+        e1x, e1y, e1z = edge1[j], edge1[j + 1], edge1[j + 2]
+        a = e1x * hx + e1y * hy + e1z * hz
+        if abs(a) < parallel_epsilon:
+            return INF
+        f = 1 / a
+        sx = origin.x - v0[j]
+        sy = origin.y - v0[j + 1]
+        sz = origin.z - v0[j + 2]
+        u = f * (sx * hx + sy * hy + sz * hz)
+        if u < 0 or u > 1:
+            return INF
+        # q = s x edge1
+        qx = sy * e1z - sz * e1y
+        qy = sz * e1x - sx * e1z
+        qz = sx * e1y - sy * e1x
+        v = f * (dx * qx + dy * qy + dz * qz)
+        if v < 0 or u + v > 1:
+            return INF
+        t = f * (e2x * qx + e2y * qy + e2z * qz)
+        if t_min < t < t_max:
+            return t
+        return INF
+
+    return intersect
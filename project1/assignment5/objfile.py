@@ -0,0 +1,115 @@
+"""
+Bulk Wavefront OBJ loading into numpy arrays, with an on-disk binary cache.
+
+parse_obj reads the whole file at once and converts all vertex and face
+lines with a handful of numpy calls instead of building an object per line.
+load_obj_arrays stores the result next to the OBJ file and memory-maps it on
+later runs, as long as the OBJ file's size and modification time are unchanged.
+"""
+import os
+import re
+
+import numpy as np
+
+from assignment5.arrayfile import load_arrays, save_arrays
+
+# Bump when parse_obj changes what it produces, to invalidate old caches.
+PARSER_VERSION = 1
+
+CACHE_SUFFIX = '.cache'
+
+_FACE_REFS = re.compile(rb'/\S*')
+
+
+def _triangulate(indices, counts):
+    """Fans every polygon (counts[i] consecutive indices) into triangles."""
+    if (counts < 3).any():
+        raise ValueError("OBJ face with fewer than 3 vertices")
+    starts = np.cumsum(counts) - counts
+    fan = counts - 2
+    face = np.repeat(np.arange(len(counts)), fan)
+    j = np.arange(fan.sum()) - np.repeat(np.cumsum(fan) - fan, fan) + 1
+    first = starts[face]
+    return np.stack((indices[first], indices[first + j], indices[first + j + 1]), axis=1)
+
+
+def parse_obj(filename):
+    """
+    Parses the vertex positions and faces of an OBJ file.
+    Returns (vertices, faces) as (V, 3) float64 and (F, 3) int32 arrays with
+    0-based indices. Polygons are fanned into triangles, texture/normal
+    references (v/vt/vn) are ignored and negative (relative) indices resolved.
+    """
+    with open(filename, 'rb') as f:
+        lines = f.read().splitlines()
+    v_lines = [line[2:] for line in lines if line.startswith(b'v ')]
+    f_lines = [line[2:] for line in lines if line.startswith(b'f ')]
+
+    values = np.array(b' '.join(v_lines).split(), dtype=np.float64)
+    if len(values) != 3 * len(v_lines):
+        # Extra values (w, or vertex colors) on some lines: keep x, y, z.
+        values = np.array([v for line in v_lines for v in line.split()[:3]], dtype=np.float64)
+        if len(values) != 3 * len(v_lines):
+            raise ValueError("OBJ vertex with fewer than 3 coordinates")
+    vertices = values.reshape(-1, 3)
+
+    face_text = b' '.join(f_lines)
+    if b'/' in face_text:
+        face_text = _FACE_REFS.sub(b'', face_text)
+    indices = np.array(face_text.split(), dtype=np.int64)
+
+    if len(indices) == 3 * len(f_lines):
+        counts = np.full(len(f_lines), 3)
+    else:
+        counts = np.array([len(line.split()) for line in f_lines])
+    if (indices < 0).any():
+        # Relative indices count back from the last vertex defined so far.
+        seen = np.cumsum([line.startswith(b'v ') for line in lines])
+        seen = seen[[i for i, line in enumerate(lines) if line.startswith(b'f ')]]
+        indices = np.where(indices < 0, np.repeat(seen, counts) + indices, indices - 1)
+    else:
+        indices = indices - 1
+    if len(indices) and (indices.min() < 0 or indices.max() >= len(vertices)):
+        raise ValueError("OBJ face index out of range")
+
+    if (counts == 3).all():
+        faces = indices.reshape(-1, 3)
+    else:
+        faces = _triangulate(indices, counts)
+    return vertices, faces.astype(np.int32)
+
+
+def cache_path(filename):
+    """Path of the binary cache kept next to an OBJ file."""
+    return filename + CACHE_SUFFIX
+
+
+def source_key(filename):
+    """Identifies a version of an OBJ file by its size and modification time."""
+    st = os.stat(filename)
+    return {'parser': PARSER_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def load_obj_arrays(filename, cache=True):
+    """
+    Like parse_obj, but reuses a binary cache of the parsed arrays when the OBJ
+    file has not changed since it was written (same size and mtime), in which
+    case the arrays are read-only memory maps of the cache file.
+    The cache is (re)written after every parse; pass cache=False to bypass it.
+    """
+    if not cache:
+        return parse_obj(filename)
+    key = source_key(filename)
+    path = cache_path(filename)
+    found = load_arrays(path)
+    if found is not None:
+        meta, arrays = found
+        if meta == key and set(arrays) == {'vertices', 'faces'}:
+            return arrays['vertices'], arrays['faces']
+
+    vertices, faces = parse_obj(filename)
+    try:
+        save_arrays(path, {'vertices': vertices, 'faces': faces}, key)
+    except OSError:
+        pass  # e.g. a read-only directory; the cache is only an optimization
+    return vertices, faces
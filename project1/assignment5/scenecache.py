@@ -0,0 +1,55 @@
+"""
+On-disk cache of a built scene: the triangle mesh arrays and the flat BVH over
+them, stored in one array file (see arrayfile.py) that later runs memory-map
+instead of rebuilding.
+
+The file records a caller-supplied key describing how the scene was made
+(source file, builder settings). A cache is only used when its
+format version, key and data checksum all match.
+"""
+from assignment5.arrayfile import load_arrays, save_arrays
+from assignment5.bvh import FlatBVH
+from assignment5.compact import CompactBVH
+from assignment5.mesh import MESH_ARRAYS, TriangleMesh
+
+# Bump when the layout of the cached arrays or the BVH builders change.
+FORMAT_VERSION = 2
+
+BVH_ARRAYS = ('bounds', 'offsets', 'counts', 'axes', 'prim_indices')
+COMPACT_ARRAYS = ('root', 'boxes', 'offsets', 'counts', 'axes', 'prim_indices')
+
+
+def save_scene(path, key, mesh, bvh):
+    """
+    Writes the mesh and its BVH (a FlatBVH or CompactBVH) to path, tagged
+    with key (a JSON-able dict).
+    """
+    arrays = {}
+    for name, a in mesh.arrays().items():
+        arrays['mesh.' + name] = a
+    for name in COMPACT_ARRAYS if isinstance(bvh, CompactBVH) else BVH_ARRAYS:
+        arrays['bvh.' + name] = getattr(bvh, name)
+    save_arrays(path, arrays, {'format': FORMAT_VERSION, 'key': key})
+
+
+def load_scene(path, key, materials, verify=True):
+    """
+    Returns (mesh, bvh) memory-mapped from a cache written by save_scene for
+    the same key, or None if there is no usable cache. Materials are not
+    cached and are supplied by the caller.
+    """
+    found = load_arrays(path, verify=verify)
+    if found is None:
+        return None
+    meta, arrays = found
+    if meta != {'format': FORMAT_VERSION, 'key': key}:
+        return None
+    compact = 'bvh.boxes' in arrays
+    bvh_arrays = COMPACT_ARRAYS if compact else BVH_ARRAYS
+    names = {'mesh.' + name for name in MESH_ARRAYS} | {'bvh.' + name for name in bvh_arrays}
+    if set(arrays) != names:
+        return None
+    mesh = TriangleMesh.from_arrays({name: arrays['mesh.' + name] for name in MESH_ARRAYS},
+                                    materials)
+    bvh = (CompactBVH if compact else FlatBVH)(*(arrays['bvh.' + name] for name in bvh_arrays))
+    return mesh, bvh
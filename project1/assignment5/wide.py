@@ -0,0 +1,266 @@
+"""
+4-wide BVH collapsed from a binary FlatBVH.
+
+A binary BVH makes a ray test one box at a time down a deep tree. A
+WideBVH node has up to four children, so the tree is about half as deep,
+and the boxes of the four children are stored side by side (per node, a
+6 x 4 block: min x, y, z then max x, y, z, one column per child). One
+vectorized slab test over the block gives the entry distance of all four
+children at once, and the children the ray enters come back sorted by
+distance.
+
+collapse_bvh builds the wide tree from any binary FlatBVH (SAH, LBVH,
+parallel build): every wide node starts with the two children of a binary
+node and keeps opening its interior child with the largest surface area
+until it has four children. Leaves and prim_indices are those of the
+binary tree, so the leaf tests are unchanged.
+
+wide_closest and wide_occluded work like bvh_closest and bvh_occluded. A
+ray visits about a quarter as many nodes as in the binary tree, but every
+numpy call has a fixed cost of around a microsecond, so in Python one wide
+node test costs more than the scalar box tests it saves and a query is
+slower overall (see benchmarks/wide.py). The layout is the one a compiled
+SIMD traversal would use.
+"""
+import numpy as np
+
+import render.stats
+from assignment5.bvh import INF, PARALLEL_EPSILON, surface_area
+
+WIDTH = 4
+
+
+class WideBVH:
+    def __init__(self, root, bounds, offsets, counts, prim_indices):
+        """
+        root: (6,) float64 - box of the whole tree, min x, y, z then max x, y, z
+        bounds: (n_nodes, 6, 4) float64 - boxes of the children of every node,
+                one column per child; unused columns are NaN, which no slab
+                test passes
+        offsets: (n_nodes, 4) int32 - leaf child: first entry in prim_indices,
+                 interior child: its node number
+        counts: (n_nodes, 4) int32 - leaf child: number of primitives,
+                interior or unused child: 0
+        prim_indices: (n_prims,) int32 - primitive numbers in leaf order
+        """
+        self.root = np.ascontiguousarray(root, dtype=np.float64).reshape(6)
+        self.bounds = np.ascontiguousarray(bounds, dtype=np.float64).reshape(-1, 6, WIDTH)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int32).reshape(-1, WIDTH)
+        self.counts = np.ascontiguousarray(counts, dtype=np.int32).reshape(-1, WIDTH)
+        self.prim_indices = np.ascontiguousarray(prim_indices, dtype=np.int32)
+        self._make_views()
+
+    def _make_views(self):
+        self.root_box = tuple(self.root.tolist())
+        self.offsets_view = memoryview(self.offsets.reshape(-1))
+        self.counts_view = memoryview(self.counts.reshape(-1))
+        self.prims_view = memoryview(self.prim_indices)
+
+    def __getstate__(self):
+        return {'root': self.root, 'bounds': self.bounds, 'offsets': self.offsets,
+                'counts': self.counts, 'prim_indices': self.prim_indices}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def nbytes(self):
+        """Total size of the node and primitive arrays in bytes."""
+        return (self.root.nbytes + self.bounds.nbytes + self.offsets.nbytes
+                + self.counts.nbytes + self.prim_indices.nbytes)
+
+    def root_bounds(self):
+        """Box of the whole tree as a (2, 3) array of min and max corners."""
+        return self.root.reshape(2, 3)
+
+
+def collapse_bvh(bvh):
+    """Returns the WideBVH collapsed from the binary FlatBVH bvh."""
+    area = surface_area(bvh.bounds[:, :3], bvh.bounds[:, 3:])
+    interior = bvh.counts == 0
+    # Binary nodes that are the children of every wide node of the current
+    # level, -1 in unused columns; the root stands alone if it is a leaf.
+    level = np.array([[1, bvh.offsets[0], -1, -1]] if interior[0] else [[0, -1, -1, -1]])
+    levels = []
+    n_nodes = 1
+    while len(level):
+        filled = (level >= 0).sum(axis=1)
+        for _ in range(WIDTH - 2):
+            # Open the largest interior child of every node that has room.
+            child = np.maximum(level, 0)
+            score = np.where((level >= 0) & interior[child], area[child], -1.0)
+            pick = np.argmax(score, axis=1)
+            opened = level[np.arange(len(level)), pick]
+            room = (score.max(axis=1) >= 0) & (filled < WIDTH)
+            rows = np.flatnonzero(room)
+            level[rows, pick[rows]] = opened[rows] + 1
+            level[rows, filled[rows]] = bvh.offsets[opened[rows]]
+            filled += room
+        child = np.maximum(level, 0)
+        inner = (level >= 0) & interior[child]
+        ids = np.full(level.shape, -1, dtype=np.int64)
+        ids[inner] = n_nodes + np.arange(int(inner.sum()))
+        n_nodes += int(inner.sum())
+        levels.append((level, ids))
+        opened = level[inner]
+        level = np.stack((opened + 1, bvh.offsets[opened], np.full(len(opened), -1),
+                          np.full(len(opened), -1)), axis=1)
+
+    level = np.concatenate([lv for lv, _ in levels])
+    ids = np.concatenate([i for _, i in levels])
+    used = level >= 0
+    child = np.maximum(level, 0)
+    bounds = np.where(used[:, None, :], bvh.bounds[child].transpose(0, 2, 1), np.nan)
+    leaf = used & ~interior[child]
+    offsets = np.where(leaf, bvh.offsets[child], np.maximum(ids, 0))
+    counts = np.where(leaf, bvh.counts[child], 0)
+    return WideBVH(bvh.bounds[0], bounds, offsets, counts, bvh.prim_indices)
+
+
+def _child_entries(bvh, origin, direction, t_min, parallel_epsilon):
+    """
+    Returns (enter, enter_root) for this ray. enter(node, t_max) tests the
+    four children of a node in one go and returns the columns of those the
+    ray enters within (t_min, t_max) with their entry distances, as two lists
+    sorted by distance. enter_root(t_max) is the entry distance into the
+    root box, or inf. Direction components below parallel_epsilon count as
+    parallel to a slab, as in _box_entry.
+    """
+    bounds = bvh.bounds
+    origin = (origin.x, origin.y, origin.z)
+    direction = (direction.x, direction.y, direction.z)
+    flat = [abs(d) < parallel_epsilon for d in direction]
+    inv = [0.0 if f else 1.0 / d for f, d in zip(flat, direction)]
+    # Rows of the near planes (the min side where the direction is positive)
+    # and then of the far planes, so no min/max of plane pairs is needed.
+    near = [axis + 3 if direction[axis] < 0 else axis for axis in range(3)]
+    rows = np.array(near + [(row + 3) % 6 for row in near])
+    o6 = np.array(origin + origin)[:, None]
+    inv6 = np.array(inv + inv)[:, None]
+    axes = np.flatnonzero(flat)
+    any_flat = len(axes) > 0
+    if any_flat:
+        o_flat = o6[axes]
+    maximum = np.maximum
+    minimum = np.minimum
+
+    def enter(node, hi):
+        box = bounds[node]
+        t = (box[rows] - o6) * inv6
+        if any_flat:
+            t[axes] = -INF
+            t[axes + 3] = INF
+        lo = maximum(maximum(maximum(t[0], t[1]), t[2]), t_min)
+        hit = lo <= minimum(minimum(minimum(t[3], t[4]), t[5]), hi)
+        if any_flat:
+            hit &= ((box[axes] <= o_flat) & (o_flat <= box[axes + 3])).all(axis=0)
+        columns = np.flatnonzero(hit)
+        if len(columns) > 1:
+            columns = columns[lo[columns].argsort(kind='stable')]
+        return columns.tolist(), lo[columns].tolist()
+
+    def enter_root(hi):
+        box = bvh.root_box
+        lo = t_min
+        for axis in range(3):
+            o = origin[axis]
+            if flat[axis]:
+                if o < box[axis] or o > box[axis + 3]:
+                    return INF
+                continue
+            t0 = (box[axis] - o) * inv[axis]
+            t1 = (box[axis + 3] - o) * inv[axis]
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > lo:
+                lo = t0
+            if t1 < hi:
+                hi = t1
+            if hi < lo:
+                return INF
+        return lo
+
+    stats = render.stats.active
+    if stats is not None:
+        return stats.count_nodes(enter), enter_root
+    return enter, enter_root
+
+
+def wide_closest(bvh, origin, direction, t_min, t_max, intersect,
+                 parallel_epsilon=PARALLEL_EPSILON):
+    """
+    Closest-hit query on a WideBVH; arguments and result as for bvh_closest.
+    The children a ray enters are pushed farthest first, so the nearest is
+    opened next and leaves are tested front to back.
+    """
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter, enter_root = _child_entries(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    closest_t = t_max
+    closest = -1
+    entry = enter_root(t_max)
+    if entry == INF:
+        return None
+    # Entries are (entry distance, offset, count), as in the node arrays.
+    stack = [(entry, 0, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        entry, offset, count = pop()
+        if entry > closest_t:
+            continue
+        if count:
+            for k in range(offset, offset + count):
+                prim = prims[k]
+                t = intersect(prim, origin, direction, t_min, closest_t)
+                if t < closest_t:
+                    closest_t = t
+                    closest = prim
+        else:
+            columns, entries = enter(offset, closest_t)
+            base = WIDTH * offset
+            for k in range(len(columns) - 1, -1, -1):
+                slot = base + columns[k]
+                push((entries[k], offsets[slot], counts[slot]))
+
+    if closest < 0:
+        return None
+    return (closest, closest_t)
+
+
+def wide_occluded(bvh, origin, direction, t_min, t_max, intersect,
+                  parallel_epsilon=PARALLEL_EPSILON):
+    """Any-hit query on a WideBVH; arguments and result as for bvh_occluded."""
+    offsets = bvh.offsets_view
+    counts = bvh.counts_view
+    prims = bvh.prims_view
+    enter, enter_root = _child_entries(bvh, origin, direction, t_min, parallel_epsilon)
+    if render.stats.active is not None:
+        intersect = render.stats.active.count_tests(intersect)
+
+    if enter_root(t_max) == INF:
+        return False
+    stack = [0]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        base = WIDTH * node
+        for column in enter(node, t_max)[0]:
+            slot = base + column
+            count = counts[slot]
+            if count:
+                first = offsets[slot]
+                for k in range(first, first + count):
+                    if intersect(prims[k], origin, direction, t_min, t_max) < t_max:
+                        return True
+            else:
+                push(offsets[slot])
+    return False
@@ -0,0 +1,142 @@
+"""
+Per-frame BVH cost of an animated bunny: full SAH rebuild against refitting.
+
+The animations are timed frame by frame:
+- two deforming bunnies, kept up to date three ways: a full build_bvh_sah
+  per frame, refit_bvh alone, and AnimatedBVH.update, which refits and
+  only rebuilds the subtrees that degraded. The SAH cost of every tree is
+  reported, so the quality lost to refitting is visible. In the first, a
+  gentle wave runs through the whole mesh and refitting keeps up. In the
+  second, the vertices around the tip of an ear burst apart, which
+  degrades the subtrees over that region until update rebuilds them;
+- a field of rigidly moving bunny instances, where only the top-level BVH
+  changes: a new InstanceScene per frame against set_transform plus
+  InstanceScene.update.
+
+Run from the project1 directory:
+    python3 benchmarks/refit.py
+    python3 benchmarks/refit.py --frames 60 --amplitude 0.05 --burst 0.2
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from assignment5.bvh import AnimatedBVH, build_bvh_sah, refit_bvh, sah_costs
+from assignment5.instance import Instance, InstanceScene, affine
+from assignment5.mesh import TriangleMesh
+from assignment5.objfile import load_obj_arrays
+
+BUNNY = os.path.join(os.path.dirname(__file__), '..', 'assignment5', 'bunny.obj')
+
+
+def wave(amplitude):
+    """Motion of a wave travelling up the mesh; amplitude is relative to its size."""
+    def move(vertices, frame, frames):
+        lo = vertices.min(axis=0)
+        size = vertices.max(axis=0) - lo
+        height = (vertices[:, 1] - lo[1]) / size[1]
+        moved = vertices.copy()
+        moved[:, 0] += amplitude * size[0] * np.sin(2 * math.pi * (2 * height - frame / 12))
+        moved[:, 2] += amplitude * size[2] * np.cos(2 * math.pi * (3 * height - frame / 12))
+        return moved
+    return move
+
+
+def burst(amplitude, radius=0.25):
+    """
+    Motion of the vertices within radius (relative to the mesh size) of the
+    top of the mesh flying apart, each in its own random direction, until
+    they are amplitude times the mesh size away in the last frame.
+    """
+    def move(vertices, frame, frames):
+        size = (vertices.max(axis=0) - vertices.min(axis=0)).max()
+        tip = vertices[np.argmax(vertices[:, 1])]
+        region = np.linalg.norm(vertices - tip, axis=1) < radius * size
+        directions = np.random.default_rng(1).normal(size=(int(region.sum()), 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        moved = vertices.copy()
+        moved[region] += directions * (amplitude * size * frame / frames)
+        return moved
+    return move
+
+
+def deforming(title, motion, frames, threshold):
+    vertices, faces = load_obj_arrays(BUNNY)
+    mesh = TriangleMesh(vertices, faces, [])
+    refit = build_bvh_sah(*mesh.bounds())
+    animated = AnimatedBVH(build_bvh_sah(*mesh.bounds()), threshold)
+    rebuild_time = refit_time = update_time = 0.0
+    print(f"{title} ({len(faces)} triangles)")
+    print(f"{'frame':>5}{'rebuild ms':>12}{'refit ms':>10}{'update ms':>11}{'SAH rebuilt':>13}"
+          f"{'SAH refit':>11}{'SAH update':>12}{'subtrees':>10}")
+    for frame in range(1, frames + 1):
+        mesh.set_vertices(motion(vertices, frame, frames))
+        bounds = mesh.bounds()
+        started = time.perf_counter()
+        rebuilt = build_bvh_sah(*bounds)
+        rebuild = time.perf_counter() - started
+        started = time.perf_counter()
+        refit_bvh(refit, bounds[0], bounds[1])
+        refitting = time.perf_counter() - started
+        started = time.perf_counter()
+        updated = animated.update(*bounds)
+        updating = time.perf_counter() - started
+        rebuild_time += rebuild
+        refit_time += refitting
+        update_time += updating
+        print(f"{frame:>5}{rebuild * 1e3:>12.2f}{refitting * 1e3:>10.2f}{updating * 1e3:>11.2f}"
+              f"{sah_costs(rebuilt)[0]:>13.2f}{sah_costs(refit)[0]:>11.2f}"
+              f"{sah_costs(updated)[0]:>12.2f}{animated.rebuilds:>10}")
+    print(f"{title}: {rebuild_time / frames * 1e3:.2f} ms per frame rebuilding, "
+          f"{refit_time / frames * 1e3:.2f} ms refitting, {update_time / frames * 1e3:.2f} ms "
+          f"updating ({animated.rebuilds} subtree rebuilds, {animated.full_rebuilds} full)")
+
+
+def rigid(frames, count):
+    vertices, faces = load_obj_arrays(BUNNY)
+    mesh = TriangleMesh(vertices, faces, [])
+    bvh = build_bvh_sah(*mesh.bounds())
+
+    def placements(frame):
+        for k in range(count):
+            angle = 2 * math.pi * k / count + frame / 20
+            yield affine(3.5, math.degrees(angle) + frame * 5), \
+                (3 * math.cos(angle), 0.5 * math.sin(frame / 5 + k), 8 + 3 * math.sin(angle))
+
+    instances = [Instance(mesh, bvh, m, t) for m, t in placements(0)]
+    scene = InstanceScene(instances)
+    rebuild_time = refit_time = 0.0
+    for frame in range(1, frames + 1):
+        moves = list(placements(frame))
+        started = time.perf_counter()
+        InstanceScene([Instance(mesh, bvh, m, t) for m, t in moves])
+        rebuild_time += time.perf_counter() - started
+        started = time.perf_counter()
+        for inst, (m, t) in zip(instances, moves):
+            inst.set_transform(m, t)
+        scene.update()
+        refit_time += time.perf_counter() - started
+    print(f"{count} moving instances: {rebuild_time / frames * 1e3:.2f} ms per frame with a new "
+          f"scene, {refit_time / frames * 1e3:.2f} ms with set_transform and update")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare BVH rebuilds and refits per frame.")
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--amplitude", type=float, default=0.03,
+                        help="wave amplitude as a fraction of the bunny size")
+    parser.add_argument("--burst", type=float, default=0.1,
+                        help="distance the bursting vertices travel, as a fraction of the bunny size")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="SAH cost growth at which a subtree is rebuilt")
+    parser.add_argument("--instances", type=int, default=50)
+    args = parser.parse_args()
+    deforming("Waving bunny", wave(args.amplitude), args.frames, args.threshold)
+    deforming("Bursting bunny", burst(args.burst), args.frames, args.threshold)
+    rigid(args.frames, args.instances)
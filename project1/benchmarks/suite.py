@@ -0,0 +1,345 @@
+"""
+Benchmark suite for the ray tracers.
+
+Times the core kernels (ray-sphere, ray-triangle, ray-cylinder and ray-box
+tests as the renderers call them, the median-split and SAH BVH builds) and renders every scene at
+reduced resolution. A reduced render traces every `stride`-th pixel of
+every `stride`-th row of the full image, so each sample can be checked
+against the same pixel of the scene's reference PNG. A render passes when
+at most --max-mismatch of its samples differ from the reference by more
+than --tolerance in some channel; otherwise the suite exits with status 1.
+
+The project scene is random and its PNGs are not reproducible, so it is
+rendered with a fixed seed and only timed. Every render also records a
+digest of its samples, which tells whether an image changed between two
+result files.
+
+Results are written as JSON (sorted keys, one value per line) so two runs
+can be diffed or compared with --compare, which prints the speed-up of
+every benchmark.
+
+Run from the project1 directory:
+    python3 benchmarks/suite.py
+    python3 benchmarks/suite.py --stride 2 --output after.json --compare before.json
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+PROJECT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+REPOSITORY = os.path.dirname(PROJECT)
+sys.path.append(PROJECT)
+
+import render.grid
+from assignment5.bvh import PARALLEL_EPSILON, _box_entry
+from assignment5.mesh import Material, triangle_intersector
+from assignment1.color import Color
+from assignment1.vec import Vec
+
+# Seed of the project scene.
+PROJECT_SEED = 1
+
+_modules = {}
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def load_main(name, directory):
+    """
+    Imports directory/main.py as module `name` (once), with the directory on
+    sys.path and as working directory, as when the script is run from there.
+    """
+    if name in _modules:
+        return _modules[name]
+    directory = os.path.join(REPOSITORY, directory)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    with working_directory(directory):
+        spec.loader.exec_module(module)
+    _modules[name] = module
+    return module
+
+
+def time_call(function, *args, number=None, repeat=5):
+    """Best time in seconds of one call, over repeat rounds of number calls."""
+    timer = timeit.Timer(lambda: function(*args))
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def bunny_triangles(a5):
+    mesh = a5.load_mesh(os.path.join(REPOSITORY, 'project1', 'assignment5', 'bunny.obj'),
+                        Material(Color(255, 255, 255), specular=10, reflective=0.2))
+    return mesh, a5.mesh_triangles(mesh)
+
+
+def kernel_benchmarks():
+    """name -> (function, args, calls per round or None to choose)"""
+    project = load_main('bench_project', 'project1')
+    a5 = load_main('bench_assignment5', 'project1/assignment5')
+    inclass = load_main('bench_inclass', 'inclass_assessment')
+
+    sphere = project.spheres[-3]
+    origin = project.camera_position
+    to_sphere = sphere.center.sub(origin)
+
+    mesh, tris = bunny_triangles(a5)
+    index = len(tris) // 2
+    triangle = tris[index]
+    eye = Vec(0, 0.1, 1)
+    to_triangle = triangle.v0.add(triangle.v1).add(triangle.v2).div(3).sub(eye)
+    bbox_min, bbox_max = a5.compute_bbox_for_triangles(tris)
+    to_box = bbox_min.add(bbox_max).div(2).sub(eye)
+    # The BVH slab test of the renderer, on the root box of the bunny.
+    enter = _box_entry(a5.build_bvh_sah(*mesh.bounds()), eye, to_box, a5.EPSILON,
+                       PARALLEL_EPSILON)
+
+    cylinder = inclass.cylinders[0]
+    to_cylinder = cylinder.base.add(cylinder.axis.mul(cylinder.height / 2)).sub(inclass.camera_position)
+
+    return {
+        'intersect_ray_sphere': (project.intersect_ray_sphere, (origin, to_sphere, sphere), None),
+        'triangle_intersector': (triangle_intersector(mesh),
+                                 (index, eye, to_triangle, a5.EPSILON, float('inf')), None),
+        'box_entry': (enter, (0, float('inf')), None),
+        'intersect_ray_cylinder': (inclass.intersect_ray_cylinder,
+                                   (inclass.camera_position, to_cylinder, cylinder), None),
+        # build_bvh sorts its list, so every call gets a fresh copy.
+        'build_bvh': (lambda: a5.build_bvh(list(tris)), (), 1),
+        'build_bvh_sah': (a5.build_bvh_sah, mesh.bounds(), 1),
+        'build_lbvh': (a5.build_lbvh, mesh.bounds(), 1),
+    }
+
+
+def clamp(color):
+    return bytes((max(min(int(color.r), 255), 0),
+                  max(min(int(color.g), 255), 0),
+                  max(min(int(color.b), 255), 0)))
+
+
+def canvas_pixel(module, rotate=False, depth=()):
+    """Per-pixel renderer of assignments 2-4, whose render_scene renders the whole image."""
+    def pixel(fx, fy):
+        direction = module.canvas_to_viewport(fx - module.WIDTH // 2, module.HEIGHT // 2 - fy - 1)
+        if rotate:
+            direction = module.multiply_mv(module.camera_rotation, direction)
+        return clamp(module.trace_ray(module.camera_position, direction, 1.0, float('inf'), *depth))
+    return pixel
+
+
+def tile_pixel(module):
+    def pixel(fx, fy):
+        return module.render_tile(fx, fy, fx + 1, fy + 1).tobytes()
+    return pixel
+
+
+def setup_render(name):
+    """
+    Loads the scene `name` and returns (width, height, pixel, reference PNG
+    or None), pixel(fx, fy) being the RGB bytes of pixel (fx, fy).
+    """
+    if name == 'project':
+        project = load_main('bench_project', 'project1')
+        random.seed(PROJECT_SEED)
+        spheres = project.random_spheres()
+        project.set_scene(spheres, render.grid.SphereGrid(spheres))
+        return project.WIDTH, project.HEIGHT, tile_pixel(project), None
+    if name == 'assignment5':
+        a5 = load_main('bench_assignment5', 'project1/assignment5')
+        with working_directory(os.path.dirname(a5.__file__)):
+            a5.build_scene()
+        return a5.WIDTH, a5.HEIGHT, tile_pixel(a5), 'project1/assignment5/bunny.png'
+    if name == 'inclass':
+        inclass = load_main('bench_inclass', 'inclass_assessment')
+        with working_directory(os.path.dirname(inclass.__file__)):
+            inclass.build_scene()
+        return (inclass.WIDTH, inclass.HEIGHT, tile_pixel(inclass),
+                'inclass_assessment/inclass_assessment.png')
+    number = name[-1]
+    module = load_main(f'bench_{name}', f'project1/{name}')
+    if name == 'assignment2':
+        pixel = canvas_pixel(module)
+    elif name == 'assignment3':
+        pixel = canvas_pixel(module, depth=(module.RECURSION_DEPTH,))
+    else:
+        pixel = canvas_pixel(module, rotate=True, depth=(module.RECURSION_DEPTH,))
+    return module.WIDTH, module.HEIGHT, pixel, f'project1/{name}/assignment_{number}_output.png'
+
+
+def render_sampled(pixel, width, height, stride):
+    """(rows, columns, 3) uint8 array of every stride-th pixel of every stride-th row."""
+    data = bytearray()
+    for fy in range(0, height, stride):
+        for fx in range(0, width, stride):
+            data += pixel(fx, fy)
+    return np.frombuffer(bytes(data), dtype=np.uint8).reshape(len(range(0, height, stride)), -1, 3)
+
+
+def render_assignment1():
+    """
+    Assignment 1 renders when its script runs, so it is run whole in a
+    scratch directory. Returns (seconds, image).
+    """
+    script = os.path.join(PROJECT, 'assignment1', 'main.py')
+    with tempfile.TemporaryDirectory() as scratch:
+        started = time.perf_counter()
+        subprocess.run([sys.executable, script], cwd=scratch, check=True)
+        seconds = time.perf_counter() - started
+        with Image.open(os.path.join(scratch, 'assignment_1_output.png')) as image:
+            return seconds, np.asarray(image.convert('RGB'))
+
+
+def compare_images(image, reference, tolerance):
+    """(fraction of pixels off by more than tolerance, largest channel difference)"""
+    difference = np.abs(image.astype(np.int16) - reference.astype(np.int16)).max(axis=2)
+    return float((difference > tolerance).mean()), int(difference.max())
+
+
+def run_render(name, stride, tolerance, max_mismatch):
+    if name == 'assignment1':
+        # The script includes interpreter start-up and PNG encoding.
+        seconds, image = render_assignment1()
+        result = {'seconds': seconds, 'setup_seconds': 0.0, 'stride': 1}
+        reference = 'project1/assignment1/assignment_1_output.png'
+    else:
+        started = time.perf_counter()
+        width, height, pixel, reference = setup_render(name)
+        setup = time.perf_counter() - started
+        started = time.perf_counter()
+        image = render_sampled(pixel, width, height, stride)
+        seconds = time.perf_counter() - started
+        result = {'seconds': seconds, 'setup_seconds': setup, 'stride': stride}
+    samples = image.shape[0] * image.shape[1]
+    result.update(samples=samples, samples_per_second=samples / seconds,
+                  digest=hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest())
+    if reference is not None:
+        with Image.open(os.path.join(REPOSITORY, reference)) as golden:
+            golden = np.asarray(golden.convert('RGB'))
+        step = result['stride']
+        mismatch, largest = compare_images(image, golden[::step, ::step], tolerance)
+        result.update(reference=reference, mismatch=mismatch, max_difference=largest,
+                      passed=mismatch <= max_mismatch)
+    return result
+
+
+RENDERS = ('assignment1', 'assignment2', 'assignment3', 'assignment4', 'assignment5',
+           'inclass', 'project')
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(old, new):
+    """Old and new time of every benchmark in both result files, and the speed-up."""
+    print(f"\n{'benchmark':<28}{'before':>12}{'after':>12}{'speed-up':>10}")
+    for group in ('kernels', 'renders'):
+        for name, result in new[group].items():
+            before = old.get(group, {}).get(name)
+            if before is None:
+                continue
+            if group == 'kernels':
+                then, now = before, result
+            else:
+                then, now = before['seconds'], result['seconds']
+            line = f"{name:<28}{then:>12.3g}{now:>12.3g}{then / now:>9.2f}x"
+            if group == 'renders' and before.get('stride') == result['stride'] \
+                    and before['digest'] != result['digest']:
+                line += "  image changed"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the ray tracers and check their images.")
+    parser.add_argument("--stride", type=int, default=4,
+                        help="render every n-th pixel of every n-th row (default 4)")
+    parser.add_argument("--tolerance", type=int, default=2,
+                        help="largest channel difference from the reference that still matches")
+    parser.add_argument("--max-mismatch", type=float, default=0.001,
+                        help="fraction of pixels that may differ by more than the tolerance")
+    parser.add_argument("--only", nargs="+", metavar="NAME",
+                        help="run only these kernels and renders")
+    parser.add_argument("--output", default=os.path.join(PROJECT, 'benchmarks', 'results.json'),
+                        help="JSON file for the results")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    def selected(name):
+        return args.only is None or name in args.only
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'stride': args.stride, 'tolerance': args.tolerance,
+                     'max_mismatch': args.max_mismatch},
+        'kernels': {},
+        'renders': {},
+    }
+
+    kernels = kernel_benchmarks()
+    for name, (function, call_args, number) in kernels.items():
+        if selected(name):
+            seconds = time_call(function, *call_args, number=number,
+                                repeat=3 if number == 1 else 5)
+            results['kernels'][name] = seconds
+            print(f"{name:<28}{seconds * 1e6:>14.2f} us")
+
+    failed = []
+    for name in RENDERS:
+        if not selected(name):
+            continue
+        result = run_render(name, args.stride, args.tolerance, args.max_mismatch)
+        results['renders'][name] = result
+        line = f"{name:<28}{result['seconds']:>14.2f} s  {result['samples_per_second']:>9.0f} pixels/s"
+        if 'passed' in result:
+            line += (f"  {result['mismatch']:.2%} off, max {result['max_difference']}  "
+                     + ("ok" if result['passed'] else "FAILED"))
+            if not result['passed']:
+                failed.append(name)
+        print(line)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.write("\n")
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    if failed:
+        print("Images differ from the reference: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
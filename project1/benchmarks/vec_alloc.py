@@ -0,0 +1,116 @@
+"""
+Micro-benchmark of the Vec/Color math core.
+
+Reports the size of a slotted Vec against the old dict-backed layout, the
+objects allocated and the time taken by one ray hit (hit point, normal,
+view, lighting vectors, reflection and color blend) written with the
+unfused operations the tracers used before and with the fused ones they
+use now, and the Vec/Color allocations per primary ray of the project
+renderer.
+
+Run from the project1 directory:
+    python3 benchmarks/vec_alloc.py
+"""
+import os
+import sys
+import timeit
+from contextlib import contextmanager
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from assignment1.vec import Vec
+from assignment1.color import Color
+
+
+class DictVec:
+    """The previous Vec layout: a plain class with a per-instance __dict__."""
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+@contextmanager
+def count_instances(*classes):
+    """Counts the objects of the given classes created inside the block."""
+    counts = {cls.__name__: 0 for cls in classes}
+    originals = {cls: cls.__init__ for cls in classes}
+
+    def counting(cls, init):
+        def __init__(self, *args):
+            counts[cls.__name__] += 1
+            init(self, *args)
+        return __init__
+
+    for cls, init in originals.items():
+        cls.__init__ = counting(cls, init)
+    try:
+        yield counts
+    finally:
+        for cls, init in originals.items():
+            cls.__init__ = init
+
+
+def shade_unfused(origin, direction, t, center, light, color, reflected):
+    point = origin.add(direction.mul(t))
+    normal = point.sub(center).div(point.sub(center).length())
+    view = direction.mul(-1)
+    L = light.sub(point)
+    R = normal.mul(2 * normal.dot(L)).sub(L)
+    reflected_ray = normal.mul(2 * view.dot(normal)).sub(view)
+    lighting = normal.dot(L) / (normal.length() * L.length()) + R.dot(view) / R.length()
+    return color.mul(lighting).mul(1 - 0.3).add(reflected.mul(0.3)), reflected_ray
+
+
+def shade_fused(origin, direction, t, center, light, color, reflected):
+    point = origin.madd(direction, t)
+    normal = point.direction_from(center)
+    view = direction.neg()
+    L = light.sub(point)
+    R = L.reflect(normal)
+    reflected_ray = view.reflect(normal)
+    lighting = normal.dot(L) / (normal.length() * L.length()) + R.dot(view) / R.length()
+    return color.mul(lighting).blend(reflected, 0.3), reflected_ray
+
+
+def object_sizes():
+    v = Vec(1.0, 2.0, 3.0)
+    d = DictVec(1.0, 2.0, 3.0)
+    print("Vec object size:     %4d bytes" % sys.getsizeof(v))
+    print("DictVec object size: %4d bytes (including its __dict__)"
+          % (sys.getsizeof(d) + sys.getsizeof(d.__dict__)))
+    print("Vec(...) construction:     %.0f ns"
+          % (min(timeit.repeat(lambda: Vec(1.0, 2.0, 3.0), number=200000, repeat=5)) / 2e-4))
+    print("DictVec(...) construction: %.0f ns"
+          % (min(timeit.repeat(lambda: DictVec(1.0, 2.0, 3.0), number=200000, repeat=5)) / 2e-4))
+
+
+def hit_shading():
+    args = (Vec(0, 0, 0), Vec(0.1, 0.2, 1.0), 4.5, Vec(0, 0, 6), Vec(2, 1, 0),
+            Color(255, 0, 0), Color(10, 20, 30))
+    (c1, r1), (c2, r2) = shade_unfused(*args), shade_fused(*args)
+    assert (c1.r, c1.g, c1.b, r1.x, r1.y, r1.z) == (c2.r, c2.g, c2.b, r2.x, r2.y, r2.z)
+    for name, shade in (("unfused", shade_unfused), ("fused", shade_fused)):
+        with count_instances(Vec, Color) as counts:
+            shade(*args)
+        seconds = min(timeit.repeat(lambda: shade(*args), number=20000, repeat=5)) / 20000
+        print("%-8s hit: %2d Vec + %d Color allocations, %.2f us"
+              % (name, counts['Vec'], counts['Color'], seconds * 1e6))
+
+
+def renderer_rays(size=16):
+    import main
+    x0 = (main.WIDTH - size) // 2
+    y0 = (main.HEIGHT - size) // 2
+    with count_instances(Vec, Color) as counts:
+        main.render_tile(x0, y0, x0 + size, y0 + size)
+    rays = size * size
+    print("project renderer: %.1f Vec + %.1f Color allocations per primary ray "
+          "(%dx%d tile at the image center)" % (counts['Vec'] / rays, counts['Color'] / rays,
+                                               size, size))
+
+
+if __name__ == "__main__":
+    object_sizes()
+    hit_shading()
+    renderer_rays()
@@ -0,0 +1,109 @@
+"""
+Binary against 4-wide BVH traversal on the bunny and the cover scene.
+
+The bunny scene is the assignment 5 mesh placed as in its render; the cover
+scene is this project's field of random spheres (seeded), with one BVH
+leaf per sphere. For both, a SAH FlatBVH is built and collapsed into a
+WideBVH, and the primary rays of every `stride`-th pixel are traced through
+each: closest hits and any-hit queries. The results must agree ray by ray.
+
+Reported per tree: node count and size, query time per ray, and node
+visits per ray. A binary visit slab-tests one box, a wide visit tests the
+four child boxes of a node in one vectorized test.
+
+Run from the project1 directory:
+    python3 benchmarks/wide.py
+    python3 benchmarks/wide.py --stride 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from suite import PROJECT_SEED, load_main
+
+import render.stats
+from assignment5.bvh import build_bvh_sah, bvh_closest, bvh_occluded
+from assignment5.mesh import triangle_intersector
+from assignment5.wide import collapse_bvh, wide_closest, wide_occluded
+
+
+def bunny_scene(stride):
+    """(FlatBVH, leaf test, rays) of the assignment 5 bunny in world space."""
+    a5 = load_main('bench_assignment5', 'project1/assignment5')
+    mesh = a5.load_mesh(os.path.join(os.path.dirname(a5.__file__), 'bunny.obj'), None)
+    mesh.set_vertices(mesh.vertices * 15.0 + np.array([0, -1.5, 4]))
+    rays = []
+    for fy in range(0, a5.HEIGHT, stride):
+        for fx in range(0, a5.WIDTH, stride):
+            direction = a5.canvas_to_viewport(fx - a5.WIDTH // 2, a5.HEIGHT // 2 - fy - 1)
+            rays.append((a5.camera_position, direction, 1.0))
+    return build_bvh_sah(*mesh.bounds()), triangle_intersector(mesh), rays
+
+
+def cover_scene(stride):
+    """(FlatBVH, leaf test, rays) of the project's random sphere field."""
+    random.seed(PROJECT_SEED)
+    project = load_main('bench_project', 'project1')
+    project.spheres[:] = project.random_spheres()
+    centers = np.array([(s.center.x, s.center.y, s.center.z) for s in project.spheres])
+    radii = np.array([s.radius for s in project.spheres])[:, None]
+    rays = []
+    for j in range(0, project.HEIGHT, stride):
+        for i in range(0, project.WIDTH, stride):
+            direction = project.canvas_to_viewport(i - project.WIDTH / 2, project.HEIGHT / 2 - j - 1)
+            direction = project.multiply_mv(project.camera_rotation, direction)
+            rays.append((project.camera_position, direction, 1.0))
+    return build_bvh_sah(centers - radii, centers + radii), project.hit_sphere, rays
+
+
+def run(name, closest, occluded, bvh, intersect, rays):
+    """Times both queries over all rays and counts the node visits."""
+    started = time.perf_counter()
+    hits = [closest(bvh, o, d, t_min, float('inf'), intersect) for o, d, t_min in rays]
+    closest_time = time.perf_counter() - started
+    started = time.perf_counter()
+    blocked = [occluded(bvh, o, d, t_min, float('inf'), intersect) for o, d, t_min in rays]
+    occluded_time = time.perf_counter() - started
+
+    stats = render.stats.enable()
+    for o, d, t_min in rays:
+        closest(bvh, o, d, t_min, float('inf'), intersect)
+    render.stats.disable()
+    n = len(rays)
+    print(f"  {name:<8}{len(bvh):>8}{bvh.nbytes() / 1024:>10.0f}"
+          f"{closest_time / n * 1e6:>13.1f}{occluded_time / n * 1e6:>13.1f}"
+          f"{stats.counts['primary'][1] / n:>10.1f}{stats.counts['primary'][2] / n:>10.1f}")
+    return hits, blocked, closest_time
+
+
+def compare(title, scene, stride):
+    bvh, intersect, rays = scene(stride)
+    started = time.perf_counter()
+    wide = collapse_bvh(bvh)
+    collapse_time = time.perf_counter() - started
+    print(f"{title}: {len(rays)} rays, collapsed in {collapse_time * 1e3:.1f} ms")
+    print(f"  {'BVH':<8}{'nodes':>8}{'KB':>10}{'closest us':>13}{'any-hit us':>13}"
+          f"{'visits':>10}{'tests':>10}")
+    binary = run('binary', bvh_closest, bvh_occluded, bvh, intersect, rays)
+    four = run('wide', wide_closest, wide_occluded, wide, intersect, rays)
+    for a, b in zip(binary[0], four[0]):
+        if (a is None) != (b is None) or (a is not None and a[1] != b[1]):
+            sys.exit(f"{title}: the wide BVH found a different hit ({a} against {b})")
+    if binary[1] != four[1]:
+        sys.exit(f"{title}: the wide BVH disagrees on an any-hit query")
+    print(f"  closest hits: wide/binary time {four[2] / binary[2]:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare binary and 4-wide BVH traversal.")
+    parser.add_argument("--stride", type=int, default=8,
+                        help="trace every stride-th pixel of every stride-th row")
+    args = parser.parse_args()
+    compare("Bunny", bunny_scene, args.stride)
+    compare("Cover", cover_scene, args.stride)
@@ -1,5 +1,6 @@
 from PIL import Image
-import sys, os, random, math
+import sys, os, random, math, argparse, functools
+import numpy as np
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -7,6 +8,14 @@ import assignment1.vec
 import assignment1.color
 import assignment1.sphere
 import assignment2.light
+import render.grid
+import render.packet
+import render.wavefront
+import render.tiles
+import render.stats
+import render.distributed
+import render.checkpoint
+import render.output
 
 WIDTH = 1200
 HEIGHT = 675
@@ -46,66 +55,77 @@ background_color = assignment1.color.Color(135, 206, 235)
 #   • For a metal, use a high specular exponent (e.g. 250) and a high reflective factor.
 #   • For a dielectric (glass) sphere, we simulate with a white color,
 #     high specular exponent and a reflective factor near 0.9.
-spheres = []
-
-ground_color = assignment1.color.Color(int(0.5 * 255), int(0.5 * 255), int(0.5 * 255))
-spheres.append(
-    assignment1.sphere.Sphere(assignment1.vec.Vec(0, -1000, 0), 1000,
-                                ground_color, specular=-1, reflective=0)
-)
-
-for a in range(-11, 11):
-    for b in range(-11, 11):
-        choose_mat = random.random()
-        center = assignment1.vec.Vec(
-            a + 0.9 * random.random(),
-            0.2,
-            b + 0.9 * random.random()
-        )
-        if center.sub(assignment1.vec.Vec(4, 0.2, 0)).length() > 0.9:
-            if choose_mat < 0.8:
-                r = random.random() * random.random()
-                g = random.random() * random.random()
-                b_val = random.random() * random.random()
-                diffuse_color = assignment1.color.Color(
-                    int(r * 255), int(g * 255), int(b_val * 255)
-                )
-                spheres.append(
-                    assignment1.sphere.Sphere(center, 0.2, diffuse_color,
-                                              specular=-1, reflective=0)
-                )
-            elif choose_mat < 0.95:
-                r = random.uniform(0.5, 1)
-                g = random.uniform(0.5, 1)
-                b_val = random.uniform(0.5, 1)
-                metal_color = assignment1.color.Color(
-                    int(r * 255), int(g * 255), int(b_val * 255)
-                )
-                spheres.append(
-                    assignment1.sphere.Sphere(center, 0.2, metal_color,
-                                              specular=250, reflective=0.8)
-                )
-            else:
-                spheres.append(
-                    assignment1.sphere.Sphere(center, 0.2, assignment1.color.Color(255, 255, 255),
-                                              specular=500, reflective=0.9)
-                )
-
-spheres.append(
-    assignment1.sphere.Sphere(assignment1.vec.Vec(0, 1, 0), 1.0,
-                              assignment1.color.Color(255, 255, 255),
-                              specular=500, reflective=0.9)
-)
-spheres.append(
-    assignment1.sphere.Sphere(assignment1.vec.Vec(-4, 1, 0), 1.0,
-                              assignment1.color.Color(int(0.4 * 255), int(0.2 * 255), int(0.1 * 255)),
-                              specular=-1, reflective=0)
-)
-spheres.append(
-    assignment1.sphere.Sphere(assignment1.vec.Vec(4, 1, 0), 1.0,
-                              assignment1.color.Color(int(0.7 * 255), int(0.6 * 255), int(0.5 * 255)),
-                              specular=250, reflective=1.0)
-)
+def random_spheres():
+    """
+    Builds the scene: a ground sphere, a 22 x 22 field of small random spheres
+    and three large ones. Seed the random module first for a repeatable scene.
+    """
+    spheres = []
+
+    ground_color = assignment1.color.Color(int(0.5 * 255), int(0.5 * 255), int(0.5 * 255))
+    spheres.append(
+        assignment1.sphere.Sphere(assignment1.vec.Vec(0, -1000, 0), 1000,
+                                    ground_color, specular=-1, reflective=0)
+    )
+
+    for a in range(-11, 11):
+        for b in range(-11, 11):
+            choose_mat = random.random()
+            center = assignment1.vec.Vec(
+                a + 0.9 * random.random(),
+                0.2,
+                b + 0.9 * random.random()
+            )
+            if center.sub(assignment1.vec.Vec(4, 0.2, 0)).length() > 0.9:
+                if choose_mat < 0.8:
+                    r = random.random() * random.random()
+                    g = random.random() * random.random()
+                    b_val = random.random() * random.random()
+                    diffuse_color = assignment1.color.Color(
+                        int(r * 255), int(g * 255), int(b_val * 255)
+                    )
+                    spheres.append(
+                        assignment1.sphere.Sphere(center, 0.2, diffuse_color,
+                                                  specular=-1, reflective=0)
+                    )
+                elif choose_mat < 0.95:
+                    r = random.uniform(0.5, 1)
+                    g = random.uniform(0.5, 1)
+                    b_val = random.uniform(0.5, 1)
+                    metal_color = assignment1.color.Color(
+                        int(r * 255), int(g * 255), int(b_val * 255)
+                    )
+                    spheres.append(
+                        assignment1.sphere.Sphere(center, 0.2, metal_color,
+                                                  specular=250, reflective=0.8)
+                    )
+                else:
+                    spheres.append(
+                        assignment1.sphere.Sphere(center, 0.2, assignment1.color.Color(255, 255, 255),
+                                                  specular=500, reflective=0.9)
+                    )
+
+    spheres.append(
+        assignment1.sphere.Sphere(assignment1.vec.Vec(0, 1, 0), 1.0,
+                                  assignment1.color.Color(255, 255, 255),
+                                  specular=500, reflective=0.9)
+    )
+    spheres.append(
+        assignment1.sphere.Sphere(assignment1.vec.Vec(-4, 1, 0), 1.0,
+                                  assignment1.color.Color(int(0.4 * 255), int(0.2 * 255), int(0.1 * 255)),
+                                  specular=-1, reflective=0)
+    )
+    spheres.append(
+        assignment1.sphere.Sphere(assignment1.vec.Vec(4, 1, 0), 1.0,
+                                  assignment1.color.Color(int(0.7 * 255), int(0.6 * 255), int(0.5 * 255)),
+                                  specular=250, reflective=1.0)
+    )
+    return spheres
+
+spheres = random_spheres()
+
+# Uniform grid over the spheres (rebuilt by set_scene); None tests every sphere.
+grid = render.grid.SphereGrid(spheres)
 
 def canvas_to_viewport(x, y):
     """
@@ -133,10 +153,14 @@ def intersect_ray_sphere(origin, direction, sphere):
     Computes the intersections (t values) of a ray with a sphere.
     Returns a tuple (t1, t2). If no intersection, returns (inf, inf).
     """
-    oc = origin.sub(sphere.center)
+    # oc = origin - center
+    c = sphere.center
+    ocx = origin.x - c.x
+    ocy = origin.y - c.y
+    ocz = origin.z - c.z
     k1 = direction.dot(direction)
-    k2 = 2 * oc.dot(direction)
-    k3 = oc.dot(oc) - sphere.radius ** 2
+    k2 = 2 * (ocx * direction.x + ocy * direction.y + ocz * direction.z)
+    k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - sphere.radius ** 2
 
     discriminant = k2 * k2 - 4 * k1 * k3
     if discriminant < 0:
@@ -146,11 +170,30 @@ def intersect_ray_sphere(origin, direction, sphere):
     t2 = (-k2 - sqrt_d) / (2 * k1)
     return t1, t2
 
+def hit_sphere(index, origin, direction, t_min, t_max):
+    """
+    Distance to the nearer intersection of the ray with spheres[index] within
+    (t_min, t_max), or inf. This is the sphere test used by the grid.
+    """
+    t1, t2 = intersect_ray_sphere(origin, direction, spheres[index])
+    t = float('inf')
+    if t_min < t1 < t_max:
+        t = t1
+    if t_min < t2 < t_max and t2 < t:
+        t = t2
+    return t
+
 def closest_intersection(origin, direction, t_min, t_max):
     """
     Finds the closest sphere hit by the ray (if any) within (t_min, t_max).
     Returns a tuple (sphere, t) if found, or None otherwise.
     """
+    if grid is not None:
+        hit = render.grid.grid_closest(grid, origin, direction, t_min, t_max, hit_sphere)
+        if hit is None:
+            return None
+        return (spheres[hit[0]], hit[1])
+
     closest_t = float('inf')
     closest_sphere = None
 
@@ -167,6 +210,19 @@ def closest_intersection(origin, direction, t_min, t_max):
         return None
     return (closest_sphere, closest_t)
 
+def occluded(origin, direction, t_min, t_max):
+    """
+    Shadow-ray query: returns True as soon as any sphere is hit within
+    (t_min, t_max). Unlike closest_intersection it stops at the first hit.
+    """
+    if grid is not None:
+        return render.grid.grid_occluded(grid, origin, direction, t_min, t_max, hit_sphere)
+    for sphere in spheres:
+        t1, t2 = intersect_ray_sphere(origin, direction, sphere)
+        if t_min < t1 < t_max or t_min < t2 < t_max:
+            return True
+    return False
+
 def compute_lighting(point, normal, view, specular):
     """
     Computes the lighting at a point with a given surface normal.
@@ -189,7 +245,12 @@ def compute_lighting(point, normal, view, specular):
                 continue
 
             # Shadow check.
-            if closest_intersection(point, L, EPSILON, t_max) is not None:
+            stats = render.stats.active
+            if stats is None:
+                blocked = occluded(point, L, EPSILON, t_max)
+            else:
+                blocked = stats.trace("shadow", occluded, point, L, EPSILON, t_max)
+            if blocked:
                 continue
 
             # Diffuse shading.
@@ -199,7 +260,7 @@ def compute_lighting(point, normal, view, specular):
 
             # Specular shading.
             if specular != -1:
-                R = normal.mul(2 * n_dot_l).sub(L)
+                R = L.reflect(normal)
                 r_dot_v = R.dot(view)
                 if r_dot_v > 0:
                     intensity += light.intensity * (r_dot_v / (R.length() * view.length())) ** specular
@@ -211,27 +272,32 @@ def reflect_ray(incident, normal):
     Reflects the incident ray around the given normal.
     Formula: R = 2*(incident dot normal)*normal - incident.
     """
-    return normal.mul(2 * incident.dot(normal)).sub(incident)
+    return incident.reflect(normal)
 
 EPSILON = 0.001
 RECURSION_DEPTH = 3
 
-def trace_ray(origin, direction, t_min, t_max, depth):
+def trace_ray(origin, direction, t_min, t_max, depth, kind="primary"):
     """
     Traces a ray into the scene. If it hits an object, computes local color (using
     diffuse and specular lighting) and, if reflective and depth limit not reached,
     recursively computes the reflected color.
     Returns a Color.
+    kind is the ray type counted by render.stats.
     """
-    hit = closest_intersection(origin, direction, t_min, t_max)
+    stats = render.stats.active
+    if stats is None:
+        hit = closest_intersection(origin, direction, t_min, t_max)
+    else:
+        hit = stats.trace(kind, closest_intersection, origin, direction, t_min, t_max)
     if hit is None:
         # Return the light blue background.
         return background_color
 
     closest_sphere, closest_t = hit
-    point = origin.add(direction.mul(closest_t))
-    normal = point.sub(closest_sphere.center).div(point.sub(closest_sphere.center).length())
-    view = direction.mul(-1)
+    point = origin.madd(direction, closest_t)
+    normal = point.direction_from(closest_sphere.center)
+    view = direction.neg()
 
     lighting = compute_lighting(point, normal, view, closest_sphere.specular)
     local_color = closest_sphere.color.mul(lighting)
@@ -240,23 +306,33 @@ def trace_ray(origin, direction, t_min, t_max, depth):
         return local_color
 
     reflected_ray = reflect_ray(view, normal)
-    reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1)
-    return local_color.mul(1 - closest_sphere.reflective).add(
-        reflected_color.mul(closest_sphere.reflective)
-    )
+    reflected_color = trace_ray(point, reflected_ray, EPSILON, float('inf'), depth - 1, "reflection")
+    return local_color.blend(reflected_color, closest_sphere.reflective)
 
-def render_scene():
+def set_scene(scene_spheres, scene_grid, size=None):
     """
-    Renders the scene scanline-by-scanline and returns a PIL Image.
+    Installs the sphere list and its grid in a worker process. The scene is
+    generated randomly at import time, so workers that re-import this module
+    must be handed the parent's spheres. size is the image (width, height)
+    if it differs from the default.
+    """
+    global spheres, grid, WIDTH, HEIGHT
+    spheres = scene_spheres
+    grid = scene_grid
+    if size is not None:
+        WIDTH, HEIGHT = size
+
+def render_tile(x0, y0, x1, y1):
+    """
+    Renders the pixel block [x0, x1) x [y0, y1) ray by ray and returns it as a
+    (y1 - y0, x1 - x0, 3) uint8 array.
     For each pixel, a ray is cast from the camera position in a direction computed
     from canvas coordinates (with origin at the center) then transformed by the
     camera rotation matrix.
     """
-    img = Image.new("RGB", (WIDTH, HEIGHT))
-    pixels = img.load()
-
-    for j in range(HEIGHT):
-        for i in range(WIDTH):
+    data = bytearray()
+    for j in range(y0, y1):
+        for i in range(x0, x1):
             # Convert pixel coordinates (i, j) to canvas coordinates.
             canvas_x = i - WIDTH / 2
             canvas_y = HEIGHT / 2 - j - 1
@@ -266,11 +342,223 @@ def render_scene():
             r = max(min(int(color.r), 255), 0)
             g = max(min(int(color.g), 255), 0)
             b = max(min(int(color.b), 255), 0)
-            pixels[i, j] = (r, g, b)
-        print(f"Scanline {j+1}/{HEIGHT} complete", flush=True)
-    return img
+            data += bytes((r, g, b))
+    return np.frombuffer(data, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
+
+def print_progress(done, total):
+    print(f"Tile {done}/{total} complete", flush=True)
+
+def to_image(frame):
+    """PIL Image of a rendered frame, or None if the tiles went to a sink."""
+    return None if frame is None else Image.fromarray(frame, "RGB")
+
+def render_scene(workers=1, tile_size=32, **options):
+    """
+    Renders the scene tile by tile on `workers` processes (0 uses every core)
+    and returns a PIL Image. options (order, costs, checkpoint, sink) are
+    passed on to render.tiles.render_parallel.
+    """
+    frame = render.tiles.render_parallel(render_tile, WIDTH, HEIGHT, workers, tile_size,
+                                         initializer=set_scene,
+                                         initargs=(spheres, grid, (WIDTH, HEIGHT)),
+                                         progress=print_progress, **options)
+    return to_image(frame)
+
+def primary_rays(x0, y0, x1, y1):
+    """
+    Builds the primary rays of the pixel block [x0, x1) x [y0, y1) as arrays,
+    in row-major order. Returns (origins, directions), both of shape (N, 3).
+    """
+    j, i = np.mgrid[y0:y1, x0:x1]
+    canvas_x = i.reshape(-1) - WIDTH / 2
+    canvas_y = HEIGHT / 2 - j.reshape(-1) - 1
+    x = canvas_x * viewport_width / WIDTH
+    y = canvas_y * viewport_height / HEIGHT
+    z = projection_plane_z
+    m = camera_rotation
+    directions = np.stack([
+        m[0][0] * x + m[0][1] * y + m[0][2] * z,
+        m[1][0] * x + m[1][1] * y + m[1][2] * z,
+        m[2][0] * x + m[2][1] * y + m[2][2] * z,
+    ], axis=1)
+    origins = np.empty_like(directions)
+    origins[:] = (camera_position.x, camera_position.y, camera_position.z)
+    return origins, directions
+
+def render_tile_packet(scene, x0, y0, x1, y1, wavefront=False):
+    """
+    Traces the pixel block [x0, x1) x [y0, y1) as one NumPy ray packet and
+    returns it as a (y1 - y0, x1 - x0, 3) uint8 array. wavefront traces the
+    packet with the ray queues of render.wavefront instead of recursively.
+    """
+    origins, directions = primary_rays(x0, y0, x1, y1)
+    tracer = render.wavefront if wavefront else render.packet
+    colors = tracer.trace_rays(scene, origins, directions, 1.0, float('inf'), RECURSION_DEPTH)
+    return render.packet.to_pixels(colors).reshape(y1 - y0, x1 - x0, 3)
+
+def render_scene_packet(workers=1, tile_size=128, wavefront=False, **options):
+    """
+    Renders the scene with the NumPy packet tracer (or the wavefront tracer)
+    and returns a PIL Image identical to render_scene().
+    """
+    scene = render.packet.PacketScene(spheres, lights, background_color, EPSILON, RECURSION_DEPTH)
+    frame = render.tiles.render_parallel(functools.partial(render_tile_packet, scene,
+                                                           wavefront=wavefront),
+                                         WIDTH, HEIGHT, workers, tile_size,
+                                         initializer=set_scene,
+                                         initargs=(spheres, grid, (WIDTH, HEIGHT)),
+                                         progress=print_progress, **options)
+    return to_image(frame)
+
+def render_scene_distributed(address, local_workers=0, tile_size=32, packet=False,
+                             wavefront=False, **options):
+    """
+    Renders the scene on the render workers that connect to `address` (see
+    render.distributed), starting `local_workers` of them on this host, and
+    returns a PIL Image identical to render_scene(). options (order, stats,
+    checkpoint, sink) are passed on to render_distributed.
+    """
+    tile = render_tile
+    if packet or wavefront:
+        scene = render.packet.PacketScene(spheres, lights, background_color, EPSILON, RECURSION_DEPTH)
+        tile = functools.partial(render_tile_packet, scene, wavefront=wavefront)
+    frame = render.distributed.render_distributed(tile, WIDTH, HEIGHT, address, tile_size,
+                                                  set_scene, (spheres, grid, (WIDTH, HEIGHT)),
+                                                  local_workers, progress=print_progress,
+                                                  **options)
+    return to_image(frame)
+
+def checkpoint_meta(tile_size):
+    """
+    Describes everything that decides the pixels of a tile, so a checkpoint
+    is only resumed for the same scene, camera, image size and tiling.
+    """
+    scene = render.checkpoint.scene_hash(spheres, lights, background_color, camera_position,
+                                         camera_rotation, viewport_width, viewport_height,
+                                         EPSILON, RECURSION_DEPTH)
+    return {'scene': scene, 'width': WIDTH, 'height': HEIGHT, 'tile_size': tile_size}
 
 if __name__ == "__main__":
-    image = render_scene()
-    image.save("project_output.png")
-    print("Rendering complete. Saved as project_output.png")
+    parser = argparse.ArgumentParser(description="Render the Project 1 sphere scene.")
+    parser.add_argument("--packet", action="store_true",
+                        help="trace NumPy ray packets instead of one ray at a time")
+    parser.add_argument("--wavefront", action="store_true",
+                        help="trace packets bounce by bounce with queues of shadow and reflection "
+                             "rays (implies --packet)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of render processes (0 uses every core)")
+    parser.add_argument("--tile-size", type=int,
+                        help="tile size in pixels (default 32, or 128 with --packet)")
+    parser.add_argument("--no-grid", action="store_true",
+                        help="test every sphere for every ray instead of walking the grid")
+    parser.add_argument("--tile-order", choices=render.tiles.TILE_ORDERS, default="hilbert",
+                        help="order in which tiles are scheduled")
+    parser.add_argument("--tile-report", action="store_true",
+                        help="print per-tile and per-worker render times")
+    parser.add_argument("--coordinator", metavar="ADDRESS",
+                        help="hand tiles to render workers connecting to ADDRESS (host:port or a socket path)")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="with --coordinator, number of workers to start on this host")
+    parser.add_argument("--worker", metavar="ADDRESS",
+                        help="render tiles for the coordinator at ADDRESS")
+    parser.add_argument("--seed", type=int,
+                        help="seed for the random sphere field, to get the same scene every run")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="save finished tiles to FILE and resume from it if it exists")
+    parser.add_argument("--width", type=int,
+                        help=f"image width in pixels, height follows at 16:9 (default {WIDTH})")
+    parser.add_argument("--output", default="project_output.png",
+                        help="image file to write (default project_output.png)")
+    parser.add_argument("--stream", action="store_true",
+                        help="write tiles to --output (.png or .ppm) as they finish instead of "
+                             "keeping the whole image in memory")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="count rays, traversal work and phase times and save them as JSON")
+    parser.add_argument("--heatmap", metavar="FILE",
+                        help="save an image of the render time of every tile (implies statistics)")
+    args = parser.parse_args()
+    if args.stats or args.heatmap:
+        render.stats.enable()
+    if args.width:
+        WIDTH = args.width
+        HEIGHT = round(WIDTH / aspect_ratio)
+    if args.seed is not None:
+        random.seed(args.seed)
+        with render.stats.phase("load"):
+            spheres = random_spheres()
+        with render.stats.phase("build"):
+            grid = render.grid.SphereGrid(spheres)
+    if args.no_grid:
+        grid = None
+    if args.wavefront:
+        args.packet = True
+
+    if args.worker:
+        try:
+            render.distributed.run_worker(args.worker)
+        except render.distributed.MissingAuthkey as e:
+            print(f"Cannot connect: {e}.")
+            sys.exit(1)
+        sys.exit(0)
+
+    tile_size = args.tile_size or (128 if args.packet else 32)
+    checkpoint = None
+    if args.checkpoint:
+        try:
+            checkpoint = render.checkpoint.Checkpoint(args.checkpoint, checkpoint_meta(tile_size))
+        except render.checkpoint.CheckpointMismatch as e:
+            print(f"Cannot resume: {e}.")
+            print("Use the same --seed, --tile-size and image size, or delete the checkpoint.")
+            sys.exit(1)
+        if checkpoint.tiles:
+            print(f"Resuming from {args.checkpoint}: {len(checkpoint.tiles)} tiles already rendered")
+
+    options = {'order': args.tile_order, 'checkpoint': checkpoint}
+    writer = None
+    if args.stream:
+        # Rows finish roughly top to bottom, so the PNG writer only holds a few bands.
+        writer = render.output.writer_for(args.output, WIDTH, HEIGHT)
+
+        def encode_tile(tile, block):
+            with render.stats.phase("encode"):
+                writer.write_tile(tile, block)
+
+        options.update(order="row", sink=encode_tile)
+    costs = [] if args.tile_report else None
+    try:
+        if args.coordinator:
+            stats = []
+            try:
+                image = render_scene_distributed(args.coordinator, args.local_workers, tile_size,
+                                                 args.packet, args.wavefront, stats=stats,
+                                                 **options)
+            except render.distributed.MissingAuthkey as e:
+                print(f"Cannot coordinate: {e}.")
+                sys.exit(1)
+            print(render.distributed.throughput_report(stats))
+        elif args.packet:
+            image = render_scene_packet(args.workers, tile_size, args.wavefront, costs=costs,
+                                        **options)
+        else:
+            image = render_scene(args.workers, tile_size, costs=costs, **options)
+        if writer is not None:
+            with render.stats.phase("encode"):
+                writer.close()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    if costs is not None:
+        print(render.tiles.cost_report(costs))
+    if image is not None:
+        with render.stats.phase("encode"):
+            image.save(args.output)
+    print(f"Rendering complete. Saved as {args.output}")
+    stats = render.stats.active
+    if stats is not None:
+        print(stats.summary())
+        if args.stats:
+            stats.save_json(args.stats)
+        if args.heatmap:
+            stats.save_heatmap(args.heatmap, WIDTH, HEIGHT)
+    if checkpoint is not None:
+        os.remove(args.checkpoint)
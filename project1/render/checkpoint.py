@@ -0,0 +1,174 @@
+"""
+Checkpoints for long renders: an append-only file of finished tiles.
+
+The file starts with a header describing the render (a hash of the scene
+and the settings that change the pixels, such as image and tile size) and
+then holds one record per finished tile: its coordinates and its pixels,
+zlib-compressed and protected by a CRC. Tiles are appended as they finish
+and the file is flushed to disk every few seconds, so a killed render loses
+at most the tiles of the last interval. A record cut short by the kill is
+detected by its length or CRC and dropped.
+
+Reopening the file with the same header resumes the render: its tiles are
+restored and skipped. Only their places in the file are kept in memory;
+the pixels of a tile are read back when they are needed, so resuming a
+streamed render (see Replay) holds no more of the image than a fresh one.
+A checkpoint whose header does not match (another
+scene, another resolution) is never resumed; opening it raises
+CheckpointMismatch instead.
+"""
+import hashlib
+import json
+import os
+import pickle
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'ICSCKPT\x00'
+VERSION = 1
+
+# x0, y0, x1, y1, compressed size, CRC-32 of the compressed pixels
+_RECORD = struct.Struct('<6I')
+
+
+class CheckpointMismatch(ValueError):
+    """The checkpoint file was written for a different scene or settings."""
+
+
+def scene_hash(*objects):
+    """Hex digest identifying a scene made of picklable objects."""
+    return hashlib.blake2b(pickle.dumps(objects, protocol=4), digest_size=16).hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, path, meta, sync_interval=10.0):
+        """
+        Opens (or creates) the checkpoint at path for a render described by
+        meta, a JSON-able dict that should include the scene hash.
+        sync_interval: seconds between flushes of new tiles to disk.
+        """
+        self.path = path
+        self.meta = {'version': VERSION, **meta}
+        self.sync_interval = sync_interval
+        # (x0, y0, x1, y1) -> (offset, size) of the compressed pixels of the
+        # tiles found in the file
+        self.tiles = {}
+        self._saved = None
+        if os.path.exists(path):
+            end = self._read()
+            self._saved = open(path, 'rb')
+            self._file = open(path, 'r+b')
+            # Drop a record that was only partly written.
+            self._file.truncate(end)
+            self._file.seek(end)
+        else:
+            self._file = open(path, 'wb')
+            header = json.dumps(self.meta, sort_keys=True).encode()
+            self._file.write(MAGIC + struct.pack('<I', len(header)) + header)
+            self._sync()
+        self._synced = time.monotonic()
+
+    def _read(self):
+        """
+        Finds the tiles of an existing file, one record at a time, and
+        returns the end of its last intact record.
+        """
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise CheckpointMismatch(f"{self.path} is not a render checkpoint")
+            data = f.read(4)
+            if len(data) < 4:
+                raise CheckpointMismatch(f"{self.path} has a damaged header")
+            (size,) = struct.unpack('<I', data)
+            try:
+                meta = json.loads(f.read(size))
+            except ValueError:
+                raise CheckpointMismatch(f"{self.path} has a damaged header")
+            if meta != self.meta:
+                raise CheckpointMismatch(f"{self.path} was written for a different scene or settings")
+            pos = len(MAGIC) + 4 + size
+            while True:
+                data = f.read(_RECORD.size)
+                if len(data) < _RECORD.size:
+                    break
+                x0, y0, x1, y1, size, crc = _RECORD.unpack(data)
+                block = f.read(size)
+                if len(block) < size or zlib.crc32(block) != crc:
+                    break
+                start = pos + _RECORD.size
+                self.tiles[(x0, y0, x1, y1)] = (start, size)
+                pos = start + size
+        return pos
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def add(self, tile, pixels):
+        """Appends a finished tile (x0, y0, x1, y1) and its uint8 pixel block."""
+        block = zlib.compress(pixels.tobytes(), 1)
+        self._file.write(_RECORD.pack(*tile, len(block), zlib.crc32(block)) + block)
+        if time.monotonic() - self._synced >= self.sync_interval:
+            self._sync()
+
+    def load(self, tile):
+        """Reads the pixel block of a tile found in the file."""
+        x0, y0, x1, y1 = tile
+        offset, size = self.tiles[tile]
+        self._saved.seek(offset)
+        pixels = zlib.decompress(self._saved.read(size))
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
+
+    def restore(self, frame):
+        """Copies the tiles found in the file into frame ((height, width, 3) uint8)."""
+        for x0, y0, x1, y1 in self.tiles:
+            frame[y0:y1, x0:x1] = self.load((x0, y0, x1, y1))
+
+    def replay(self, sink):
+        """A Replay that adds the tiles found in the file to the tiles sent to sink."""
+        return Replay(self, sink)
+
+    def close(self):
+        if self._saved is not None:
+            self._saved.close()
+        if not self._file.closed:
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Replay:
+    def __init__(self, checkpoint, sink):
+        """
+        A sink(tile, block) for the new tiles of a resumed render. Before a
+        new tile goes on to sink, the saved tiles of its band and of the
+        bands above it are read from the checkpoint and sent first; close()
+        sends the rest. A streaming writer therefore gets the saved tiles
+        of a band when it works on that band, not all at the start.
+        """
+        self.checkpoint = checkpoint
+        self.sink = sink
+        # Saved tiles still to send, the last in row order first.
+        self._saved = sorted(checkpoint.tiles, key=lambda t: (t[1], t[0]), reverse=True)
+
+    def _send(self, row=None):
+        saved = self._saved
+        while saved and (row is None or saved[-1][1] <= row):
+            tile = saved.pop()
+            self.sink(tile, self.checkpoint.load(tile))
+
+    def __call__(self, tile, block):
+        self._send(tile[1])
+        self.sink(tile, block)
+
+    def close(self):
+        self._send()
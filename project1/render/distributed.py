@@ -0,0 +1,344 @@
+"""
+Distributed tile rendering: one coordinator, any number of worker processes
+on this or other machines, connected over TCP or Unix sockets.
+
+The coordinator listens on an address and every worker connects to it. A
+new worker is sent the scene once (the tile renderer plus an initializer
+and its arguments, as for render.tiles.render_parallel), then tile jobs one
+after another. It answers each job with the raw pixel block and, when
+render.stats is on in the coordinator, the tile's statistics. A tile whose
+worker fails, disconnects or takes much longer than usual is handed to
+another worker; the first result to arrive is kept.
+
+Messages are pickled, so both ends run the same code and trust each other:
+connections are authenticated with a shared key (multiprocessing.connection),
+but only use this on machines and networks you control. The key comes from
+the RENDER_AUTHKEY environment variable and is required for TCP; only a
+coordinator on a Unix socket may go without it, in which case it makes a
+random key that only the workers it starts itself are given.
+
+Addresses are "host:port" for TCP or a filesystem path for a Unix socket.
+"""
+import multiprocessing
+import os
+import queue
+import socket
+import statistics
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener, wait
+
+import numpy as np
+
+import render.stats
+from render.tiles import order_tiles, split_tiles
+
+
+def parse_address(address):
+    """
+    Maps "host:port" to a TCP (host, port) tuple; any other string is a Unix
+    socket path. Tuples are returned unchanged.
+    """
+    if not isinstance(address, str):
+        return address
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+
+class MissingAuthkey(ValueError):
+    """No shared key was given for a connection that needs one."""
+
+
+def _authkey(authkey, address, coordinator=False):
+    """
+    The key for connections on address: authkey if given, else
+    RENDER_AUTHKEY. Without either, a coordinator on a Unix socket gets a
+    random key; anything else raises MissingAuthkey.
+    """
+    if authkey is not None:
+        return authkey
+    key = os.environ.get('RENDER_AUTHKEY', '').encode()
+    if key:
+        return key
+    if coordinator and not isinstance(parse_address(address), tuple):
+        return os.urandom(32)
+    raise MissingAuthkey("RENDER_AUTHKEY is not set: set it to the same secret on the "
+                         "coordinator and every worker (only a coordinator on a Unix socket "
+                         "can do without, for the workers it starts itself)")
+
+
+def run_worker(address, authkey=None):
+    """
+    Connects to the coordinator at address and renders tiles until it says
+    stop or the connection closes.
+    """
+    conn = Client(parse_address(address), authkey=_authkey(authkey, address))
+    try:
+        conn.send(('ready', socket.gethostname(), os.getpid()))
+        render_tile = None
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == 'stop':
+                break
+            if message[0] == 'scene':
+                try:
+                    _, render_tile, initializer, initargs, with_stats = message
+                    # Statistics as in the coordinator; each tile's record goes back with it.
+                    if with_stats:
+                        render.stats.enable()
+                    else:
+                        render.stats.disable()
+                    if initializer is not None:
+                        initializer(*initargs)
+                except Exception:
+                    conn.send(('error', None, traceback.format_exc()))
+                    break
+                continue
+            _, index, (x0, y0, x1, y1) = message
+            try:
+                stats = render.stats.active
+                begun = stats.begin_tile() if stats is not None else None
+                started = time.perf_counter()
+                block = np.ascontiguousarray(render_tile(x0, y0, x1, y1), dtype=np.uint8)
+                seconds = time.perf_counter() - started
+                record = None
+                if stats is not None:
+                    record = stats.end_tile((x0, y0, x1, y1), seconds, begun)
+            except Exception:
+                conn.send(('error', index, traceback.format_exc()))
+                continue
+            conn.send(('done', index, seconds, record))
+            # send_bytes counts items of the first axis, so send a flat view.
+            conn.send_bytes(block.reshape(-1))
+    finally:
+        conn.close()
+
+
+def spawn_workers(address, count, authkey=None):
+    """Starts count local worker processes connecting to address and returns them."""
+    processes = []
+    for _ in range(count):
+        p = multiprocessing.Process(target=run_worker, args=(address, authkey), daemon=True)
+        p.start()
+        processes.append(p)
+    return processes
+
+
+class WorkerStats:
+    def __init__(self, name):
+        """Per-worker counters kept by the coordinator."""
+        self.name = name
+        self.connected = time.perf_counter()
+        self.tiles = 0
+        self.pixels = 0
+        self.busy = 0.0
+        self.failures = 0
+
+    def throughput(self):
+        """Pixels per second of render time."""
+        return self.pixels / self.busy if self.busy > 0 else 0.0
+
+
+class _Worker:
+    def __init__(self, conn, stats):
+        self.conn = conn
+        self.stats = stats
+        # index -> time the job was sent
+        self.jobs = {}
+
+
+def render_distributed(render_tile, width, height, address, tile_size=32,
+                       initializer=None, initargs=(), local_workers=0, authkey=None,
+                       order='hilbert', pipeline=2, retries=3, tile_timeout=None,
+                       progress=None, stats=None, checkpoint=None, sink=None):
+    """
+    Renders a width x height image on the workers connected to address and
+    returns it as a (height, width, 3) uint8 array.
+
+    local_workers: worker processes to start on this host (others may connect
+                   with run_worker at any time).
+    pipeline: tiles in flight per worker, so a worker never waits for its
+              next job.
+    retries: how many times a tile may fail before the render is aborted.
+    tile_timeout: seconds after which a tile is also given to another worker.
+                  None uses four times the median tile time seen so far.
+    progress: optional callback progress(done, total) called after every tile.
+    stats: optional list that receives a WorkerStats per worker.
+    checkpoint: optional render.checkpoint.Checkpoint; its tiles are reused
+                instead of rendered and every new tile is added to it.
+    sink: optional callback sink(tile, block) that takes every finished tile
+          instead of a framebuffer, as in render.tiles.render_parallel;
+          nothing is returned.
+    """
+    authkey = _authkey(authkey, address, coordinator=True)
+    tiles = order_tiles(split_tiles(width, height, tile_size), tile_size, order)
+    total = len(tiles)
+    frame = np.zeros((height, width, 3), dtype=np.uint8) if sink is None else None
+    replay = None
+    if checkpoint is not None:
+        tiles = [t for t in tiles if t not in checkpoint.tiles]
+        if frame is not None:
+            checkpoint.restore(frame)
+        else:
+            replay = sink = checkpoint.replay(sink)
+    restored = total - len(tiles)
+    scene = ('scene', render_tile, initializer, initargs, render.stats.active is not None)
+
+    listener = Listener(parse_address(address), authkey=authkey)
+    # The bound address, in case the port was 0 (any free port).
+    address = listener.address
+    arrivals = queue.Queue()
+
+    def accept():
+        while True:
+            try:
+                arrivals.put(listener.accept())
+            except OSError:
+                # The listener was closed by the coordinator.
+                return
+            except Exception:
+                # A client that failed authentication; keep listening.
+                continue
+
+    threading.Thread(target=accept, daemon=True).start()
+    processes = spawn_workers(address, local_workers, authkey) if local_workers and tiles else []
+
+    workers = []
+    pending = list(range(len(tiles)))
+    pending.reverse()
+    finished = [False] * len(tiles)
+    failures = [0] * len(tiles)
+    times = []
+    done = 0
+    try:
+        while done < len(tiles):
+            while not arrivals.empty():
+                conn = arrivals.get()
+                try:
+                    _, host, pid = conn.recv()
+                    conn.send(scene)
+                except (EOFError, OSError):
+                    conn.close()
+                    continue
+                worker = _Worker(conn, WorkerStats(f"{host}:{pid}"))
+                workers.append(worker)
+                if stats is not None:
+                    stats.append(worker.stats)
+
+            # Re-issue tiles that have been out for too long.
+            timeout = tile_timeout
+            if timeout is None and times:
+                timeout = max(1.0, 4 * statistics.median(times))
+            now = time.perf_counter()
+            if timeout is not None:
+                out = {i for w in workers for i, sent in w.jobs.items() if now - sent < timeout}
+                for w in workers:
+                    for i, sent in w.jobs.items():
+                        if now - sent >= timeout and i not in out and i not in pending \
+                                and not finished[i]:
+                            pending.append(i)
+
+            for w in workers:
+                # Re-issued tiles this worker already holds are kept for the next ones.
+                held = []
+                while pending and len(w.jobs) < pipeline:
+                    i = pending.pop()
+                    if finished[i]:
+                        continue
+                    if i in w.jobs:
+                        held.append(i)
+                        continue
+                    try:
+                        w.conn.send(('tile', i, tiles[i]))
+                    except OSError:
+                        pending.append(i)
+                        break
+                    w.jobs[i] = time.perf_counter()
+                pending.extend(reversed(held))
+
+            if not workers:
+                if processes and all(p.exitcode is not None for p in processes) \
+                        and arrivals.empty():
+                    raise RuntimeError("all local render workers exited before connecting")
+                time.sleep(0.01)
+                continue
+
+            for conn in wait([w.conn for w in workers], timeout=0.1):
+                w = next(w for w in workers if w.conn is conn)
+                try:
+                    message = conn.recv()
+                    if message[0] == 'done':
+                        block = conn.recv_bytes()
+                except (EOFError, OSError):
+                    # Lost worker: its tiles go back to the queue.
+                    workers.remove(w)
+                    conn.close()
+                    pending.extend(i for i in w.jobs if not finished[i])
+                    continue
+                if message[0] == 'error':
+                    _, i, trace = message
+                    w.stats.failures += 1
+                    if i is None:
+                        raise RuntimeError(f"render worker {w.stats.name} could not load the scene:\n{trace}")
+                    del w.jobs[i]
+                    failures[i] += 1
+                    if failures[i] > retries:
+                        raise RuntimeError(f"tile {tiles[i]} failed {failures[i]} times, last on "
+                                           f"{w.stats.name}:\n{trace}")
+                    if not finished[i]:
+                        pending.append(i)
+                    continue
+                _, i, seconds, record = message
+                del w.jobs[i]
+                w.stats.tiles += 1
+                w.stats.busy += seconds
+                times.append(seconds)
+                if finished[i]:
+                    continue
+                if record is not None and render.stats.active is not None:
+                    render.stats.active.add_tile(record)
+                x0, y0, x1, y1 = tiles[i]
+                w.stats.pixels += (x1 - x0) * (y1 - y0)
+                pixels = np.frombuffer(block, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
+                if frame is not None:
+                    frame[y0:y1, x0:x1] = pixels
+                else:
+                    sink(tiles[i], pixels)
+                finished[i] = True
+                done += 1
+                if checkpoint is not None:
+                    checkpoint.add(tiles[i], pixels)
+                if progress is not None:
+                    progress(restored + done, total)
+    finally:
+        for w in workers:
+            try:
+                w.conn.send(('stop',))
+            except OSError:
+                pass
+            w.conn.close()
+        listener.close()
+        for p in processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+    if replay is not None:
+        replay.close()
+    return frame
+
+
+def throughput_report(stats):
+    """One line per worker: tiles, pixels per second and failures."""
+    if not stats:
+        return "no workers connected"
+    lines = []
+    for s in stats:
+        lines.append(f"{s.name}: {s.tiles} tiles, {s.throughput():.0f} pixels/s, "
+                     f"{s.busy:.3f} s busy, {s.failures} failed")
+    return "\n".join(lines)
@@ -0,0 +1,238 @@
+"""
+Uniform-grid acceleration structure for sphere scenes.
+
+Space around the spheres is divided into equal cells and every cell lists
+the spheres whose bounding boxes overlap it. A ray walks only the cells it
+passes through, front to back (3D-DDA), so its cost grows with the number of
+spheres near the ray instead of with the size of the scene.
+
+Spheres that are far larger than the typical one (like the radius-1000
+ground sphere) would overlap every cell and inflate the grid bounds, so they
+are kept out of the grid and tested against every ray separately.
+
+The query functions take the sphere test as a callback with the same
+contract as the BVH leaf test: intersect(index, origin, direction, t_min,
+t_max) returns the distance to sphere number `index` within (t_min, t_max),
+or inf.
+"""
+import math
+
+import render.stats
+
+INF = float('inf')
+
+
+class SphereGrid:
+    def __init__(self, spheres, density=4.0, max_resolution=128, large_factor=10.0):
+        """
+        spheres: objects with .center (Vec) and .radius
+        density: target number of cells per grid sphere
+        max_resolution: upper limit for the number of cells along each axis
+        large_factor: spheres with a radius above large_factor times the
+                      median radius are kept out of the grid
+        """
+        radii = sorted(s.radius for s in spheres)
+        median = radii[len(radii) // 2] if radii else 0.0
+        self.large = [i for i, s in enumerate(spheres) if s.radius > large_factor * median]
+        small = [i for i, s in enumerate(spheres) if s.radius <= large_factor * median]
+        self.count = len(spheres)
+        # Mailboxes: the id of the last ray that tested each sphere, so a
+        # sphere overlapping several cells is tested once per ray.
+        self._mailbox = [0] * len(spheres)
+        self._ray = 0
+
+        if not small:
+            self.resolution = (0, 0, 0)
+            self.cells = []
+            return
+
+        lo = [min(spheres[i].center.x - spheres[i].radius for i in small),
+              min(spheres[i].center.y - spheres[i].radius for i in small),
+              min(spheres[i].center.z - spheres[i].radius for i in small)]
+        hi = [max(spheres[i].center.x + spheres[i].radius for i in small),
+              max(spheres[i].center.y + spheres[i].radius for i in small),
+              max(spheres[i].center.z + spheres[i].radius for i in small)]
+        # Pad the box a little so boundary spheres are strictly inside.
+        for axis in range(3):
+            pad = 1e-6 * max(1.0, hi[axis] - lo[axis])
+            lo[axis] -= pad
+            hi[axis] += pad
+        extent = [hi[axis] - lo[axis] for axis in range(3)]
+
+        # Cells per axis proportional to the box extent, about `density`
+        # cells per sphere in total.
+        k = (density * len(small) / (extent[0] * extent[1] * extent[2])) ** (1 / 3)
+        res = [min(max(int(math.ceil(extent[axis] * k)), 1), max_resolution) for axis in range(3)]
+        self.resolution = tuple(res)
+        self.lo = tuple(lo)
+        self.hi = tuple(hi)
+        self.cell_size = tuple(extent[axis] / res[axis] for axis in range(3))
+
+        cells = [[] for _ in range(res[0] * res[1] * res[2])]
+        for i in small:
+            s = spheres[i]
+            c = (s.center.x, s.center.y, s.center.z)
+            first = [self._cell_coord(c[axis] - s.radius, axis) for axis in range(3)]
+            last = [self._cell_coord(c[axis] + s.radius, axis) for axis in range(3)]
+            for z in range(first[2], last[2] + 1):
+                for y in range(first[1], last[1] + 1):
+                    for x in range(first[0], last[0] + 1):
+                        cells[x + res[0] * (y + res[1] * z)].append(i)
+        self.cells = [tuple(cell) for cell in cells]
+
+    def _cell_coord(self, value, axis):
+        n = self.resolution[axis]
+        cell = int((value - self.lo[axis]) / self.cell_size[axis])
+        return min(max(cell, 0), n - 1)
+
+    def stats(self):
+        """Grid resolution, number of sphere references and largest cell size."""
+        return {'resolution': self.resolution,
+                'large_spheres': len(self.large),
+                'references': sum(len(cell) for cell in self.cells),
+                'max_cell': max((len(cell) for cell in self.cells), default=0)}
+
+
+def _walk(grid, origin, direction, t_min, t_max):
+    """
+    Yields (cell, t_exit) for every cell the ray crosses within
+    (t_min, t_max), front to back (Amanatides & Woo).
+    """
+    nx, ny, nz = grid.resolution
+    if not grid.cells:
+        return
+    o = (origin.x, origin.y, origin.z)
+    d = (direction.x, direction.y, direction.z)
+
+    # Clip the ray against the grid box.
+    t0, t1 = t_min, t_max
+    for axis in range(3):
+        if d[axis] == 0:
+            if o[axis] < grid.lo[axis] or o[axis] > grid.hi[axis]:
+                return
+            continue
+        a = (grid.lo[axis] - o[axis]) / d[axis]
+        b = (grid.hi[axis] - o[axis]) / d[axis]
+        if a > b:
+            a, b = b, a
+        if a > t0:
+            t0 = a
+        if b < t1:
+            t1 = b
+        if t1 < t0:
+            return
+
+    cell = [0, 0, 0]
+    step = [0, 0, 0]
+    t_next = [INF, INF, INF]
+    t_delta = [INF, INF, INF]
+    for axis in range(3):
+        cell[axis] = grid._cell_coord(o[axis] + d[axis] * t0, axis)
+        size = grid.cell_size[axis]
+        if d[axis] > 0:
+            step[axis] = 1
+            t_next[axis] = (grid.lo[axis] + (cell[axis] + 1) * size - o[axis]) / d[axis]
+            t_delta[axis] = size / d[axis]
+        elif d[axis] < 0:
+            step[axis] = -1
+            t_next[axis] = (grid.lo[axis] + cell[axis] * size - o[axis]) / d[axis]
+            t_delta[axis] = -size / d[axis]
+
+    x, y, z = cell
+    sx, sy, sz = step
+    tx, ty, tz = t_next
+    dx, dy, dz = t_delta
+    cells = grid.cells
+    while True:
+        if tx <= ty and tx <= tz:
+            t_exit = tx
+            yield cells[x + nx * (y + ny * z)], t_exit
+            x += sx
+            tx += dx
+            if x < 0 or x >= nx:
+                return
+        elif ty <= tz:
+            t_exit = ty
+            yield cells[x + nx * (y + ny * z)], t_exit
+            y += sy
+            ty += dy
+            if y < 0 or y >= ny:
+                return
+        else:
+            t_exit = tz
+            yield cells[x + nx * (y + ny * z)], t_exit
+            z += sz
+            tz += dz
+            if z < 0 or z >= nz:
+                return
+        if t_exit > t1:
+            return
+
+
+def grid_closest(grid, origin, direction, t_min, t_max, intersect):
+    """
+    Finds the closest sphere hit by the ray within (t_min, t_max).
+    Equal distances go to the sphere listed first, as in a linear scan.
+    Returns a tuple (index, t) if an intersection is found; otherwise, None.
+    """
+    stats = render.stats.active
+    if stats is not None:
+        intersect = stats.count_tests(intersect)
+    closest_t = INF
+    closest = -1
+    for i in grid.large:
+        t = intersect(i, origin, direction, t_min, t_max)
+        if t < closest_t:
+            closest_t = t
+            closest = i
+
+    grid._ray += 1
+    ray = grid._ray
+    mailbox = grid._mailbox
+    cells = _walk(grid, origin, direction, t_min, min(t_max, closest_t))
+    if stats is not None:
+        cells = stats.count_cells(cells)
+    for cell, t_exit in cells:
+        for i in cell:
+            if mailbox[i] == ray:
+                continue
+            mailbox[i] = ray
+            t = intersect(i, origin, direction, t_min, t_max)
+            if t < closest_t or (t == closest_t and i < closest):
+                closest_t = t
+                closest = i
+        # A hit inside this cell cannot be beaten by any later cell.
+        if closest_t <= t_exit:
+            break
+
+    if closest < 0:
+        return None
+    return (closest, closest_t)
+
+
+def grid_occluded(grid, origin, direction, t_min, t_max, intersect):
+    """
+    Any-hit query for shadow rays: returns True as soon as any sphere is hit
+    within (t_min, t_max).
+    """
+    stats = render.stats.active
+    if stats is not None:
+        intersect = stats.count_tests(intersect)
+    for i in grid.large:
+        if intersect(i, origin, direction, t_min, t_max) < t_max:
+            return True
+
+    grid._ray += 1
+    ray = grid._ray
+    mailbox = grid._mailbox
+    cells = _walk(grid, origin, direction, t_min, t_max)
+    if stats is not None:
+        cells = stats.count_cells(cells)
+    for cell, _ in cells:
+        for i in cell:
+            if mailbox[i] == ray:
+                continue
+            mailbox[i] = ray
+            if intersect(i, origin, direction, t_min, t_max) < t_max:
+                return True
+    return False
@@ -0,0 +1,125 @@
+"""
+Streaming image writers for renders too large to keep in memory.
+
+Both writers take finished tiles through write_tile((x0, y0, x1, y1), block),
+with block a (y1 - y0, x1 - x0, 3) uint8 array, in any order, and are used
+as the `sink` of render.tiles.render_parallel.
+
+PPMWriter writes binary PPM (P6). The file is sized up front and every tile
+row is written straight to its place, so nothing is buffered.
+
+PNGWriter encodes scanlines as soon as every row above them is done. Tiles
+are collected per band of rows; a completed band at the top of the unwritten
+part of the image is deflated into IDAT chunks and dropped. Memory therefore
+stays at the bands that are still in progress, which with row-order tile
+scheduling is a few bands.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Compressed bytes collected before an IDAT chunk is written.
+IDAT_SIZE = 1 << 16
+
+
+def writer_for(path, width, height):
+    """PNGWriter or PPMWriter, chosen by the extension of path."""
+    if path.lower().endswith('.png'):
+        return PNGWriter(path, width, height)
+    if path.lower().endswith(('.ppm', '.pnm')):
+        return PPMWriter(path, width, height)
+    raise ValueError(f"cannot stream {path}: use a .png or .ppm file name")
+
+
+class PPMWriter:
+    def __init__(self, path, width, height):
+        self.width = width
+        self.height = height
+        self._file = open(path, 'wb')
+        header = f"P6\n{width} {height}\n255\n".encode()
+        self._offset = len(header)
+        self._file.write(header)
+        self._file.truncate(self._offset + width * height * 3)
+
+    def write_tile(self, tile, block):
+        x0, y0, x1, y1 = tile
+        for row in range(y1 - y0):
+            self._file.seek(self._offset + ((y0 + row) * self.width + x0) * 3)
+            self._file.write(block[row].tobytes())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PNGWriter:
+    def __init__(self, path, width, height, compression=6):
+        """compression: zlib level, 0 (none) to 9 (smallest)."""
+        self.width = width
+        self.height = height
+        self._file = open(path, 'wb')
+        self._file.write(PNG_SIGNATURE)
+        # 8-bit RGB, no interlacing.
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        self._deflate = zlib.compressobj(compression)
+        self._pending = b''
+        # First row not encoded yet.
+        self.next_row = 0
+        # band start row -> [rows array, pixels still missing]
+        self._bands = {}
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)) + kind + data
+                         + struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def _encode(self, rows):
+        # Filter type 0 (none) in front of every scanline.
+        lines = np.empty((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        lines[:, 0] = 0
+        lines[:, 1:] = rows.reshape(len(rows), -1)
+        self._pending += self._deflate.compress(lines.tobytes())
+        if len(self._pending) >= IDAT_SIZE:
+            self._chunk(b'IDAT', self._pending)
+            self._pending = b''
+
+    def write_tile(self, tile, block):
+        x0, y0, x1, y1 = tile
+        band = self._bands.get(y0)
+        if band is None:
+            band = self._bands[y0] = [np.empty((y1 - y0, self.width, 3), dtype=np.uint8),
+                                      (y1 - y0) * self.width]
+        band[0][:, x0:x1] = block
+        band[1] -= (y1 - y0) * (x1 - x0)
+        # Encode every finished band that continues the image.
+        while self.next_row in self._bands and self._bands[self.next_row][1] == 0:
+            rows = self._bands.pop(self.next_row)[0]
+            self._encode(rows)
+            self.next_row += len(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.next_row != self.height:
+            self._file.close()
+            raise ValueError(f"PNG closed after {self.next_row} of {self.height} rows")
+        self._chunk(b'IDAT', self._pending + self._deflate.flush())
+        self._chunk(b'IEND', b'')
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            # A failed render: keep the partial file, do not finish it.
+            self._file.close()
@@ -0,0 +1,291 @@
+"""
+Ray-packet tracing of sphere scenes with NumPy.
+
+Instead of tracing one ray at a time through Vec objects, a whole packet of
+rays (a frame or a tile) is stored as (N, 3) float arrays and every step of
+trace_ray / compute_lighting is applied to all of them at once.
+
+Every arithmetic step mirrors the scalar code operation by operation (same
+operand order, same strict comparisons, spheres tested in list order) so the
+packet path produces exactly the same pixels as the per-pixel renderer.
+
+With render.stats on, every packet query counts its rays, ray-sphere tests
+and hits under the ray type of the packet.
+"""
+import operator
+
+import numpy as np
+
+import assignment2.light
+import render.stats
+
+INF = float('inf')
+
+# Python's float ** goes through the C library pow(), which is not always
+# bit-identical to NumPy's vectorized power, so the ** of the scalar
+# specular term is evaluated with the same pow() here.
+_pow = np.frompyfunc(operator.pow, 2, 1)
+
+
+def py_pow(base, exponent):
+    """Element-wise base ** exponent using Python's float pow()."""
+    return _pow(base, exponent).astype(np.float64)
+
+
+def dot(a, b):
+    """Row-wise dot product, summed in the same order as Vec.dot."""
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1] + a[:, 2] * b[:, 2]
+
+
+def length(a):
+    """Row-wise vector length, computed the same way as Vec.length."""
+    return np.sqrt(a[:, 0] * a[:, 0] + a[:, 1] * a[:, 1] + a[:, 2] * a[:, 2])
+
+
+class SphereArrays:
+    """
+    Structure-of-arrays copy of a sphere list.
+    centers: (N, 3), colors: (N, 3), radius_sq, specular, reflective: (N,)
+    """
+    def __init__(self, spheres):
+        self.centers = np.array([(s.center.x, s.center.y, s.center.z) for s in spheres],
+                                dtype=np.float64).reshape(-1, 3)
+        self.radius_sq = np.array([s.radius ** 2 for s in spheres], dtype=np.float64)
+        self.colors = np.array([(s.color.r, s.color.g, s.color.b) for s in spheres],
+                               dtype=np.float64).reshape(-1, 3)
+        self.specular = np.array([s.specular for s in spheres], dtype=np.float64)
+        self.reflective = np.array([s.reflective for s in spheres], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.radius_sq)
+
+
+class PacketScene:
+    """
+    Everything the packet tracer needs about a sphere scene.
+    """
+    def __init__(self, spheres, lights, background_color, epsilon, recursion_depth):
+        self.spheres = SphereArrays(spheres)
+        self.lights = lights
+        self.background = np.array([background_color.r, background_color.g,
+                                    background_color.b], dtype=np.float64)
+        self.epsilon = epsilon
+        self.recursion_depth = recursion_depth
+
+
+def closest_intersection(spheres, origins, directions, t_min, t_max):
+    """
+    Finds the closest sphere hit by each ray within (t_min, t_max).
+    t_min and t_max may be scalars or per-ray arrays.
+    Returns (index, t): the sphere index (-1 for a miss) and the hit distance.
+    """
+    n = len(origins)
+    closest_t = np.full(n, INF)
+    closest_index = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return closest_index, closest_t
+
+    ox, oy, oz = origins[:, 0], origins[:, 1], origins[:, 2]
+    dx, dy, dz = directions[:, 0], directions[:, 1], directions[:, 2]
+    k1 = dx * dx + dy * dy + dz * dz
+    four_k1 = 4 * k1
+    two_k1 = 2 * k1
+
+    with np.errstate(invalid='ignore'):
+        for k, (center, radius_sq) in enumerate(zip(spheres.centers.tolist(),
+                                                    spheres.radius_sq.tolist())):
+            cx, cy, cz = center
+            ocx = ox - cx
+            ocy = oy - cy
+            ocz = oz - cz
+            k2 = 2 * (ocx * dx + ocy * dy + ocz * dz)
+            k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - radius_sq
+            # A negative discriminant gives NaN roots, which fail every
+            # comparison below just like the scalar (inf, inf) miss.
+            sqrt_d = np.sqrt(k2 * k2 - four_k1 * k3)
+            t1 = (-k2 + sqrt_d) / two_k1
+            t2 = (-k2 - sqrt_d) / two_k1
+
+            mask = (t_min < t1) & (t1 < t_max) & (t1 < closest_t)
+            closest_t = np.where(mask, t1, closest_t)
+            closest_index[mask] = k
+            mask = (t_min < t2) & (t2 < t_max) & (t2 < closest_t)
+            closest_t = np.where(mask, t2, closest_t)
+            closest_index[mask] = k
+
+    stats = render.stats.active
+    if stats is not None:
+        stats.current[2] += n * len(spheres)
+    return closest_index, closest_t
+
+
+def occluded(spheres, origins, directions, t_min, t_max):
+    """
+    Any-hit query for a packet of shadow rays: True for every ray that hits
+    some sphere within (t_min, t_max). Rays drop out of the packet as soon
+    as they are blocked, so later spheres are only tested against the rays
+    that are still unoccluded.
+    """
+    n = len(origins)
+    blocked = np.zeros(n, dtype=bool)
+    active = np.arange(n)
+    lo = np.broadcast_to(t_min, n)
+    hi = np.broadcast_to(t_max, n)
+    ox, oy, oz = origins[:, 0], origins[:, 1], origins[:, 2]
+    dx, dy, dz = directions[:, 0], directions[:, 1], directions[:, 2]
+    k1 = dx * dx + dy * dy + dz * dz
+    tests = 0
+
+    with np.errstate(invalid='ignore'):
+        for center, radius_sq in zip(spheres.centers.tolist(), spheres.radius_sq.tolist()):
+            if not len(active):
+                break
+            tests += len(active)
+            cx, cy, cz = center
+            ocx = ox - cx
+            ocy = oy - cy
+            ocz = oz - cz
+            k2 = 2 * (ocx * dx + ocy * dy + ocz * dz)
+            k3 = (ocx * ocx + ocy * ocy + ocz * ocz) - radius_sq
+            sqrt_d = np.sqrt(k2 * k2 - 4 * k1 * k3)
+            t1 = (-k2 + sqrt_d) / (2 * k1)
+            t2 = (-k2 - sqrt_d) / (2 * k1)
+            hit = ((lo < t1) & (t1 < hi)) | ((lo < t2) & (t2 < hi))
+            if hit.any():
+                blocked[active[hit]] = True
+                keep = ~hit
+                active = active[keep]
+                ox, oy, oz, dx, dy, dz = ox[keep], oy[keep], oz[keep], dx[keep], dy[keep], dz[keep]
+                k1, lo, hi = k1[keep], lo[keep], hi[keep]
+
+    stats = render.stats.active
+    if stats is not None:
+        stats.current[2] += tests
+    return blocked
+
+
+def closest_hits(result):
+    """Number of rays that hit a sphere, for a closest_intersection result."""
+    return int((result[0] >= 0).sum())
+
+
+def blocked_count(blocked):
+    """Number of shadow rays that are blocked, for an occluded result."""
+    return int(blocked.sum())
+
+
+def shadow_rays(light, points):
+    """
+    Directions and t_max of the shadow rays from points toward a point or
+    directional light, or None for a light that casts no shadows.
+    """
+    if isinstance(light, assignment2.light.PointLight):
+        p = light.position
+        return np.array([p.x, p.y, p.z]) - points, 1.0
+    if isinstance(light, assignment2.light.DirectionalLight):
+        d = light.direction
+        return np.broadcast_to(np.array([d.x, d.y, d.z], dtype=np.float64), (len(points), 3)), INF
+    return None
+
+
+def compute_lighting(scene, points, normals, views, specular, blocked=None):
+    """
+    Computes the lighting intensity at every point (ambient, diffuse and
+    specular terms plus shadow rays), like compute_lighting of the scalar code.
+    blocked: optional list holding, for every light, the result of occluded
+    for its shadow rays (None for ambient lights), when the shadow rays were
+    already traced; otherwise they are traced here, light by light.
+    """
+    n = len(points)
+    intensity = np.zeros(n)
+    normal_length = length(normals)
+    view_length = length(views)
+    has_specular = specular != -1
+
+    for k, light in enumerate(scene.lights):
+        if isinstance(light, assignment2.light.AmbientLight):
+            intensity = intensity + light.intensity
+            continue
+        rays = shadow_rays(light, points)
+        if rays is None:
+            continue
+        L, t_max = rays
+
+        # Shadow check.
+        if blocked is None:
+            stats = render.stats.active
+            if stats is None:
+                lit = ~occluded(scene.spheres, points, L, scene.epsilon, t_max)
+            else:
+                lit = ~stats.trace_packet("shadow", blocked_count, occluded, scene.spheres,
+                                          points, L, scene.epsilon, t_max)
+        else:
+            lit = ~blocked[k]
+
+        # Diffuse shading.
+        n_dot_l = dot(normals, L)
+        mask = lit & (n_dot_l > 0)
+        if mask.any():
+            diffuse = light.intensity * n_dot_l[mask] / (normal_length[mask] * length(L[mask]))
+            intensity[mask] = intensity[mask] + diffuse
+
+        # Specular shading.
+        mask = lit & has_specular
+        if mask.any():
+            R = normals[mask] * (2 * n_dot_l[mask])[:, None] - L[mask]
+            r_dot_v = dot(R, views[mask])
+            shiny = r_dot_v > 0
+            where = np.flatnonzero(mask)[shiny]
+            base = r_dot_v[shiny] / (length(R[shiny]) * view_length[where])
+            intensity[where] = intensity[where] + light.intensity * py_pow(base, specular[where])
+
+    return intensity
+
+
+def trace_rays(scene, origins, directions, t_min, t_max, depth, kind="primary"):
+    """
+    Traces a packet of rays and returns their colors as an (N, 3) float array.
+    Reflective hits are traced again as a smaller packet until depth runs out.
+    kind is the ray type counted by render.stats.
+    """
+    colors = np.empty((len(origins), 3))
+    colors[:] = scene.background
+
+    stats = render.stats.active
+    if stats is None:
+        index, t = closest_intersection(scene.spheres, origins, directions, t_min, t_max)
+    else:
+        index, t = stats.trace_packet(kind, closest_hits, closest_intersection, scene.spheres,
+                                      origins, directions, t_min, t_max)
+    hit = index >= 0
+    if not hit.any():
+        return colors
+
+    index = index[hit]
+    directions = directions[hit]
+    points = origins[hit] + directions * t[hit][:, None]
+    normals = points - scene.spheres.centers[index]
+    normals = normals / length(normals)[:, None]
+    views = directions * -1
+
+    lighting = compute_lighting(scene, points, normals, views, scene.spheres.specular[index])
+    local_colors = scene.spheres.colors[index] * lighting[:, None]
+
+    reflective = scene.spheres.reflective[index]
+    bounce = reflective > 0
+    if depth > 0 and bounce.any():
+        r = reflective[bounce][:, None]
+        n = normals[bounce]
+        v = views[bounce]
+        reflected_rays = n * (2 * dot(v, n))[:, None] - v
+        reflected_colors = trace_rays(scene, points[bounce], reflected_rays,
+                                      scene.epsilon, INF, depth - 1, "reflection")
+        local_colors[bounce] = local_colors[bounce] * (1 - r) + reflected_colors * r
+
+    colors[hit] = local_colors
+    return colors
+
+
+def to_pixels(colors):
+    """Clamps float colors to 0..255 the same way as max(min(int(c), 255), 0)."""
+    return np.clip(np.trunc(colors), 0, 255).astype(np.uint8)
@@ -0,0 +1,189 @@
+"""
+Opt-in render statistics: rays per type, acceleration-structure work, time
+per phase and per tile.
+
+Instrumentation is off unless enable() is called. Every hook in the tracers
+and traversal code is a single `render.stats.active is None` test per ray or
+per traversal, so renders without statistics pay next to nothing; the
+counting wrappers are only installed while statistics are on.
+
+Counters are kept per ray type (primary, shadow, reflection, refraction):
+rays traced, acceleration-structure nodes visited (BVH boxes tested or grid
+cells walked), primitive tests and rays that hit something. Phases are load,
+build, trace (time inside intersection queries), shade (the rest of the
+time spent on tiles) and encode.
+
+render.tiles records a delta of the counters for every tile. Worker
+processes started by fork inherit the enabled state and send their tile
+records back with the tile, so the parent ends up with the totals.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+RAY_TYPES = ('primary', 'shadow', 'reflection', 'refraction')
+PHASES = ('load', 'build', 'trace', 'shade', 'encode')
+COUNTERS = ('rays', 'nodes', 'tests', 'hits')
+
+# The RenderStats collecting in this process, or None when disabled.
+active = None
+
+
+def enable():
+    """Turns statistics on in this process and returns the collector."""
+    global active
+    active = RenderStats()
+    return active
+
+
+def disable():
+    global active
+    active = None
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the with-block to phase `name` (no-op when disabled)."""
+    stats = active
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[name] += time.perf_counter() - started
+
+
+class RenderStats:
+    def __init__(self):
+        # ray type -> [rays, nodes, tests, hits]
+        self.counts = {kind: [0, 0, 0, 0] for kind in RAY_TYPES}
+        # Counters of the ray type being traced; traversal code adds to these.
+        self.current = self.counts['primary']
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.tiles = []
+
+    def trace(self, kind, query, *args):
+        """
+        Runs the intersection query query(*args) for a ray of type kind,
+        counting the ray, its hit (a truthy result) and its time.
+        """
+        counts = self.counts[kind]
+        counts[0] += 1
+        self.current = counts
+        started = time.perf_counter()
+        result = query(*args)
+        self.phases['trace'] += time.perf_counter() - started
+        if result:
+            counts[3] += 1
+        return result
+
+    def trace_packet(self, kind, hits, query, spheres, origins, *args):
+        """
+        Runs the packet query query(spheres, origins, *args) for len(origins)
+        rays of type kind, counting the rays, their hits (hits(result) is the
+        number of rays that hit something) and the time. The query adds its
+        sphere tests to the counters itself.
+        """
+        counts = self.counts[kind]
+        counts[0] += len(origins)
+        self.current = counts
+        started = time.perf_counter()
+        result = query(spheres, origins, *args)
+        self.phases['trace'] += time.perf_counter() - started
+        counts[3] += hits(result)
+        return result
+
+    def count_tests(self, intersect):
+        """Wraps a primitive test callback so every call is counted."""
+        def counted(*args):
+            self.current[2] += 1
+            return intersect(*args)
+        return counted
+
+    def count_nodes(self, enter):
+        """Wraps a node box test so every call is counted."""
+        def counted(*args):
+            self.current[1] += 1
+            return enter(*args)
+        return counted
+
+    def count_cells(self, cells):
+        """Passes through the cells of a grid walk, counting them as nodes."""
+        for cell in cells:
+            self.current[1] += 1
+            yield cell
+
+    def begin_tile(self):
+        """State to hand to end_tile once the tile is rendered."""
+        return ({kind: list(c) for kind, c in self.counts.items()}, self.phases['trace'])
+
+    def end_tile(self, tile, seconds, begun):
+        """
+        Records the work done on tile (x0, y0, x1, y1) since begin_tile and
+        returns the record, which add_tile can merge into another collector.
+        """
+        before, trace_before = begun
+        counts = {kind: [now - then for now, then in zip(self.counts[kind], before[kind])]
+                  for kind in RAY_TYPES}
+        trace = self.phases['trace'] - trace_before
+        self.phases['shade'] += max(seconds - trace, 0.0)
+        record = {'tile': list(tile), 'seconds': seconds, 'trace': trace, 'counts': counts}
+        for i, name in enumerate(COUNTERS):
+            record[name] = sum(c[i] for c in counts.values())
+        self.tiles.append(record)
+        return record
+
+    def add_tile(self, record):
+        """Merges a tile record made by end_tile in a worker process."""
+        for kind, deltas in record['counts'].items():
+            counts = self.counts[kind]
+            for i, d in enumerate(deltas):
+                counts[i] += d
+        self.phases['trace'] += record['trace']
+        self.phases['shade'] += max(record['seconds'] - record['trace'], 0.0)
+        self.tiles.append(record)
+
+    def to_dict(self):
+        rays = {kind: dict(zip(COUNTERS, c)) for kind, c in self.counts.items()}
+        return {'rays': rays, 'phases': dict(self.phases), 'tiles': self.tiles}
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self):
+        """Human-readable table of the counters and phases."""
+        lines = [f"{'ray type':<12}{'rays':>12}{'nodes/ray':>12}{'tests/ray':>12}{'hit rate':>10}"]
+        for kind, (rays, nodes, tests, hits) in self.counts.items():
+            if rays:
+                lines.append(f"{kind:<12}{rays:>12}{nodes / rays:>12.1f}{tests / rays:>12.1f}"
+                             f"{hits / rays:>10.1%}")
+        lines.append("phases: " + ", ".join(f"{name} {seconds:.3f} s"
+                                            for name, seconds in self.phases.items() if seconds))
+        return "\n".join(lines)
+
+    def heatmap(self, width, height, field='seconds'):
+        """
+        (height, width, 3) uint8 image of a per-tile value ('seconds', 'rays',
+        'nodes', 'tests' or 'hits'), scaled from black for zero through red
+        and yellow to white for the largest value.
+        """
+        values = np.zeros((height, width))
+        for record in self.tiles:
+            x0, y0, x1, y1 = record['tile']
+            values[y0:y1, x0:x1] = record[field]
+        top = values.max()
+        if top > 0:
+            values /= top
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        for channel in range(3):
+            image[..., channel] = np.clip(3 * values - channel, 0, 1) * 255
+        return image
+
+    def save_heatmap(self, path, width, height, field='seconds'):
+        Image.fromarray(self.heatmap(width, height, field), "RGB").save(path)
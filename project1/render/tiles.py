@@ -0,0 +1,324 @@
+"""
+Tiled, multi-process rendering into a shared-memory framebuffer.
+
+The image is split into square tiles which are rendered by worker processes.
+Every worker attaches to the same shared-memory framebuffer and writes its
+finished tiles straight into it, so no pixel data has to be sent back to the
+parent process.
+
+Tiles are put in the order of a space-filling curve (Hilbert by default), so
+consecutive tiles are neighbours on screen and trace rays through the same
+part of the scene. Each worker starts with its own contiguous run of that
+order; a worker that runs out steals the back half of the largest run left,
+so expensive regions are shared out until the very end while every worker
+still works on a compact patch of the image.
+
+A tile renderer is any picklable callable render_tile(x0, y0, x1, y1) that
+returns the pixel block [x0, x1) x [y0, y1) as a (y1 - y0, x1 - x0, 3) uint8
+array (image coordinates, row 0 at the top).
+"""
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import render.stats
+
+TILE_ORDERS = ('hilbert', 'morton', 'row')
+
+
+def split_tiles(width, height, tile_size):
+    """Returns the (x0, y0, x1, y1) tiles covering the image in row-major order."""
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tiles.append((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)))
+    return tiles
+
+
+def morton_key(x, y):
+    """Z-order index of grid cell (x, y): the bits of x and y interleaved."""
+    key = 0
+    bit = 0
+    while x >> bit or y >> bit:
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return key
+
+
+def hilbert_key(x, y, n):
+    """
+    Index of grid cell (x, y) along the Hilbert curve filling an n x n grid
+    (n a power of two).
+    """
+    key = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        key += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve inside it has the standard shape.
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - (x & (s - 1))
+                y = s - 1 - (y & (s - 1))
+            x, y = y, x
+        x &= s - 1
+        y &= s - 1
+        s //= 2
+    return key
+
+
+def order_tiles(tiles, tile_size, order='hilbert'):
+    """
+    Returns the tiles sorted along a space-filling curve over the tile grid:
+    'hilbert', 'morton' (Z-order) or 'row' (unchanged row-major order).
+    """
+    if order == 'row':
+        return list(tiles)
+    if order == 'morton':
+        return sorted(tiles, key=lambda t: morton_key(t[0] // tile_size, t[1] // tile_size))
+    if order == 'hilbert':
+        side = max(max(t[0] // tile_size, t[1] // tile_size) for t in tiles) + 1 if tiles else 1
+        n = 1
+        while n < side:
+            n *= 2
+        return sorted(tiles, key=lambda t: hilbert_key(t[0] // tile_size, t[1] // tile_size, n))
+    raise ValueError(f"unknown tile order {order!r}, expected one of {TILE_ORDERS}")
+
+
+def resolve_workers(workers):
+    """Maps a requested worker count to a real one (0 or None means all cores)."""
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+
+def _take_tile(runs, lock, worker):
+    """
+    Index of the next tile for `worker`, or None when every run is empty.
+    runs holds a (start, end) pair per worker; a worker takes from the front
+    of its own run and, once that is empty, moves the back half of the
+    largest other run over to itself.
+    """
+    with lock:
+        start, end = runs[2 * worker], runs[2 * worker + 1]
+        if start == end:
+            victim = max(range(len(runs) // 2), key=lambda w: runs[2 * w + 1] - runs[2 * w])
+            v_start, v_end = runs[2 * victim], runs[2 * victim + 1]
+            if v_start == v_end:
+                return None
+            middle = v_start + (v_end - v_start) // 2
+            runs[2 * victim + 1] = middle
+            start, end = middle, v_end
+        runs[2 * worker] = start + 1
+        runs[2 * worker + 1] = end
+        return start
+
+
+def _worker(worker, tiles, runs, results, shm_name, shape, render_tile, initializer, initargs):
+    """
+    Worker process: renders tiles until none are left and reports
+    ('tile', index, seconds, worker, pixels, stats record) for each one, or
+    ('error', worker, traceback) if anything fails. With a shared framebuffer
+    (shm_name) the tile is written into it and pixels is None; otherwise
+    the pixel bytes travel with the message. The stats record is None
+    unless render.stats is enabled.
+    When there is a single run, all workers take from it in order.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name) if shm_name else None
+        try:
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf) if shm else None
+            if initializer is not None:
+                initializer(*initargs)
+            lock = runs.get_lock()
+            own = worker if len(runs) > 2 else 0
+            while True:
+                index = _take_tile(runs, lock, own)
+                if index is None:
+                    break
+                x0, y0, x1, y1 = tiles[index]
+                stats = render.stats.active
+                begun = stats.begin_tile() if stats is not None else None
+                started = time.perf_counter()
+                block = render_tile(x0, y0, x1, y1)
+                seconds = time.perf_counter() - started
+                record = stats.end_tile(tiles[index], seconds, begun) if stats is not None else None
+                pixels = None
+                if frame is not None:
+                    frame[y0:y1, x0:x1] = block
+                else:
+                    pixels = np.ascontiguousarray(block, dtype=np.uint8).tobytes()
+                results.put(('tile', index, seconds, worker, pixels, record))
+            del frame
+        finally:
+            if shm is not None:
+                shm.close()
+    except BaseException:
+        results.put(('error', worker, traceback.format_exc()))
+
+
+def render_parallel(render_tile, width, height, workers=1, tile_size=32,
+                    initializer=None, initargs=(), progress=None, order='hilbert',
+                    costs=None, checkpoint=None, sink=None):
+    """
+    Renders a width x height image tile by tile and returns it as a
+    (height, width, 3) uint8 array.
+
+    workers: number of processes (0 or None uses every core; 1 renders in the
+             calling process).
+    tile_size: edge length of the square tiles in pixels.
+    initializer/initargs: run once in every worker before its first tile, to
+             install scene state that is not inherited by the worker process.
+    progress: optional callback progress(done, total) called after every tile.
+    order: tile order, one of TILE_ORDERS.
+    costs: optional list that receives an (x0, y0, x1, y1, seconds, worker)
+           record per tile, in completion order (see cost_report).
+    checkpoint: optional render.checkpoint.Checkpoint; its tiles are reused
+           instead of rendered and every new tile is added to it.
+    sink: optional callback sink(tile, block) that takes every finished tile
+           instead of a framebuffer (e.g. a render.output writer); nothing is
+           returned and memory does not grow with the image. Workers then
+           share one queue in `order` instead of stealing, so tiles finish
+           close to that order.
+    """
+    tiles = order_tiles(split_tiles(width, height, tile_size), tile_size, order)
+    total = len(tiles)
+    restored = 0
+    if checkpoint is not None:
+        tiles = [t for t in tiles if t not in checkpoint.tiles]
+        restored = total - len(tiles)
+    workers = min(resolve_workers(workers), max(len(tiles), 1))
+
+    frame = None
+    replay = None
+    if sink is None:
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        if checkpoint is not None:
+            checkpoint.restore(frame)
+    elif checkpoint is not None:
+        replay = sink = checkpoint.replay(sink)
+
+    def finish(tile, block, seconds, worker, done):
+        if sink is not None:
+            sink(tile, block)
+        if costs is not None:
+            costs.append(tile + (seconds, worker))
+        if checkpoint is not None:
+            checkpoint.add(tile, block)
+        if progress is not None:
+            progress(done, total)
+
+    if workers == 1:
+        for done, (x0, y0, x1, y1) in enumerate(tiles, restored + 1):
+            stats = render.stats.active
+            begun = stats.begin_tile() if stats is not None else None
+            started = time.perf_counter()
+            block = render_tile(x0, y0, x1, y1)
+            seconds = time.perf_counter() - started
+            if stats is not None:
+                stats.end_tile((x0, y0, x1, y1), seconds, begun)
+            if frame is not None:
+                frame[y0:y1, x0:x1] = block
+                block = frame[y0:y1, x0:x1]
+            finish((x0, y0, x1, y1), block, seconds, 0, done)
+        if replay is not None:
+            replay.close()
+        return frame
+
+    if sink is None:
+        # Initial runs: equal contiguous slices of the curve order.
+        runs = multiprocessing.Array('i', 2 * workers)
+        for w in range(workers):
+            runs[2 * w] = len(tiles) * w // workers
+            runs[2 * w + 1] = len(tiles) * (w + 1) // workers
+    else:
+        runs = multiprocessing.Array('i', [0, len(tiles)])
+
+    shape = (height, width, 3)
+    shm = None
+    if sink is None:
+        shm = shared_memory.SharedMemory(create=True, size=width * height * 3)
+        shared = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        shared[:] = frame
+        frame = shared
+    results = multiprocessing.Queue()
+    processes = []
+    try:
+        for w in range(workers):
+            p = multiprocessing.Process(target=_worker,
+                                        args=(w, tiles, runs, results, shm.name if shm else None,
+                                              shape, render_tile, initializer, initargs),
+                                        daemon=True)
+            p.start()
+            processes.append(p)
+
+        done = 0
+        while done < len(tiles):
+            try:
+                message = results.get(timeout=1.0)
+            except queue.Empty:
+                if all(p.exitcode is not None for p in processes):
+                    raise RuntimeError("render workers exited before finishing every tile")
+                continue
+            if message[0] == 'error':
+                raise RuntimeError(f"render worker {message[1]} failed:\n{message[2]}")
+            _, index, seconds, worker, pixels, record = message
+            if record is not None and render.stats.active is not None:
+                render.stats.active.add_tile(record)
+            x0, y0, x1, y1 = tiles[index]
+            if frame is not None:
+                block = frame[y0:y1, x0:x1]
+            else:
+                block = np.frombuffer(pixels, dtype=np.uint8).reshape(y1 - y0, x1 - x0, 3)
+            done += 1
+            finish(tiles[index], block, seconds, worker, restored + done)
+        if replay is not None:
+            replay.close()
+        for p in processes:
+            p.join()
+        result = None
+        if frame is not None:
+            result = frame.copy()
+            del frame, shared
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        results.close()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return result
+
+
+def cost_report(costs, slowest=5):
+    """
+    Summarizes the records collected by render_parallel(costs=...): total and
+    per-worker render time, load imbalance and the most expensive tiles.
+    """
+    if not costs:
+        return "no tiles rendered"
+    total = sum(c[4] for c in costs)
+    busy = {}
+    count = {}
+    for c in costs:
+        busy[c[5]] = busy.get(c[5], 0.0) + c[4]
+        count[c[5]] = count.get(c[5], 0) + 1
+    lines = [f"{len(costs)} tiles, {total:.3f} s of tile time, "
+             f"mean {1000 * total / len(costs):.2f} ms per tile"]
+    for w in sorted(busy):
+        lines.append(f"  worker {w}: {count[w]} tiles, {busy[w]:.3f} s")
+    if len(busy) > 1:
+        mean = total / len(busy)
+        lines.append(f"  imbalance (busiest / mean worker): {max(busy.values()) / mean:.3f}")
+    lines.append("slowest tiles:")
+    for x0, y0, x1, y1, seconds, w in sorted(costs, key=lambda c: -c[4])[:slowest]:
+        lines.append(f"  [{x0}, {x1}) x [{y0}, {y1}): {1000 * seconds:.2f} ms (worker {w})")
+    return "\n".join(lines)
@@ -0,0 +1,141 @@
+"""
+Wavefront tracing of sphere scenes: the recursion of trace_ray unrolled into
+queues of rays that are processed in bulk, one bounce at a time.
+
+All primary rays of a tile form the first queue. Each queue is intersected
+in one pass, its hits emit a single queue of shadow rays (toward every
+light at once) and a queue of reflection rays for the next bounce. A path
+that misses, lands on a non-reflective sphere or runs out of depth simply
+does not appear in the next queue, so finished paths cost nothing more.
+
+Every queued ray carries its path weight, the product of the reflectivities
+along the path, i.e. how much the ray can still add to its pixel. Paths
+whose weight would drop to min_weight or below are ended there, like a ray
+that runs out of depth. The default of 0 ends none of them early.
+
+Colors are resolved once all queues are done, from the last bounce back to
+the first, with the same blend as the recursive tracer, so with min_weight
+0 the pixels are exactly those of render.packet.trace_rays and of the
+per-ray renderer. The kernels are those of render.packet, and with
+render.stats on every queue is counted like a packet: the first queue as
+primary rays, the later ones as reflection rays, shadow queues as shadow rays.
+"""
+import numpy as np
+
+import render.stats
+from render.packet import (INF, blocked_count, closest_hits, closest_intersection,
+                           compute_lighting, dot, length, occluded, shadow_rays)
+
+
+class RayQueue:
+    """
+    Rays waiting for the same bounce, stored as arrays.
+    origins, directions: (N, 3); weights: (N,) path weights.
+    """
+    def __init__(self, origins, directions, weights):
+        self.origins = origins
+        self.directions = directions
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.origins)
+
+
+def trace_shadows(scene, points):
+    """
+    Tests the shadow rays from points toward every light as one queue and
+    returns, per light, the rays that are blocked (None for ambient lights),
+    as compute_lighting takes them.
+    """
+    rays = [shadow_rays(light, points) for light in scene.lights]
+    queued = [r for r in rays if r is not None]
+    if not queued:
+        return [None] * len(rays)
+    n = len(points)
+    directions = np.concatenate([L for L, _ in queued])
+    t_max = np.concatenate([np.full(n, t) for _, t in queued])
+    origins = np.concatenate([points] * len(queued))
+    stats = render.stats.active
+    if stats is None:
+        blocked = occluded(scene.spheres, origins, directions, scene.epsilon, t_max)
+    else:
+        blocked = stats.trace_packet("shadow", blocked_count, occluded, scene.spheres, origins,
+                                     directions, scene.epsilon, t_max)
+    result = []
+    start = 0
+    for r in rays:
+        if r is None:
+            result.append(None)
+        else:
+            result.append(blocked[start:start + n])
+            start += n
+    return result
+
+
+def shade_queue(scene, queue, t_min, t_max, kind="primary"):
+    """
+    Intersects and shades one queue. Returns (colors, hit, index, points,
+    normals, views): the local color of every ray (the background for a
+    miss) and, for the rays that hit, the sphere and surface data.
+    kind is the ray type counted by render.stats.
+    """
+    colors = np.empty((len(queue), 3))
+    colors[:] = scene.background
+    stats = render.stats.active
+    if stats is None:
+        index, t = closest_intersection(scene.spheres, queue.origins, queue.directions,
+                                        t_min, t_max)
+    else:
+        index, t = stats.trace_packet(kind, closest_hits, closest_intersection, scene.spheres,
+                                      queue.origins, queue.directions, t_min, t_max)
+    hit = index >= 0
+    index = index[hit]
+    directions = queue.directions[hit]
+    points = queue.origins[hit] + directions * t[hit][:, None]
+    normals = points - scene.spheres.centers[index]
+    normals = normals / length(normals)[:, None]
+    views = directions * -1
+    if len(index):
+        blocked = trace_shadows(scene, points)
+        lighting = compute_lighting(scene, points, normals, views, scene.spheres.specular[index],
+                                    blocked)
+        colors[hit] = scene.spheres.colors[index] * lighting[:, None]
+    return colors, hit, index, points, normals, views
+
+
+def trace_rays(scene, origins, directions, t_min, t_max, depth, min_weight=0.0):
+    """
+    Traces rays bounce by bounce and returns their colors as an (N, 3) float
+    array, like render.packet.trace_rays.
+    """
+    queue = RayQueue(origins, directions, np.ones(len(origins)))
+    # Per bounce: the colors of its queue, which of its rays were extended
+    # by a reflection ray and their reflectivity.
+    bounces = []
+    kind = "primary"
+    while True:
+        colors, hit, index, points, normals, views = shade_queue(scene, queue, t_min, t_max, kind)
+        reflective = scene.spheres.reflective[index]
+        weights = queue.weights[hit] * reflective
+        bounce = reflective > 0
+        if min_weight > 0:
+            bounce &= weights > min_weight
+        if depth <= 0 or not bounce.any():
+            bounces.append((colors, None, None))
+            break
+        extended = np.flatnonzero(hit)[bounce]
+        bounces.append((colors, extended, reflective[bounce][:, None]))
+        n = normals[bounce]
+        v = views[bounce]
+        queue = RayQueue(points[bounce], n * (2 * dot(v, n))[:, None] - v, weights[bounce])
+        t_min, t_max = scene.epsilon, INF
+        kind = "reflection"
+        depth -= 1
+
+    # Blend the reflected colors into their parents, deepest bounce first.
+    reflected = None
+    for colors, extended, r in reversed(bounces):
+        if extended is not None:
+            colors[extended] = colors[extended] * (1 - r) + reflected * r
+        reflected = colors
+    return reflected
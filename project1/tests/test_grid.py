@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from assignment1.vec import Vec
+from render.grid import SphereGrid, grid_closest, grid_occluded
+
+
+def never_hit(i, origin, direction, t_min, t_max):
+    raise AssertionError("an empty grid has no spheres to test")
+
+
+def test_empty_scene_misses():
+    grid = SphereGrid([])
+    origin = Vec(0, 0, 0)
+    direction = Vec(0, 0, 1)
+    assert grid.resolution == (0, 0, 0)
+    assert grid_closest(grid, origin, direction, 1.0, float('inf'), never_hit) is None
+    assert not grid_occluded(grid, origin, direction, 1.0, float('inf'), never_hit)